@@ -0,0 +1,82 @@
+import sys
+from collections import OrderedDict
+
+# rough memory footprint of a cached result, following the containers the analysis
+# functions return (dicts, sets, lists of lists and tuples of strings and numbers)
+def estimate_size(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += estimate_size(key) + estimate_size(item)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            size += estimate_size(item)
+    return size
+
+# default of resize's limits, telling a limit that is not passed from one set to None
+unchanged = object()
+
+# a least-recently-used cache bounded by number of entries and, optionally, by the
+# estimated memory of the stored results. Cached results are shared between callers
+# and must be treated as read-only
+class AnalysisCache:
+    def __init__(self, max_entries=4096, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (result, estimated size)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # returns (True, result) on a hit, (False, None) on a miss
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return False, None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[0]
+
+    def store(self, key, result):
+        if self.max_entries <= 0:
+            return  # caching disabled
+        size = estimate_size(result) if self.max_bytes is not None else 0
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (result, size)
+        self.bytes += size
+        self._evict()
+
+    # changes the limits that are passed, dropping the oldest entries if they no longer fit.
+    # max_bytes=None removes the memory limit
+    def resize(self, max_entries=None, max_bytes=unchanged):
+        if max_entries is not None:
+            self.max_entries = max_entries
+        if max_bytes is not unchanged:
+            self.max_bytes = max_bytes
+            # sizes are only tracked under a memory limit
+            self.bytes = 0
+            for key, (result, size) in self.entries.items():
+                size = estimate_size(result) if max_bytes is not None else 0
+                self.entries[key] = (result, size)
+                self.bytes += size
+        self._evict()
+
+    def _evict(self):
+        while self.entries and (len(self.entries) > self.max_entries or
+                                (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            key, (result, size) = self.entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self.entries), "bytes": self.bytes,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0}
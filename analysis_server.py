@@ -0,0 +1,457 @@
+import sys
+import json
+import time
+import random
+import asyncio
+import statistics
+import concurrent.futures
+from urllib.parse import urlsplit, parse_qs
+import chess
+from piece_methods import Position, PositionAnalysis, square_display_coordinates
+from attack_tables import squares_descending
+from analysis_cache import AnalysisCache
+from uci_engine import UCIEngine, EngineError
+from eval_store import EvalStore, normalize_fen
+from perf import Histogram
+
+# a local HTTP service for the analysis layers, so a web front end can show the overlays
+# without a pygame window per user. Layers are computed in a process pool, every layer of
+# a position at once since they share their move generation. Requests for a position that
+# is already being computed wait on that computation instead of starting another, and
+# results are kept in one LRU cache for every client. Engine searches go through a single
+# queue served by a fixed number of engine processes, merged and cached the same way.
+#
+#   GET  /analysis?fen=<fen>&layers=attack,struggle    layers of a position
+#   POST /analysis  {"fen": ..., "layers": [...]}       the same, as JSON
+#   GET  /evaluate?fen=<fen>&depth=12                   engine search, needs -e
+#   GET  /stats                                         counters and p50/p99 latencies
+#
+# Responses are JSON. Squares use the "xy" display keys of piece_methods
+
+# layer names a request can ask for, and the record fields each one returns
+layer_fields = {"attack": ("attack_white", "attack_black"),
+                "struggle": ("struggle",),
+                "king_attackers": ("king_attackers_white", "king_attackers_black"),
+                "legal_moves": ("legal_moves",),
+                "restricted": ("restricted_white", "restricted_black")}
+
+reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           503: "Service Unavailable"}
+
+# runs in a worker process. Every layer of the position, sets as sorted lists and the legal
+# moves as {origin: [destinations]} for both colors. The layers only depend on where the
+# pieces stand, so only the placement field of the FEN is used
+def analyze_placement(placement):
+    position = Position.from_fen(f"{placement} w - - 0 1")
+    analysis = PositionAnalysis(position)
+    record = {"struggle": analysis.board_struggle(), "legal_moves": {}}
+    for side, name in ((True, "white"), (False, "black")):
+        record[f"attack_{name}"] = analysis.attack_color_coding(side)
+        enemy_king = position.king("black" if side else "white")
+        record[f"king_attackers_{name}"] = (sorted(analysis.king_attackers(side))
+                                            if enemy_king is not None else [])
+        record[f"restricted_{name}"] = sorted(analysis.restricted_pieces(side))
+        for origin, (reach, legal) in analysis.move_table(side).items():
+            record["legal_moves"][square_display_coordinates[origin]] = sorted(
+                square_display_coordinates[destination] for destination in squares_descending(legal))
+    return record
+
+
+# counters and latency histograms of the service, in milliseconds
+class ServiceStats:
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.latencies = {}
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record(self, name, ms):
+        if name not in self.latencies:
+            self.latencies[name] = Histogram()
+        self.latencies[name].add(ms)
+
+    def to_dict(self):
+        return {"uptime_s": time.time() - self.started, "counters": dict(sorted(self.counters.items())),
+                "latency": {name: {key: value for key, value in histogram.summary().items() if key != "buckets"}
+                            for name, histogram in sorted(self.latencies.items())}}
+
+
+# runs compute(key) once for any number of concurrent callers of the same key and keeps
+# the results in an LRU cache. compute is a coroutine function
+class MergedCache:
+    def __init__(self, compute, stats, name, max_entries=4096):
+        self.compute = compute
+        self.stats = stats
+        self.name = name
+        self.cache = AnalysisCache(max_entries=max_entries)
+        self.in_flight = {}  # key -> future of the running computation
+
+    async def get(self, key):
+        found, result = self.cache.lookup(key)
+        if found:
+            self.stats.count(f"{self.name}.cache_hits")
+            return result
+        if key in self.in_flight:
+            self.stats.count(f"{self.name}.merged")
+            future = self.in_flight[key]
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise  # this request was cancelled, not the computation
+            # the request computing it was cancelled, take the computation over
+            return await self.get(key)
+
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        self.stats.count(f"{self.name}.computed")
+        try:
+            result = await self.compute(key)
+        except asyncio.CancelledError:
+            future.cancel()  # wakes the merged requests, they compute it themselves
+            raise
+        except Exception as error:
+            future.set_exception(error)
+            future.exception()  # retrieved here, waiters that gave up do not warn about it
+            raise
+        else:
+            self.cache.store(key, result)
+            future.set_result(result)
+            return result
+        finally:
+            del self.in_flight[key]
+
+
+# a queue of searches shared by every client, served by a fixed number of engine
+# processes. Each engine runs its searches on a thread so the event loop never blocks
+class EngineQueue:
+    def __init__(self, path, processes=1, options=None, store=None):
+        self.path = path
+        self.options = options
+        self.store = store
+        self.queue = asyncio.Queue()
+        self.threads = concurrent.futures.ThreadPoolExecutor(max_workers=processes)
+        self.engines = [None] * processes
+        self.tasks = [asyncio.get_running_loop().create_task(self._serve(slot))
+                      for slot in range(processes)]
+
+    # ((fen, depth) -> result), the fen already normalized
+    async def search(self, key):
+        fen, depth = key
+        loop = asyncio.get_running_loop()
+        if self.store is not None:
+            stored = await loop.run_in_executor(self.threads, lambda: self.store.lookup(fen, min_depth=depth))
+            if stored is not None:
+                stored["fen"] = fen
+                return stored
+        result = loop.create_future()
+        await self.queue.put((fen, depth, result))
+        return await result
+
+    def _search(self, slot, fen, depth):
+        engine = self.engines[slot]
+        if engine is None or not engine.is_alive():
+            engine = self.engines[slot] = UCIEngine(self.path, self.options)
+        engine.set_position(fen)
+        best_move, lines = engine.search(depth=depth)
+        result = {"fen": fen, "best_move": best_move}
+        if lines:
+            result.update({key: lines[0][key] for key in ("depth", "score_cp", "score_mate", "pv")
+                           if key in lines[0]})
+        if self.store is not None and best_move is not None:
+            self.store.store(fen, result)
+        return result
+
+    async def _serve(self, slot):
+        loop = asyncio.get_running_loop()
+        while True:
+            fen, depth, result = await self.queue.get()
+            try:
+                found = await loop.run_in_executor(self.threads, self._search, slot, fen, depth)
+            except EngineError as error:
+                if self.engines[slot] is not None:
+                    self.engines[slot].quit()
+                self.engines[slot] = None  # restarted for the next search
+                if not result.done():
+                    result.set_exception(error)
+            else:
+                if not result.done():
+                    result.set_result(found)
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+        for engine in self.engines:
+            if engine is not None:
+                engine.quit()
+        self.threads.shutdown(wait=False)
+
+
+class AnalysisService:
+    def __init__(self, workers=None, cache_entries=4096, engine_path=None, engine_processes=1,
+                 engine_depth=12, engine_options=None, store_path=None):
+        self.workers = workers
+        self.cache_entries = cache_entries
+        self.engine_path = engine_path
+        self.engine_processes = engine_processes
+        self.engine_depth = engine_depth
+        self.engine_options = engine_options or {"Hash": 256, "Threads": 1}
+        self.store_path = store_path
+        self.stats = ServiceStats()
+        self.pool = None
+        self.engine_queue = None
+        self.server = None
+        self.connections = set()  # handler tasks of the open connections
+
+    async def start(self, host="127.0.0.1", port=8765):
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        # the workers are started before any connection is accepted, a worker forked later
+        # would inherit the open client sockets and keep them from closing
+        await asyncio.get_running_loop().run_in_executor(self.pool, int)
+        self.analysis = MergedCache(self._analyze, self.stats, "analysis", self.cache_entries)
+        if self.engine_path:
+            store = EvalStore(self.store_path) if self.store_path else None
+            self.engine_queue = EngineQueue(self.engine_path, self.engine_processes,
+                                            self.engine_options, store)
+            self.evaluations = MergedCache(self.engine_queue.search, self.stats, "engine",
+                                           self.cache_entries)
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            for task in list(self.connections):
+                task.cancel()
+            await asyncio.gather(*self.connections, return_exceptions=True)
+            await self.server.wait_closed()
+        if self.engine_queue is not None:
+            self.engine_queue.close()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    async def _analyze(self, placement):
+        start = time.perf_counter()
+        result = await asyncio.get_running_loop().run_in_executor(self.pool, analyze_placement, placement)
+        self.stats.record("analysis.compute", (time.perf_counter() - start) * 1000)
+        return result
+
+    # (status, JSON payload) of one request
+    async def dispatch(self, method, target, body):
+        url = urlsplit(target)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        if method == "POST":
+            try:
+                query.update(json.loads(body or b"{}"))
+            except ValueError:
+                return 400, {"error": "the body is not JSON"}
+        elif method != "GET":
+            return 405, {"error": f"{method} is not supported"}
+
+        if url.path == "/stats":
+            stats = self.stats.to_dict()
+            stats["analysis_cache"] = self.analysis.cache.stats()
+            stats["engine_queue"] = self.engine_queue.pending() if self.engine_queue else None
+            return 200, stats
+        if url.path not in ("/analysis", "/evaluate"):
+            return 404, {"error": f"no such path {url.path}"}
+
+        fen = query.get("fen", chess.STARTING_FEN)
+        try:
+            py_board = chess.Board(fen)
+        except ValueError as error:
+            return 400, {"error": f"invalid FEN: {error}"}
+
+        if url.path == "/analysis":
+            layers = query.get("layers", list(layer_fields))
+            if isinstance(layers, str):
+                layers = [layer for layer in layers.split(",") if layer]
+            unknown = [layer for layer in layers if layer not in layer_fields]
+            if unknown:
+                return 400, {"error": f"unknown layers {unknown}, choose from {list(layer_fields)}"}
+            record = await self.analysis.get(py_board.board_fen())
+            response = {"fen": fen}
+            for layer in layers:
+                for field in layer_fields[layer]:
+                    response[field] = record[field]
+            return 200, response
+
+        if self.engine_queue is None:
+            return 503, {"error": "the service was started without an engine"}
+        if not py_board.is_valid():
+            return 400, {"error": "the engine can not search an illegal position"}
+        try:
+            depth = int(query.get("depth", self.engine_depth))
+        except ValueError:
+            return 400, {"error": "depth must be a number"}
+        try:
+            return 200, await self.evaluations.get((normalize_fen(fen), depth))
+        except EngineError as error:
+            return 503, {"error": str(error)}
+
+    # serves HTTP/1.1 requests on one connection until the client closes it
+    async def handle_connection(self, reader, writer):
+        self.stats.count("connections")
+        self.connections.add(asyncio.current_task())
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                start = time.perf_counter()
+                try:
+                    status, payload = await self.dispatch(method, target, body)
+                except Exception as error:
+                    # a position the analysis can not handle, e.g. pawns on the last rank
+                    status, payload = 400, {"error": repr(error)}
+                route = urlsplit(target).path.strip("/") or "root"
+                self.stats.count(f"requests.{route}")
+                self.stats.record(f"request.{route}", (time.perf_counter() - start) * 1000)
+
+                data = json.dumps(payload).encode()
+                keep_alive = (version != "HTTP/1.0" and headers.get("connection", "").lower() != "close")
+                writer.write((f"HTTP/1.1 {status} {reasons[status]}\r\n"
+                              "Content-Type: application/json\r\n"
+                              "Access-Control-Allow-Origin: *\r\n"
+                              f"Content-Length: {len(data)}\r\n"
+                              f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode() + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass  # the client went away or sent something that is not HTTP
+        except asyncio.CancelledError:
+            pass  # the service is shutting down
+        finally:
+            self.connections.discard(asyncio.current_task())
+            writer.close()
+
+
+# positions for the load test, reached by random legal moves from the start
+def random_positions(count, seed=1, max_plies=40):
+    rng = random.Random(seed)
+    fens = []
+    for index in range(count):
+        py_board = chess.Board()
+        for ply in range(rng.randrange(max_plies)):
+            moves = list(py_board.legal_moves)
+            if not moves:
+                break
+            py_board.push(rng.choice(moves))
+        fens.append(py_board.fen())
+    return fens
+
+# clients on keep-alive connections requesting positions at random from fens, so the
+# same position is often asked for by several clients at once. Returns throughput and
+# the client side latency percentiles in milliseconds
+async def load_test(host, port, fens, clients=16, requests_per_client=200, path="/analysis", seed=2):
+    latencies = []
+    errors = [0]
+
+    async def client(number):
+        rng = random.Random(seed + number)
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for index in range(requests_per_client):
+                fen = rng.choice(fens).replace(" ", "%20").replace("/", "%2F")
+                start = time.perf_counter()
+                writer.write(f"GET {path}?fen={fen} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+                await writer.drain()
+                status = (await reader.readline()).split()[1]
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":")[1])
+                await reader.readexactly(length)
+                latencies.append((time.perf_counter() - start) * 1000)
+                if status != b"200":
+                    errors[0] += 1
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(number) for number in range(clients)))
+    elapsed = time.perf_counter() - start
+    percentiles = statistics.quantiles(latencies, n=100)
+    return {"requests": len(latencies), "errors": errors[0], "seconds": elapsed,
+            "requests_per_s": len(latencies) / elapsed, "p50_ms": percentiles[49],
+            "p99_ms": percentiles[98], "max_ms": max(latencies)}
+
+# starts a service on a free local port, runs the load test against it and returns the
+# client results with the service's own stats
+async def run_load_test(service, positions=200, clients=16, requests_per_client=200):
+    port = await service.start("127.0.0.1", 0)
+    try:
+        fens = random_positions(positions)
+        report = await load_test("127.0.0.1", port, fens, clients, requests_per_client)
+        status, stats = await service.dispatch("GET", "/stats", b"")
+        report["service"] = stats
+        return report
+    finally:
+        await service.close()
+
+async def serve(service, host, port):
+    port = await service.start(host, port)
+    print(f"analysis service on http://{host}:{port}", file=sys.stderr)
+    try:
+        await service.server.serve_forever()
+    finally:
+        await service.close()
+
+
+if __name__ == "__main__":
+    import argparse as ag
+    parser = ag.ArgumentParser()
+    # command line program controls
+    parser.add_argument("--host", dest="host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", dest="port", type=int, default=8765)
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=None,
+                        help="analysis worker processes, defaults to the CPU count")
+    parser.add_argument("-c", "--cache", dest="cache_entries", type=int, default=4096,
+                        help="positions kept in the shared result caches")
+    parser.add_argument("-e", "--engine", dest="engine_path", default=None,
+                        help="UCI engine for /evaluate, which is disabled without one")
+    parser.add_argument("--engines", dest="engine_processes", type=int, default=1,
+                        help="engine processes serving the search queue")
+    parser.add_argument("-d", "--depth", dest="depth", type=int, default=12,
+                        help="default search depth of /evaluate")
+    parser.add_argument("--store", dest="store_path", default=None,
+                        help="SQLite evaluation store shared with the board and engine_pool")
+    parser.add_argument("--load-test", dest="load_test", action="store_true",
+                        help="run a local load test against a fresh service and print the results")
+    parser.add_argument("--clients", dest="clients", type=int, default=16)
+    parser.add_argument("--requests", dest="requests", type=int, default=200,
+                        help="requests per load test client")
+    parser.add_argument("--positions", dest="positions", type=int, default=200,
+                        help="distinct positions the load test asks for")
+
+    args = parser.parse_args()
+    analysis_service = AnalysisService(args.workers, args.cache_entries, args.engine_path,
+                                       args.engine_processes, args.depth, store_path=args.store_path)
+    if args.load_test:
+        print(json.dumps(asyncio.run(run_load_test(analysis_service, args.positions, args.clients,
+                                                   args.requests)), indent=1))
+    else:
+        try:
+            asyncio.run(serve(analysis_service, args.host, args.port))
+        except KeyboardInterrupt:
+            pass
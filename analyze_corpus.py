@@ -0,0 +1,275 @@
+import io
+import sys
+import json
+import time
+import multiprocessing as mp
+from collections import deque
+import chess
+import chess.pgn
+from piece_methods import Position, PositionAnalysis
+from opening_index import OpeningIndex
+
+# headless batch analysis of FEN/EPD lists and PGN files. Input is streamed and cut into
+# chunks that a process pool analyses, at most max_in_flight chunks are queued at a time
+# so memory stays bounded however large the input is, and results are written in input order
+
+# the fields a FEN falls back to when a line stops short, as Position.from_fen does
+default_fen_fields = ["w", "-", "-", "0", "1"]
+
+# reads a FEN or EPD file line by line. EPD lines carry only the first four FEN fields
+# followed by operations, the clocks are filled in so every item is a full FEN. Lines with
+# fewer fields, e.g. a bare placement, get the defaults of the missing ones. Only blank
+# lines are skipped, a malformed line is yielded and reported where it is analysed
+def read_fens(handle):
+    for line_number, fen in read_numbered_fens(handle):
+        yield fen
+
+# the same as (line number, FEN) pairs, lines counting from 1
+def read_numbered_fens(handle):
+    for line_number, line in enumerate(handle, 1):
+        fields = line.split()
+        if not fields:
+            continue
+        if len(fields) < 4:
+            fields = fields + default_fen_fields[len(fields) - 1:]
+        elif len(fields) < 6 or not (fields[4].isdigit() and fields[5].isdigit()):
+            fields = fields[:4] + ["0", "1"]
+        yield line_number, " ".join(fields[:6])
+
+# splits a PGN file into the text of each game without parsing the moves, so the main
+# process only scans lines and the workers do the expensive parsing
+def read_pgn_games(handle):
+    game_lines = []
+    in_movetext = False
+    for line in handle:
+        if line.startswith("[") and in_movetext:
+            yield "".join(game_lines)
+            game_lines = []
+            in_movetext = False
+        elif line.strip() and not line.startswith("["):
+            in_movetext = True
+        game_lines.append(line)
+    if in_movetext:
+        yield "".join(game_lines)
+
+# the positions of every ply of a game, starting position included
+def game_fens(game_text):
+    game = chess.pgn.read_game(io.StringIO(game_text))
+    if game is None:
+        return []
+    py_board = game.board()
+    fens = [py_board.fen()]
+    for move in game.mainline_moves():
+        py_board.push(move)
+        fens.append(py_board.fen())
+    return fens
+
+# whether the placement field of a FEN describes eight ranks of eight squares, the batch
+# layers parse nothing else and would silently misplace pieces otherwise
+def valid_placement(fen):
+    ranks = fen.split(" ")[0].split("/")
+    if len(ranks) != 8:
+        return False
+    for rank in ranks:
+        squares = 0
+        for symbol in rank:
+            if symbol in "12345678":
+                squares += int(symbol)
+            elif symbol in "KQRBNPkqrbnp":
+                squares += 1
+            else:
+                return False
+        if squares != 8:
+            return False
+    return True
+
+def chunked(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+opening_index = None  # a worker's mapping of the opening index, if one was given
+
+# runs once in each worker process, every worker maps the same index file and the pages
+# are shared between them
+def init_worker(index_path=None):
+    global opening_index
+    if index_path is not None:
+        opening_index = OpeningIndex(index_path)
+
+# the record of a position held by the opening index, None if it is not indexed or has no
+# enemy king for one of the sides
+def indexed_position(fen, position):
+    key = position.placement_key
+    if not opening_index.has_layers(key):
+        return None
+    record = {"fen": fen}
+    for side, name in ((True, "white"), (False, "black")):
+        king_attackers = opening_index.layer(key, "king_attackers", side)
+        if king_attackers is None:
+            return None
+        record[f"attack_{name}"] = opening_index.layer(key, "attack", side)
+        record[f"king_attackers_{name}"] = sorted(king_attackers)
+        record[f"restricted_{name}"] = sorted(opening_index.layer(key, "restricted", side))
+    record["struggle"] = opening_index.layer(key, "struggle")
+    return record
+
+# every piece_methods layer for one position, sets are written as sorted lists
+def analyze_position(fen):
+    record = {"fen": fen}
+    try:
+        position = Position.from_fen(fen)
+        if opening_index is not None:
+            indexed = indexed_position(fen, position)
+            if indexed is not None:
+                return indexed
+        analysis = PositionAnalysis(position)
+        for side, name in ((True, "white"), (False, "black")):
+            record[f"attack_{name}"] = analysis.attack_color_coding(side)
+            record[f"king_attackers_{name}"] = sorted(analysis.king_attackers(side))
+            record[f"restricted_{name}"] = sorted(analysis.restricted_pieces(side))
+        record["struggle"] = analysis.board_struggle()
+    except Exception as error:
+        # e.g. a malformed line or a position without a king, keep going and report it in place
+        record = {"fen": fen, "error": repr(error)}
+    return record
+
+# runs in a worker process. Returns (number of positions, json lines) for jsonl output,
+# or (number of positions, fens, arrays) for npz output
+def analyze_chunk(kind, items, output_format):
+    if kind == "pgn":
+        fens = [fen for game_text in items for fen in game_fens(game_text)]
+    else:
+        fens = items
+
+    if output_format == "npz":
+        from batch_analysis import analyze_batch
+        # arrays have no room for an error record, malformed lines are reported and dropped
+        for fen in fens:
+            if not valid_placement(fen):
+                print(f"skipped malformed FEN: {fen}", file=sys.stderr)
+        fens = [fen for fen in fens if valid_placement(fen)]
+        return len(fens), fens, analyze_batch(fens)
+    lines = [json.dumps(analyze_position(fen)) for fen in fens]
+    return len(fens), lines
+
+
+class NpzShardWriter:
+    def __init__(self, prefix, shard_size):
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.shard_number = 0
+        self.fens = []
+        self.arrays = {}
+        self.buffered = 0
+
+    def write(self, fens, arrays):
+        self.fens.extend(fens)
+        for name, array in arrays.items():
+            self.arrays.setdefault(name, []).append(array)
+        self.buffered += len(fens)
+        if self.buffered >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffered == 0:
+            return
+        import numpy as np
+        arrays = {name: np.concatenate(parts) for name, parts in self.arrays.items()}
+        np.savez_compressed(f"{self.prefix}-{self.shard_number:05d}.npz",
+                            fens=np.array(self.fens), **arrays)
+        self.shard_number += 1
+        self.fens = []
+        self.arrays = {}
+        self.buffered = 0
+
+
+def analyze_corpus(input_path, output_path, output_format="jsonl", workers=None,
+                   chunk_size=256, max_in_flight=None, shard_size=100000, report_every=5.0,
+                   index_path=None):
+    kind = "pgn" if input_path.lower().endswith(".pgn") else "fen"
+    if kind == "pgn":
+        chunk_size = max(1, chunk_size // 64)  # a game holds dozens of positions
+
+    workers = workers or mp.cpu_count()
+    max_in_flight = max_in_flight or 2 * workers
+
+    if output_format == "npz":
+        writer = NpzShardWriter(output_path, shard_size)
+        out_handle = None
+    elif output_path == "-":
+        out_handle = sys.stdout
+    else:
+        out_handle = open(output_path, "w")
+
+    start = time.perf_counter()
+    last_report = start
+    positions = 0
+
+    def write_result(result):
+        if output_format == "npz":
+            writer.write(result[1], result[2])
+        else:
+            for line in result[1]:
+                out_handle.write(line + "\n")
+        return result[0]
+
+    with open(input_path, "r", errors="replace") as in_handle, \
+            mp.Pool(workers, initializer=init_worker, initargs=(index_path,)) as pool:
+        items = read_pgn_games(in_handle) if kind == "pgn" else read_fens(in_handle)
+        pending = deque()
+        for chunk in chunked(items, chunk_size):
+            pending.append(pool.apply_async(analyze_chunk, (kind, chunk, output_format)))
+            # block on the oldest chunk once enough are queued, this keeps the output in
+            # input order and stops the reader from running ahead of the workers
+            while len(pending) >= max_in_flight:
+                positions += write_result(pending.popleft().get())
+            now = time.perf_counter()
+            if now - last_report >= report_every:
+                print(f"{positions} positions, {positions / (now - start):.0f} positions/s",
+                      file=sys.stderr)
+                last_report = now
+        while pending:
+            positions += write_result(pending.popleft().get())
+
+    if output_format == "npz":
+        writer.flush()
+    elif out_handle is not sys.stdout:
+        out_handle.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"done: {positions} positions in {elapsed:.1f}s, "
+          f"{positions / elapsed if elapsed else 0:.0f} positions/s", file=sys.stderr)
+    return positions
+
+
+if __name__ == "__main__":
+    import argparse as ag
+    parser = ag.ArgumentParser()
+    # command line program controls
+    parser.add_argument("input", help="FEN/EPD list (one position per line) or PGN file")
+    parser.add_argument("output", help="output file for jsonl ('-' for stdout), "
+                                       "shard name prefix for npz")
+    parser.add_argument("-f", "--format", dest="output_format", default="jsonl",
+                        choices=["jsonl", "npz"], help="output format")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=None,
+                        help="worker processes, defaults to the CPU count")
+    parser.add_argument("-c", "--chunk-size", dest="chunk_size", type=int, default=256,
+                        help="positions per chunk sent to a worker")
+    parser.add_argument("--max-in-flight", dest="max_in_flight", type=int, default=None,
+                        help="chunks queued at once, defaults to twice the workers")
+    parser.add_argument("--shard-size", dest="shard_size", type=int, default=100000,
+                        help="positions per npz shard")
+    parser.add_argument("-x", "--index", dest="index_path", default=None,
+                        help="opening index whose layers are used for the positions it holds "
+                             "(jsonl output)")
+
+    args = parser.parse_args()
+    analyze_corpus(args.input, args.output, args.output_format, args.workers,
+                   args.chunk_size, args.max_in_flight, args.shard_size, index_path=args.index_path)
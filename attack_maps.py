@@ -0,0 +1,171 @@
+from piece_methods import attack_weights, pawn_attacked_squares, PositionAnalysis
+
+# attack weights (get_attack_color_coding) and contested values (board_struggle) kept up
+# to date as moves are made, instead of being rebuilt from every piece after each move.
+# Every piece's attacked squares are stored along with the squares it can see (its own
+# pieces included), and a reverse map records which pieces see each square. When the
+# occupant of a square changes only the pieces on the changed squares and the pieces
+# seeing them are recomputed, so a move costs the same however full the board is.
+# Squares are slots x + 8*y of the position, the maps use the same "xy" string keys as
+# the rest of the analysis code
+
+knight_steps = ((1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2))
+king_steps = ((1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1))
+rook_directions = ((1, 0), (-1, 0), (0, 1), (0, -1))
+bishop_directions = ((1, 1), (1, -1), (-1, 1), (-1, -1))
+slider_directions = {"rook": rook_directions, "bishop": bishop_directions,
+                     "queen": rook_directions + bishop_directions}
+
+
+# the order in which attackers are summed by a full recompute: non-pawn pieces in
+# python-chess move generation order (highest square first), then pawns as the position
+# iterates them. Summing in the same order keeps the floats identical
+def summation_order(slot, piece_type):
+    py_square = slot % 8 + (7 - slot // 8)*8
+    if piece_type == "pawn":
+        return (1, py_square)
+    return (0, -py_square)
+
+
+class AttackMaps:
+    def __init__(self, position, verify=False):
+        self.position = position
+        self.verify = verify  # compare with a full recompute after every update
+        self.rebuild()
+
+    # computes everything from scratch, e.g. after the position was replaced
+    def rebuild(self):
+        self.reach = {}  # slot -> slots the piece there sees, blockers included
+        self.attacks = {}  # slot -> "xy" keys the piece there adds weight to
+        self.seen_by = [set() for slot in range(64)]
+        self.attackers = {True: {}, False: {}}  # side -> "xy" key -> attacking slots
+        self.weights = {True: {}, False: {}}  # side -> "xy" key -> attack weight
+        self.struggle = {}  # "xy" key -> white weight minus black weight
+        self._update(range(64))
+
+    def attack_color_coding(self, side_to_play):
+        return self.weights[side_to_play]
+
+    def board_struggle(self):
+        return self.struggle
+
+    # applies a move to the position (see Position.apply_move) and updates the maps
+    def apply_move(self, x, y, new_x, new_y, prom_type="empty"):
+        undo = self.position.apply_move(x, y, new_x, new_y, prom_type)
+        self._update(self._move_slots(undo))
+        return undo
+
+    def unapply_move(self, undo):
+        self.position.unapply_move(undo)
+        self._update(self._move_slots(undo))
+
+    # updates the maps after pieces were put on or taken off the given (x, y) squares
+    # by other means, e.g. a piece dropped with Position.add_piece
+    def squares_changed(self, squares):
+        self._update([x + 8*y for x, y in squares])
+
+    @staticmethod
+    def _move_slots(undo):
+        piece, x, y, new_x, new_y, captured, ep_capture, rook_move, promoted, saved_state = undo
+        slots = [x + 8*y, new_x + 8*new_y]
+        if ep_capture is not None:
+            slots.append(ep_capture.x + 8*ep_capture.y)
+        if rook_move is not None:
+            slots += [rook_move[1] + 8*y, rook_move[2] + 8*y]
+        return slots
+
+    def _update(self, changed_slots):
+        affected = set()
+        for slot in changed_slots:
+            affected.add(slot)
+            affected |= self.seen_by[slot]
+
+        dirty = set()
+        for slot in affected:
+            self._remove(slot, dirty)
+        for slot in affected:
+            if self.position.squares[slot] is not None:
+                self._add(slot, dirty)
+        for side, key in dirty:
+            self._reweigh(side, key)
+
+        if self.verify:
+            self.check()
+
+    def _remove(self, slot, dirty):
+        for seen in self.reach.pop(slot, ()):
+            self.seen_by[seen].discard(slot)
+        if slot in self.attacks:
+            side, keys = self.attacks.pop(slot)
+            for key in keys:
+                self.attackers[side][key].discard(slot)
+                dirty.add((side, key))
+
+    def _add(self, slot, dirty):
+        squares = self.position.squares
+        piece = squares[slot]
+        side = piece.color == "white"
+        x = slot % 8
+        y = slot // 8
+
+        if piece.type == "pawn":
+            # pawns attack their diagonals whatever stands there, so they see nothing
+            reach = ()
+            keys = pawn_attacked_squares(x, y, side)
+        else:
+            reach = []
+            if piece.type in slider_directions:
+                for dx, dy in slider_directions[piece.type]:
+                    new_x = x + dx
+                    new_y = y + dy
+                    while 0 <= new_x < 8 and 0 <= new_y < 8:
+                        reach.append(new_x + 8*new_y)
+                        if squares[new_x + 8*new_y] is not None:
+                            break
+                        new_x += dx
+                        new_y += dy
+            else:
+                for dx, dy in (knight_steps if piece.type == "knight" else king_steps):
+                    if 0 <= x + dx < 8 and 0 <= y + dy < 8:
+                        reach.append(x + dx + 8*(y + dy))
+            # squares holding our own pieces are seen but not attacked
+            keys = [f"{seen % 8}{seen // 8}" for seen in reach
+                    if squares[seen] is None or squares[seen].color != piece.color]
+
+        self.reach[slot] = reach
+        for seen in reach:
+            self.seen_by[seen].add(slot)
+        self.attacks[slot] = (side, keys)
+        attackers = self.attackers[side]
+        for key in keys:
+            attackers.setdefault(key, set()).add(slot)
+            dirty.add((side, key))
+
+    def _reweigh(self, side, key):
+        squares = self.position.squares
+        attackers = sorted((summation_order(slot, squares[slot].type), squares[slot].type)
+                           for slot in self.attackers[side].get(key, ()))
+        weights = self.weights[side]
+        if attackers:
+            weight = 0
+            for order, piece_type in attackers:
+                weight = weight + attack_weights[piece_type]
+            weights[key] = weight
+        else:
+            weights.pop(key, None)
+            self.attackers[side].pop(key, None)
+
+        if key in self.weights[True] or key in self.weights[False]:
+            self.struggle[key] = self.weights[True].get(key, 0.0) - self.weights[False].get(key, 0.0)
+        else:
+            self.struggle.pop(key, None)
+
+    # raises if the maps differ from a full recompute of the position
+    def check(self):
+        analysis = PositionAnalysis(self.position)
+        white = PositionAnalysis.attack_color_coding.__wrapped__(analysis, True)
+        black = PositionAnalysis.attack_color_coding.__wrapped__(analysis, False)
+        struggle = {square: white.get(square, 0.0) - black.get(square, 0.0)
+                    for square in set(white) | set(black)}
+        if self.weights[True] != white or self.weights[False] != black or self.struggle != struggle:
+            raise Exception("Incremental attack maps differ from a full recompute")
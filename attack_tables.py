@@ -0,0 +1,293 @@
+# attack generation over 64-bit bitboards from precomputed tables, for the analysis
+# functions in piece_methods. Squares follow python-chess numbering (a1 = 0, h8 = 63,
+# square = file + 8*rank) and color is a Boolean, True for white.
+# Knight, king and pawn attacks are single table lookups. Sliding attacks are looked up
+# per line (rank, file, diagonal and anti-diagonal) by the occupancy of that line, every
+# possible occupancy being tabulated when the module loads. Results are plain ints used as
+# bitboards, nothing on the hot path creates strings or move objects
+
+full_board = (1 << 64) - 1
+rank_3 = 0xFF << 16
+rank_4 = 0xFF << 24
+rank_5 = 0xFF << 32
+rank_6 = 0xFF << 40
+
+def square_bit(file, rank):
+    return 1 << (file + 8*rank)
+
+def step_mask(square, steps):
+    file = square % 8
+    rank = square // 8
+    mask = 0
+    for d_file, d_rank in steps:
+        if 0 <= file + d_file < 8 and 0 <= rank + d_rank < 8:
+            mask |= square_bit(file + d_file, rank + d_rank)
+    return mask
+
+knight_steps = ((1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2))
+king_steps = ((1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1))
+
+knight_attacks = [step_mask(square, knight_steps) for square in range(64)]
+king_attacks = [step_mask(square, king_steps) for square in range(64)]
+# pawn_attacks[color][square]
+pawn_attacks = [[step_mask(square, ((-1, -1), (1, -1))) for square in range(64)],
+                [step_mask(square, ((-1, 1), (1, 1))) for square in range(64)]]
+
+# the two directions of each line a slider moves along
+line_directions = {"rank": ((1, 0), (-1, 0)), "file": ((0, 1), (0, -1)),
+                   "diagonal": ((1, 1), (-1, -1)), "anti_diagonal": ((1, -1), (-1, 1))}
+
+# squares reached from a square along the given directions, stopping at occupied squares
+def ray_fill(square, directions, occupied):
+    attacks = 0
+    for d_file, d_rank in directions:
+        file = square % 8 + d_file
+        rank = square // 8 + d_rank
+        while 0 <= file < 8 and 0 <= rank < 8:
+            bit = square_bit(file, rank)
+            attacks |= bit
+            if occupied & bit:
+                break
+            file += d_file
+            rank += d_rank
+    return attacks
+
+# line_masks[line][square] holds the squares whose occupancy matters to a slider on the
+# square (the line without its end squares), line_attacks[line][square] maps every
+# occupancy of that mask to the attacked squares
+line_masks = {}
+line_attacks = {}
+for line, directions in line_directions.items():
+    line_masks[line] = []
+    line_attacks[line] = []
+    for square in range(64):
+        # the last square of each ray is attacked whether it is occupied or not
+        inner = 0
+        for d_file, d_rank in directions:
+            ray = ray_fill(square, ((d_file, d_rank),), 0)
+            if ray:
+                last = 1 << (ray.bit_length() - 1) if d_file + 8*d_rank > 0 else ray & -ray
+                inner |= ray & ~last
+        table = {}
+        subset = 0
+        while True:  # every subset of the inner squares, by the carry-rippler trick
+            table[subset] = ray_fill(square, directions, subset)
+            subset = (subset - inner) & inner
+            if subset == 0:
+                break
+        line_masks[line].append(inner)
+        line_attacks[line].append(table)
+
+rank_masks, rank_tables = line_masks["rank"], line_attacks["rank"]
+file_masks, file_tables = line_masks["file"], line_attacks["file"]
+diagonal_masks, diagonal_tables = line_masks["diagonal"], line_attacks["diagonal"]
+anti_masks, anti_tables = line_masks["anti_diagonal"], line_attacks["anti_diagonal"]
+
+def rook_attacks(square, occupied):
+    return (rank_tables[square][rank_masks[square] & occupied] |
+            file_tables[square][file_masks[square] & occupied])
+
+def bishop_attacks(square, occupied):
+    return (diagonal_tables[square][diagonal_masks[square] & occupied] |
+            anti_tables[square][anti_masks[square] & occupied])
+
+# squares strictly between two squares on a common line, 0 if they share none
+between = [[0] * 64 for square in range(64)]
+for square in range(64):
+    for directions in line_directions.values():
+        for direction in directions:
+            ray = ray_fill(square, (direction,), 0)
+            target_bits = ray
+            while target_bits:
+                target_bit = target_bits & -target_bits
+                target_bits ^= target_bit
+                # the part of the ray short of the target, rays run up or down the numbering
+                if target_bit > 1 << square:
+                    between[square][target_bit.bit_length() - 1] = ray & (target_bit - 1)
+                else:
+                    between[square][target_bit.bit_length() - 1] = ray & ~((target_bit << 1) - 1)
+
+# the whole line through two squares, 0 if they share none
+line_through = [[0] * 64 for square in range(64)]
+for square in range(64):
+    for directions in line_directions.values():
+        line = ray_fill(square, directions, 0)
+        target_bits = line
+        while target_bits:
+            target_bit = target_bits & -target_bits
+            target_bits ^= target_bit
+            line_through[square][target_bit.bit_length() - 1] = line | (1 << square)
+
+piece_codes = {"pawn": 0, "knight": 1, "bishop": 2, "rook": 3, "queen": 4, "king": 5}
+
+# square numbers of the set bits, highest first (python-chess generation order)
+def squares_descending(bitboard):
+    while bitboard:
+        square = bitboard.bit_length() - 1
+        yield square
+        bitboard ^= 1 << square
+
+
+# the pieces of a position as bitboards. pieces is a Position or a list of pieces in
+# display coordinates
+class Bitboards:
+    def __init__(self, pieces):
+        self.types = [None] * 64  # piece type name by square
+        self.by_type = {piece_type: 0 for piece_type in piece_codes}
+        self.by_color = {True: 0, False: 0}
+        for piece in pieces:
+            square = piece.x + (7 - piece.y)*8
+            bit = 1 << square
+            self.types[square] = piece.type
+            self.by_type[piece.type] |= bit
+            self.by_color[piece.color == "white"] |= bit
+        self.occupied = self.by_color[True] | self.by_color[False]
+
+    # squares attacked by the piece on a square, own pieces included
+    def attacks_from(self, square, occupied=None):
+        if occupied is None:
+            occupied = self.occupied
+        piece_type = self.types[square]
+        if piece_type == "knight":
+            return knight_attacks[square]
+        if piece_type == "king":
+            return king_attacks[square]
+        if piece_type == "bishop":
+            return bishop_attacks(square, occupied)
+        if piece_type == "rook":
+            return rook_attacks(square, occupied)
+        if piece_type == "queen":
+            return rook_attacks(square, occupied) | bishop_attacks(square, occupied)
+        if piece_type == "pawn":
+            return pawn_attacks[bool(self.by_color[True] >> square & 1)][square]
+        return 0
+
+    # pieces of a color attacking a square
+    def attackers(self, color, square, occupied=None):
+        if occupied is None:
+            occupied = self.occupied
+        by_type = self.by_type
+        queens = by_type["queen"]
+        attackers = ((knight_attacks[square] & by_type["knight"]) |
+                     (king_attacks[square] & by_type["king"]) |
+                     (rook_attacks(square, occupied) & (by_type["rook"] | queens)) |
+                     (bishop_attacks(square, occupied) & (by_type["bishop"] | queens)) |
+                     (pawn_attacks[not color][square] & by_type["pawn"]))
+        return attackers & self.by_color[color] & occupied
+
+    # (origin, piece type, destinations) of every non-pawn piece of a side, highest
+    # origin first, with squares holding the side's own pieces removed. This is the
+    # order python-chess generates pseudo-legal moves in
+    def piece_moves(self, color):
+        own = self.by_color[color]
+        types = self.types
+        return [(square, types[square], self.attacks_from(square) & ~own)
+                for square in squares_descending(own & ~self.by_type["pawn"])]
+
+    # {origin: destinations} of every pawn push of a side
+    def pawn_pushes(self, color):
+        empty = ~self.occupied & full_board
+        pawns = self.by_type["pawn"] & self.by_color[color]
+        pushes = {}
+        if color:
+            single = pawns << 8 & empty
+            double = single << 8 & empty & (rank_3 | rank_4)
+            for square in squares_descending(single):
+                pushes[square - 8] = 1 << square
+            for square in squares_descending(double):
+                pushes[square - 16] = pushes.get(square - 16, 0) | 1 << square
+        else:
+            single = pawns >> 8 & empty
+            double = single >> 8 & empty & (rank_6 | rank_5)
+            for square in squares_descending(single):
+                pushes[square + 8] = 1 << square
+            for square in squares_descending(double):
+                pushes[square + 16] = pushes.get(square + 16, 0) | 1 << square
+        return pushes
+
+    # destinations of every pseudo-legal move from a square, promotions counted once
+    def pseudo_destinations(self, square, color):
+        if self.types[square] == "pawn":
+            captures = pawn_attacks[color][square] & self.by_color[not color]
+            return captures | self.pawn_pushes(color).get(square, 0)
+        return self.attacks_from(square) & ~self.by_color[color]
+
+    # squares attacked by every piece of a color, pawns by their diagonals
+    def attacked_by(self, color):
+        attacked = 0
+        for square in squares_descending(self.by_color[color]):
+            attacked |= self.attacks_from(square)
+        return attacked
+
+    # own pieces standing alone between the king and an enemy slider, i.e. pinned
+    def pinned(self, color, king):
+        enemy = self.by_color[not color]
+        by_type = self.by_type
+        snipers = ((rank_tables[king][0] | file_tables[king][0]) &
+                   (by_type["rook"] | by_type["queen"]) |
+                   (diagonal_tables[king][0] | anti_tables[king][0]) &
+                   (by_type["bishop"] | by_type["queen"])) & enemy
+        pinned = 0
+        for sniper in squares_descending(snipers):
+            blockers = between[king][sniper] & self.occupied
+            if blockers and blockers & (blockers - 1) == 0:
+                pinned |= blockers
+        return pinned & self.by_color[color]
+
+    # destinations of the legal moves from a square for the piece's side, promotions
+    # counted once. The king is the highest-numbered one if a side has several (as in
+    # python-chess), a side without a king has every pseudo-legal move
+    def legal_destinations(self, square, color):
+        if not self.by_color[color] >> square & 1:
+            return 0
+        return self._legal(square, color, self.pseudo_destinations(square, color),
+                           *self._king_safety(color))
+
+    # {origin: (reach, legal destinations)} for every piece of a side. reach is what the
+    # piece attacks or moves to, own pieces excluded, and for a pawn its diagonals and
+    # pushes whatever stands there. The king's checkers and pins are found once for all
+    def move_table(self, color):
+        own = self.by_color[color]
+        enemy = self.by_color[not color]
+        pushes = self.pawn_pushes(color)
+        king_safety = self._king_safety(color)
+        table = {}
+        for square in squares_descending(own):
+            if self.types[square] == "pawn":
+                push = pushes.get(square, 0)
+                reach = pawn_attacks[color][square] | push
+                destinations = pawn_attacks[color][square] & enemy | push
+            else:
+                reach = destinations = self.attacks_from(square) & ~own
+            table[square] = (reach, self._legal(square, color, destinations, *king_safety))
+        return table
+
+    # (king square, pieces giving check, pinned pieces) of a side, the king None if it has none
+    def _king_safety(self, color):
+        kings = self.by_type["king"] & self.by_color[color]
+        if not kings:
+            return None, 0, 0
+        king = kings.bit_length() - 1
+        return king, self.attackers(not color, king), self.pinned(color, king)
+
+    # the pseudo-legal destinations of a piece that do not leave its king in check
+    def _legal(self, square, color, destinations, king, checkers, pinned):
+        if king is None:
+            return destinations
+
+        if square == king:
+            # squares the enemy attacks once the king has stepped off its square
+            without_king = self.occupied & ~(1 << king)
+            safe = 0
+            for destination in squares_descending(destinations):
+                if not self.attackers(not color, destination, without_king):
+                    safe |= 1 << destination
+            return safe
+
+        if checkers:
+            if self.types[square] == "king" or checkers & (checkers - 1):
+                return 0  # double check, or another of several kings
+            destinations &= between[king][checkers.bit_length() - 1] | checkers
+        if pinned >> square & 1:
+            destinations &= line_through[square][king]
+        return destinations
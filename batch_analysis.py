@@ -0,0 +1,193 @@
+import numpy as np
+from piece_methods import attack_weights
+
+# batch versions of the piece_methods heuristics for many positions at once. Positions are
+# held as numpy arrays of 64-bit bitboards (bit = file + 8*rank, a1 is bit 0) and every
+# step is a whole-array operation over the batch, so the cost per position is a handful of
+# vector instructions rather than a python loop over moves.
+# all maps come back as (N, 8, 8) arrays indexed [position, x, y] in display coordinates,
+# the same layout get_attack_array and get_defended_pieces use
+
+piece_order = ["pawn", "knight", "bishop", "rook", "queen", "king"]
+fen_piece_index = {"P": (0, 0), "N": (0, 1), "B": (0, 2), "R": (0, 3), "Q": (0, 4), "K": (0, 5),
+                   "p": (1, 0), "n": (1, 1), "b": (1, 2), "r": (1, 3), "q": (1, 4), "k": (1, 5)}
+
+# same values get_defended_pieces and restricted_pieces use
+defense_values = {"king": 1, "queen": 1, "rook": 5, "bishop": 7, "knight": 7, "pawn": 10}
+restriction_dict = {"queen": 9, "rook": 5, "bishop": 3, "knight": 2}
+
+full_board = np.uint64(0xFFFFFFFFFFFFFFFF)
+not_a_file = np.uint64(0xFEFEFEFEFEFEFEFE)
+not_h_file = np.uint64(0x7F7F7F7F7F7F7F7F)
+not_ab_file = np.uint64(0xFCFCFCFCFCFCFCFC)
+not_gh_file = np.uint64(0x3F3F3F3F3F3F3F3F)
+no_mask = full_board
+
+# one step in a direction as (shift, mask applied after shifting to stop wrapping around files)
+rook_directions = [(8, no_mask), (-8, no_mask), (1, not_a_file), (-1, not_h_file)]
+bishop_directions = [(9, not_a_file), (7, not_h_file), (-7, not_a_file), (-9, not_h_file)]
+king_directions = rook_directions + bishop_directions
+knight_directions = [(17, not_a_file), (15, not_h_file), (10, not_ab_file), (6, not_gh_file),
+                     (-17, not_h_file), (-15, not_a_file), (-10, not_gh_file), (-6, not_ab_file)]
+# pawn captures for white and black
+pawn_directions = [[(9, not_a_file), (7, not_h_file)], [(-7, not_a_file), (-9, not_h_file)]]
+slider_directions = {"bishop": bishop_directions, "rook": rook_directions, "queen": king_directions}
+jump_directions = {"knight": knight_directions, "king": king_directions}
+
+
+def shift(bitboards, direction):
+    amount, mask = direction
+    if amount > 0:
+        return (bitboards << np.uint64(amount)) & mask
+    return (bitboards >> np.uint64(-amount)) & mask
+
+# attacks of a set of sliders along one direction, stopping at (and including) the first
+# occupied square. Each target square is reached by at most one slider of the set
+def ray_attacks(sliders, empty, direction):
+    fill = sliders
+    for step in range(6):
+        fill = fill | (shift(fill, direction) & empty)
+    return shift(fill, direction)
+
+def popcount(bitboards):
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(bitboards).astype(np.int64)
+    return np.unpackbits(bitboards.astype("<u8").view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+# bitboards -> (N, 8, 8) arrays of 0/1 indexed [position, x, y]
+def bitboards_to_grid(bitboards):
+    bits = np.unpackbits(bitboards.astype("<u8").view(np.uint8).reshape(-1, 8),
+                         axis=1, bitorder="little")
+    ranks = bits.reshape(-1, 8, 8)  # [position, rank, file]
+    return ranks[:, ::-1, :].transpose(0, 2, 1)
+
+# parses the piece placement of each FEN into a (N, 2, 6) array of bitboards,
+# [position, color (white first), piece type in piece_order]
+def fens_to_bitboards(fens):
+    boards = np.zeros((len(fens), 2, 6), dtype=np.uint64)
+    for n, fen in enumerate(fens):
+        bitboards = [[0]*6, [0]*6]
+        rank = 7
+        file = 0
+        for symbol in fen.split(" ")[0]:
+            if symbol == "/":
+                rank -= 1
+                file = 0
+            elif symbol.isdigit():
+                file += int(symbol)
+            else:
+                color, piece_type = fen_piece_index[symbol]
+                bitboards[color][piece_type] |= 1 << (file + 8*rank)
+                file += 1
+        boards[n] = bitboards
+    return boards
+
+
+# everything the layers need for one side, as bitboards and per-type attack counts
+class SideAttacks:
+    def __init__(self, boards, color, occupied):
+        self.pieces = {name: boards[:, color, index] for index, name in enumerate(piece_order)}
+        self.own = np.bitwise_or.reduce(boards[:, color, :], axis=1)
+        self.occupied = occupied
+        empty = ~occupied
+
+        # per piece type, the attack bitboards from each direction
+        self.directional = {"pawn": [shift(self.pieces["pawn"], d) for d in pawn_directions[color]],
+                            "knight": [shift(self.pieces["knight"], d) for d in knight_directions],
+                            "king": [shift(self.pieces["king"], d) for d in king_directions]}
+        for name, directions in slider_directions.items():
+            self.directional[name] = [ray_attacks(self.pieces[name], empty, d) for d in directions]
+
+        # every square the side attacks, including squares holding its own pieces
+        self.attacked = np.zeros(len(occupied), dtype=np.uint64)
+        for attacks in self.directional.values():
+            for bitboards in attacks:
+                self.attacked |= bitboards
+
+    # matches get_attack_color_coding, pawns count every diagonal and other pieces
+    # only the squares they could move to. Non-pawn pieces are added one origin square at a
+    # time from h8 down to a1 and pawns last, the order python-chess generates moves in, so
+    # the floating point sums come out identical to the single-position functions
+    def attack_weights(self):
+        weights = np.zeros((len(self.own), 8, 8), dtype=np.float64)
+        not_own = ~self.own
+        empty = ~self.occupied
+        for square in range(63, -1, -1):
+            origin = np.uint64(1 << square)
+            for name in ("knight", "bishop", "rook", "queen", "king"):
+                here = self.pieces[name] & origin
+                if not here.any():
+                    continue
+                attacks = np.zeros_like(here)
+                if name in slider_directions:
+                    for d in slider_directions[name]:
+                        attacks |= ray_attacks(here, empty, d)
+                else:
+                    for d in jump_directions[name]:
+                        attacks |= shift(here, d)
+                weights += bitboards_to_grid(attacks & not_own) * attack_weights[name]
+        for bitboards in self.directional["pawn"]:
+            weights += bitboards_to_grid(bitboards) * attack_weights["pawn"]
+        return weights
+
+    # matches get_defended_pieces
+    def defense(self):
+        defense = np.zeros((len(self.own), 8, 8), dtype=np.int16)
+        for name in piece_order:
+            defended = self.pieces[name] & self.attacked
+            defense += bitboards_to_grid(defended).astype(np.int16) * defense_values[name]
+        return defense
+
+    # matches restricted_pieces: a piece is restricted when few of its moves land on squares
+    # the opponent neither attacks nor defends
+    def restricted(self, opponent):
+        safe = ~self.own & ~opponent.attacked
+        empty = ~self.occupied
+        restricted = np.zeros(len(self.own), dtype=np.uint64)
+        one = np.uint64(1)
+        for name, limit in restriction_dict.items():
+            remaining = self.pieces[name].copy()
+            # peel off one piece per position at a time, isolating the lowest set bit
+            while remaining.any():
+                piece = remaining & (~remaining + one)
+                moves = np.zeros_like(piece)
+                if name in slider_directions:
+                    for d in slider_directions[name]:
+                        moves |= ray_attacks(piece, empty, d)
+                else:
+                    for d in jump_directions[name]:
+                        moves |= shift(piece, d)
+                few_moves = popcount(moves & safe) <= limit
+                restricted |= np.where(few_moves, piece, np.uint64(0))
+                remaining &= ~piece
+        return bitboards_to_grid(restricted).astype(bool)
+
+
+batch_layers = ("attack_weights", "struggle", "defense", "restricted")
+
+# analyses a list of FENs in one pass. Returns a dict of arrays, each (N, 8, 8):
+# attack_weights_white/black (float32), struggle (float32), defense_white/black (int16)
+# and restricted_white/black (bool)
+def analyze_batch(fens, layers=batch_layers):
+    boards = fens_to_bitboards(fens)
+    occupied = np.bitwise_or.reduce(boards.reshape(len(fens), 12), axis=1)
+    white = SideAttacks(boards, 0, occupied)
+    black = SideAttacks(boards, 1, occupied)
+    results = {}
+
+    if "attack_weights" in layers or "struggle" in layers:
+        white_weights = white.attack_weights()
+        black_weights = black.attack_weights()
+        if "attack_weights" in layers:
+            results["attack_weights_white"] = white_weights.astype(np.float32)
+            results["attack_weights_black"] = black_weights.astype(np.float32)
+        if "struggle" in layers:
+            results["struggle"] = (white_weights - black_weights).astype(np.float32)
+    if "defense" in layers:
+        results["defense_white"] = white.defense()
+        results["defense_black"] = black.defense()
+    if "restricted" in layers:
+        results["restricted_white"] = white.restricted(black)
+        results["restricted_black"] = black.restricted(white)
+
+    return results
@@ -0,0 +1,209 @@
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+import statistics
+
+# rendering is timed without a window
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import chess
+import pygame
+import piece_methods
+from piece_methods import load_fen, get_abbrev_fen, analysis_cache
+from board import VisCache, BoardRenderer, draw_board_and_pieces, make_move
+from attack_maps import AttackMaps
+from uci_engine import UCIEngine
+
+# times the analysis, rendering and engine paths on a fixed set of positions and writes
+# the results as JSON. With a saved baseline, reports every benchmark that got slower.
+# Analysis functions are timed with the analysis cache disabled, so the numbers are the
+# cost of computing a layer rather than of looking it up
+
+corpus = {
+    "start": "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+    "italian": "r1bqk1nr/pppp1ppp/2n5/2b1p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4",
+    "najdorf": "rnbqkb1r/1p2pppp/p2p1n2/8/3NP3/2N5/PPP2PPP/R1BQKB1R w KQkq - 0 6",
+    "queens_gambit_middlegame": "r2q1rk1/pb1nbppp/1p2pn2/2pp4/2PP4/1PN1PN2/PB2BPPP/R2Q1RK1 w - - 0 10",
+    "open_middlegame": "r1b2rk1/pp1nqppp/2p1p3/3p4/2PPn3/2NBPN2/PPQ2PPP/R4RK1 w - - 0 12",
+    "tactical_middlegame": "r2qr1k1/1b1nbppp/p2p1n2/1p2p3/3PP3/1BN1BN1P/PP3PP1/R2QR1K1 w - - 0 14",
+    "rook_endgame": "8/5pk1/6p1/8/3R4/6P1/r4PK1/8 w - - 0 40",
+    "pawn_endgame": "8/8/4k3/3p1p2/3P1P2/4K3/8/8 w - - 0 50",
+    "queen_vs_king": "8/8/8/4k3/8/8/3Q4/4K3 w - - 0 60",
+    "promotion": "3r4/1P3kP1/8/8/8/8/5K2/8 w - - 0 70",
+    "en_passant": "rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3",
+    "crowded": "rnbqkbnr/pppppppp/1nbrq3/8/8/3QRBN1/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+}
+
+# measures fn and returns per-call times in microseconds. The loop count is chosen so one
+# repeat takes at least min_time seconds, the median over the repeats is the headline
+def time_call(fn, repeat=5, min_time=0.02):
+    timer = timeit.Timer(fn)
+    loops = 1
+    while timer.timeit(loops) < min_time:
+        loops *= 2
+    samples = [timer.timeit(loops) / loops * 1e6 for index in range(repeat)]
+    return {"median_us": statistics.median(samples), "min_us": min(samples), "loops": loops}
+
+# a quiet non-pawn move and its way back, so make_move can be timed without the position
+# drifting between loops. None if the side to move has no such move
+def reversible_move(fen):
+    py_board = chess.Board(fen)
+    for move in py_board.legal_moves:
+        piece = py_board.piece_at(move.from_square)
+        if (piece.piece_type not in (chess.PAWN, chess.KING) and not py_board.is_capture(move)):
+            return (move.from_square % 8, 7 - move.from_square // 8,
+                    move.to_square % 8, 7 - move.to_square // 8)
+    return None
+
+# a square holding a piece of the side to move, for legal_move_squares
+def occupied_square(position):
+    for piece in position:
+        if (piece.color == "white") == position.white_to_move:
+            return piece.x, piece.y
+    return 0, 0
+
+def analysis_benchmarks(name, fen):
+    position = load_fen(fen)
+    click = occupied_square(position)
+    benchmarks = {
+        "load_fen": lambda: load_fen(fen),
+        "get_abbrev_fen": lambda: get_abbrev_fen(position),
+        "get_attack_color_coding": lambda: piece_methods.get_attack_color_coding(position, True),
+        "get_defended_pieces": lambda: piece_methods.get_defended_pieces(position, True),
+        "get_attack_array": lambda: piece_methods.get_attack_array(position, True),
+        "board_struggle": lambda: piece_methods.board_struggle(position),
+        "king_attackers": lambda: piece_methods.king_attackers(position, True),
+        "move_table": lambda: piece_methods.PositionAnalysis(position).move_table(True),
+        "legal_move_squares": lambda: piece_methods.legal_move_squares(position, *click),
+        "restricted_pieces": lambda: piece_methods.restricted_pieces(position, True),
+        "exchange_struggle": lambda: piece_methods.exchange_struggle(position),
+        "hanging_pieces": lambda: piece_methods.hanging_pieces(position, True),
+    }
+
+    vis_cache = VisCache(position)
+    for mode in range(7):
+        def update_vis_cache(mode=mode):
+            vis_cache.position_changed()
+            vis_cache.get(mode, True, *click)
+        benchmarks[f"update_vis_cache.mode{mode}"] = update_vis_cache
+
+    move = reversible_move(fen)
+    if move is not None:
+        x, y, new_x, new_y = move
+        move_position = load_fen(fen)
+        benchmarks["make_move"] = lambda: (make_move(move_position, x, y, new_x, new_y),
+                                           make_move(move_position, new_x, new_y, x, y))
+        attack_maps = AttackMaps(load_fen(fen))
+        maps_position = attack_maps.position
+        benchmarks["make_move.attack_maps"] = lambda: (
+            make_move(maps_position, x, y, new_x, new_y, attack_maps=attack_maps),
+            make_move(maps_position, new_x, new_y, x, y, attack_maps=attack_maps))
+
+    return {f"{benchmark}/{name}": fn for benchmark, fn in benchmarks.items()}
+
+def render_benchmarks(name, fen, screen):
+    position = load_fen(fen)
+    board = pygame.Surface((600, 600))
+    highlights = piece_methods.board_struggle(position)
+    renderer = BoardRenderer(screen, board)
+
+    def render_full():
+        renderer.invalidate()
+        renderer.render(position, highlights, 1)
+
+    return {f"draw_board_and_pieces/{name}":
+                lambda: draw_board_and_pieces(board, screen, position, highlights, 1),
+            f"renderer.full/{name}": render_full,
+            f"renderer.unchanged/{name}": lambda: renderer.render(position, highlights, 1)}
+
+# the engine is timed at a fixed depth, by default against the stub engine so the numbers
+# measure this code rather than the engine's search
+def engine_benchmarks(engine, depth):
+    def search(fen):
+        engine.set_position(fen)
+        return engine.search(depth=depth)
+    return {f"engine.search_depth{depth}/{name}": (lambda fen=fen: search(fen))
+            for name, fen in corpus.items()}
+
+def run_benchmarks(engine_path=None, depth=4, selected=None, repeat=5):
+    pygame.init()
+    screen = pygame.display.set_mode((640, 640))
+    benchmarks = {}
+    for name, fen in corpus.items():
+        benchmarks.update(analysis_benchmarks(name, fen))
+        benchmarks.update(render_benchmarks(name, fen, screen))
+
+    engine = None
+    if engine_path is not None:
+        engine = UCIEngine(engine_path)
+        benchmarks.update(engine_benchmarks(engine, depth))
+
+    saved_entries = analysis_cache.max_entries
+    analysis_cache.resize(max_entries=0)  # time the computation, not the cache
+    results = {}
+    try:
+        for benchmark, fn in benchmarks.items():
+            if selected is None or selected in benchmark:
+                results[benchmark] = time_call(fn, repeat)
+    finally:
+        analysis_cache.resize(max_entries=saved_entries)
+        if engine is not None:
+            engine.quit()
+        pygame.quit()
+
+    return {"meta": {"python": platform.python_version(), "platform": platform.platform(),
+                     "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "repeat": repeat},
+            "results": results}
+
+# the benchmarks whose median got slower than the baseline by more than threshold
+# (a fraction), as {name: (baseline us, current us, relative change)}
+def compare(baseline, current, threshold=0.1):
+    regressions = {}
+    for benchmark, result in current["results"].items():
+        if benchmark not in baseline["results"]:
+            continue
+        before = baseline["results"][benchmark]["median_us"]
+        after = result["median_us"]
+        change = (after - before) / before if before else 0.0
+        if change > threshold:
+            regressions[benchmark] = (before, after, change)
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse as ag
+    parser = ag.ArgumentParser()
+    # command line program controls
+    parser.add_argument("-o", "--output", dest="output", default=None,
+                        help="write the results as JSON to this file")
+    parser.add_argument("-b", "--baseline", dest="baseline", default=None,
+                        help="saved results to compare against, regressions exit with status 1")
+    parser.add_argument("-t", "--threshold", dest="threshold", type=float, default=0.1,
+                        help="slowdown, as a fraction of the baseline, counted as a regression")
+    parser.add_argument("-e", "--engine", dest="engine_path",
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                             "fake_uci_engine.py"),
+                        help="UCI engine to time, the stub engine by default, empty to skip")
+    parser.add_argument("-d", "--depth", dest="depth", type=int, default=4)
+    parser.add_argument("-k", "--select", dest="selected", default=None,
+                        help="only run benchmarks whose name contains this text")
+    parser.add_argument("-r", "--repeat", dest="repeat", type=int, default=5)
+
+    args = parser.parse_args()
+    report = run_benchmarks(args.engine_path or None, args.depth, args.selected, args.repeat)
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump(report, handle, indent=1)
+    for benchmark, result in report["results"].items():
+        print(f"{benchmark:60s} {result['median_us']:12.1f} us")
+
+    if args.baseline:
+        with open(args.baseline) as handle:
+            regressions = compare(json.load(handle), report, args.threshold)
+        for benchmark, (before, after, change) in sorted(regressions.items()):
+            print(f"REGRESSION {benchmark}: {before:.1f} us -> {after:.1f} us ({change:+.0%})")
+        if regressions:
+            sys.exit(1)
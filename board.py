@@ -1,10 +1,19 @@
 import pygame
 import sys
-from piece_methods import Piece, load_fen, square_to_display_coordinates, request_engine_move
-from piece_methods import (get_attack_color_coding, board_struggle, king_attackers,
-                           legal_move_squares, restricted_pieces)
-from piece_methods import square_to_display_coordinates, display_coordinates_to_square, get_abbrev_fen
-from stockfish.models import Stockfish
+import time
+import chess
+import perf
+from piece_methods import Piece, square_to_display_coordinates, uci_to_display_move
+from piece_methods import PositionAnalysis
+from piece_methods import square_to_display_coordinates, display_coordinates_to_square
+from sprites import sprite_cache
+from engine_worker import EngineWorker, default_depth
+from game_state import GameState
+from eval_store import EvalStore
+from attack_maps import AttackMaps
+from sprites import SpriteCache
+from explain import explain_lines, format_explanation
+from opening_index import OpeningIndex, index_key
 
 # piece image citation: By Cburnett - Own work, CC BY-SA 3.0,
 # https://commons.wikimedia.org/w/index.php?curid=1499808
@@ -16,32 +25,80 @@ from stockfish.models import Stockfish
 white=pygame.Color(200,200,200)
 black=pygame.Color(92,64,51)
 
-def update_vis_cache(board, board_pieces, side_to_play, disp_mode, click_x=0, click_y=0):
-    # computes all relevant maps to be stored
-    attack_cc = get_attack_color_coding(board_pieces, side_to_play)
-    board_strug = board_struggle(board_pieces)
-    king_attacks = king_attackers(board_pieces, side_to_play)
-    leg_moves = legal_move_squares(board_pieces, click_x, click_y)
-    res_pieces = restricted_pieces(board_pieces, side_to_play)
-
-    return [attack_cc, board_strug, king_attacks, leg_moves, res_pieces]
-
-
-def display_processing(board, highlighted_squares, disp_mode):
+# posted by the engine worker thread when search output is waiting to be read
+ENGINE_EVENT = pygame.USEREVENT + 1
+
+# the visualization layers by display mode. Each entry gives the function computing a
+# layer from the position's shared analysis and the input, besides the position itself,
+# that its result depends on
+vis_layers = {0: (lambda analysis, side, click: analysis.attack_color_coding(side), "side"),
+              1: (lambda analysis, side, click: analysis.board_struggle(), None),
+              2: (lambda analysis, side, click: analysis.king_attackers(side), "side"),
+              3: (lambda analysis, side, click: analysis.legal_move_squares(*click), "click"),
+              4: (lambda analysis, side, click: analysis.restricted_pieces(side), "side"),
+              5: (lambda analysis, side, click: analysis.exchange_struggle(), None),
+              6: (lambda analysis, side, click: analysis.hanging_pieces(side), "side")}
+
+# layers that AttackMaps keeps up to date move by move, read from it instead when given
+incremental_layers = {0: lambda attack_maps, side: attack_maps.attack_color_coding(side),
+                      1: lambda attack_maps, side: attack_maps.board_struggle()}
+
+# layers an OpeningIndex holds, read from it for the positions it covers
+index_layers = {0: "attack", 1: "struggle", 2: "king_attackers", 4: "restricted"}
+
+# computes layers only when they are requested and keeps them until the position changes,
+# so switching modes or sides back and forth reuses earlier work
+class VisCache:
+    def __init__(self, board_pieces, attack_maps=None, opening_index=None):
+        self.board_pieces = board_pieces
+        self.attack_maps = attack_maps
+        self.opening_index = opening_index
+        self.position_changed()
+
+    # must be called whenever pieces are moved, added or removed
+    def position_changed(self):
+        self.analysis = None
+        self.layers = {}
+
+    def get(self, disp_mode, side_to_play, click_x=0, click_y=0):
+        if disp_mode not in vis_layers:
+            return set()  # visualizations disabled, nothing to compute
+        compute, depends_on = vis_layers[disp_mode]
+        if depends_on == "side":
+            key = (disp_mode, side_to_play)
+        elif depends_on == "click":
+            key = (disp_mode, click_x, click_y)
+        else:
+            key = (disp_mode,)
+
+        if key not in self.layers:
+            # positions the opening index holds are read from it, before the attack maps
+            stored = None
+            if self.opening_index is not None and disp_mode in index_layers:
+                stored = self.opening_index.layer(self.board_pieces.placement_key,
+                                                  index_layers[disp_mode], side_to_play)
+            if stored is not None:
+                self.layers[key] = stored
+            elif self.attack_maps is not None and disp_mode in incremental_layers:
+                return incremental_layers[disp_mode](self.attack_maps, side_to_play)
+            else:
+                if self.analysis is None:
+                    self.analysis = PositionAnalysis(self.board_pieces)
+                self.layers[key] = compute(self.analysis, side_to_play, (click_x, click_y))
+        return self.layers[key]
+
+
+# the border color of every highlighted square for a display mode, {(x, y): color}
+def overlay_colors(highlighted_squares, disp_mode):
+    colors = {}
     # code for 1-sided attack map
     if disp_mode == 0:
         for square in highlighted_squares.keys():
-            x = int(square[0])
-            y = int(square[1])
             color_level = min(int(120.0 / highlighted_squares[square]), 255)
-            border_color = pygame.Color(0, 0, color_level)
-
-            pygame.draw.rect(board, border_color, (x * 75, y * 75, 75, 75), 6)
-    # for contested mapping
-    elif disp_mode == 1:
+            colors[(int(square[0]), int(square[1]))] = pygame.Color(0, 0, color_level)
+    # for contested mapping, by attack weights or by exchange results
+    elif disp_mode == 1 or disp_mode == 5:
         for square in highlighted_squares.keys():
-            x = int(square[0])
-            y = int(square[1])
             attack_strength = highlighted_squares[square]
             if attack_strength != 0.0:
                 if attack_strength > 0:
@@ -50,35 +107,25 @@ def display_processing(board, highlighted_squares, disp_mode):
                 else:
                     color_level = min(int(-120.0 / attack_strength), 255)
                     border_color = pygame.Color(0, color_level, 0)
-
-                pygame.draw.rect(board, border_color, (x * 75, y * 75, 75, 75), 6)
-    # for king attackers
-    elif disp_mode == 2:
-        border_color = pygame.Color(200, 0, 0)
-
+                colors[(int(square[0]), int(square[1]))] = border_color
+    # for king attackers, restricted pieces and hanging pieces
+    elif disp_mode == 2 or disp_mode == 4 or disp_mode == 6:
         for square in highlighted_squares:
-            x = int(square[0])
-            y = int(square[1])
-            pygame.draw.rect(board, border_color, (x * 75, y * 75, 75, 75), 6)
+            colors[(int(square[0]), int(square[1]))] = pygame.Color(200, 0, 0)
     # to highlight a piece's legal moves
     elif disp_mode == 3:
-        border_color = pygame.Color(238, 230, 0)
-
         for square in highlighted_squares:
-            x = int(square[0])
-            y = int(square[1])
-            pygame.draw.rect(board, border_color, (x * 75, y * 75, 75, 75), 6)
-    # to highlight restricted pieces
-    elif disp_mode == 4:
-        border_color = pygame.Color(200, 0, 0)
+            colors[(int(square[0]), int(square[1]))] = pygame.Color(238, 230, 0)
 
-        for square in highlighted_squares:
-            x = int(square[0])
-            y = int(square[1])
-            pygame.draw.rect(board, border_color, (x * 75, y * 75, 75, 75), 6)
+    return colors
 
 
-def draw_board_and_pieces(board, screen, board_pieces, highlighted_squares, display_mode):
+def display_processing(board, highlighted_squares, disp_mode):
+    for (x, y), border_color in overlay_colors(highlighted_squares, disp_mode).items():
+        pygame.draw.rect(board, border_color, (x * 75, y * 75, 75, 75), 6)
+
+
+def draw_background(board):
     board.fill(black)  # sets background color to designated color for black squares
 
     # add squares to board
@@ -87,62 +134,115 @@ def draw_board_and_pieces(board, screen, board_pieces, highlighted_squares, disp
             pygame.draw.rect(board, white, (x * 75, y * 75, 75, 75))
             pygame.draw.rect(board, white, ((x + 1) * 75, (y + 1) * 75, 75, 75))
 
+
+def draw_board_and_pieces(board, screen, board_pieces, highlighted_squares, display_mode):
+    draw_background(board)
+
     display_processing(board, highlighted_squares, display_mode)
 
-    for piece in board_pieces:  # draw all of the acquired pieces
-        piece.draw(board)
+    # draw all of the acquired pieces, the sprites are already rasterized so this only blits
+    for piece in board_pieces:
+        sprite_cache.blit(board, piece.color, piece.type, piece.x, piece.y)
 
     # this contains a hard-coded value which may affect moving pieces
     screen.blit(board, (20, 20))  # blit is the command to put the board on screen, like plt.show?
 
+
+# keeps the background, the overlay borders and the pieces as separate layers and redraws
+# only the squares whose border or piece changed since the last frame. render returns the
+# screen rectangles that changed, to be passed to pygame.display.update
+class BoardRenderer:
+    def __init__(self, screen, board, offset=(20, 20)):
+        self.screen = screen
+        self.board = board
+        self.offset = offset
+        self.background = pygame.Surface(board.get_size())
+        draw_background(self.background)
+        self.overlay = {}  # (x, y) -> border color shown on the screen
+        self.pieces = {}  # (x, y) -> piece shown on the screen, as "color_type"
+        self.full_redraw_needed = True
+
+    # forces the next render to redraw every square, e.g. after the window was covered
+    def invalidate(self):
+        self.full_redraw_needed = True
+
+    def render(self, board_pieces, highlighted_squares, display_mode):
+        overlay = overlay_colors(highlighted_squares, display_mode)
+        pieces = {(piece.x, piece.y): f"{piece.color}_{piece.type}" for piece in board_pieces}
+
+        full_redraw = self.full_redraw_needed
+        if full_redraw:
+            dirty = [(x, y) for x in range(8) for y in range(8)]
+            self.full_redraw_needed = False
+        else:
+            changed = set(overlay) | set(self.overlay) | set(pieces) | set(self.pieces)
+            dirty = [square for square in changed
+                     if overlay.get(square) != self.overlay.get(square)
+                     or pieces.get(square) != self.pieces.get(square)]
+
+        rects = []
+        for x, y in dirty:
+            rect = pygame.Rect(x * 75, y * 75, 75, 75)
+            self.board.set_clip(rect)
+            self.board.blit(self.background, rect.topleft, rect)
+            if (x, y) in overlay:
+                pygame.draw.rect(self.board, overlay[(x, y)], rect, 6)
+            # sprites are slightly larger than a square, so neighbouring pieces are drawn
+            # again inside the clip to keep their edges intact
+            for nx in range(max(x - 1, 0), min(x + 2, 8)):
+                for ny in range(max(y - 1, 0), min(y + 2, 8)):
+                    if (nx, ny) in pieces:
+                        color, piece_type = pieces[(nx, ny)].split("_")
+                        sprite_cache.blit(self.board, color, piece_type, nx, ny)
+            self.board.set_clip(None)
+
+            if not full_redraw:
+                screen_rect = rect.move(self.offset)
+                self.screen.blit(self.board, screen_rect.topleft, rect)
+                rects.append(screen_rect)
+
+        if full_redraw:
+            self.screen.blit(self.board, self.offset)
+            rects.append(self.board.get_rect().move(self.offset))
+
+        self.overlay = overlay
+        self.pieces = pieces
+        return rects
+
+
 # this move is called to allow the player to interact with the GUI
 # as well as to allow the linked engine to make a move
 # NOTE: auto-queening is turned on by default, prom_type only used by computer
 # user_move is True if user is the one prompting a move
+# attack_maps, if given, applies the move so its maps follow the position
 
-def make_move(board_pieces, x, y, new_x, new_y, user_move=True, pr_type="empty"):
+def make_move(position, x, y, new_x, new_y, user_move=True, pr_type="empty", attack_maps=None):
 
     # UCI promotion notation from full piece name for compatibility with display
     uci_prom = {"queen": "q", "knight": "n", "bishop": "b", "rook": "r", "empty": ""}
 
-    # if piece is found at target square, remove temporarily from the board
-    # then try to move piece to the square. If they are the same color,
-    # reject the move and add the piece back to the list of active pieces
-    temp_color = None
+    # look up the moving piece and whatever stands on the target square. If they are
+    # the same color the move is rejected and the position is left untouched
     if new_x != x or new_y != y:
-        for piece in board_pieces:
-            if piece.x == new_x and piece.y == new_y:
-                temp_piece = piece
-                temp_color = temp_piece.color
-                board_pieces.remove(piece)
-                break
-
-        for piece in board_pieces:
-            # checks to avoid null moves, which removes the piece from the board
-            if piece.x == x and piece.y == y:
-                # checks for illegal move capturing same color
-                if piece.color != temp_color:
-                    # checks for promotion
-                    if piece.type == "pawn" and (new_y == 0 or new_y == 7):
-                        prom_color = piece.color
-                        # takes user input to determine promotion type
-                        if user_move:
-                            recognized_piece = False  # we wait until user correctly types a piece to promote to
-                            while recognized_piece == False:
-                                prom_type = input("Please input a piece to promote to: ")
-                                recognized_piece = prom_type in ["queen", "rook", "knight", "bishop"]
-                        # engine is making the move, all necessary info provided to function call
-                        else:
-                            prom_type = pr_type  # uses parameter exposed for engine
-                        prom_piece = Piece(prom_color, new_x, new_y, prom_type)
-                        # perform the prmotion
-                        board_pieces.remove(piece)
-                        board_pieces.append(prom_piece)
-                    else:
-                        piece.x = new_x
-                        piece.y = new_y
-                else:
-                    board_pieces.append(temp_piece)  # reject illegal move capturing own piece
+        piece = position.piece_at(x, y)
+        target = position.piece_at(new_x, new_y)
+        # checks to avoid null moves from empty squares and illegal captures of own pieces
+        if piece is not None and (target is None or target.color != piece.color):
+            # checks for promotion
+            if piece.type == "pawn" and (new_y == 0 or new_y == 7):
+                # takes user input to determine promotion type
+                if user_move:
+                    recognized_piece = False  # we wait until user correctly types a piece to promote to
+                    while recognized_piece == False:
+                        pr_type = input("Please input a piece to promote to: ")
+                        recognized_piece = pr_type in ["queen", "rook", "knight", "bishop"]
+                # engine is making the move, all necessary info provided to function call
+            else:
+                pr_type = "empty"
+            if attack_maps is not None:
+                attack_maps.apply_move(x, y, new_x, new_y, pr_type)
+            else:
+                position.apply_move(x, y, new_x, new_y, pr_type)
 
     origin_square = display_coordinates_to_square(f"{x}{y}")
     dest_square = display_coordinates_to_square(f"{new_x}{new_y}")
@@ -150,21 +250,77 @@ def make_move(board_pieces, x, y, new_x, new_y, user_move=True, pr_type="empty")
     return origin_square + dest_square + uci_prom[pr_type]
 
 
+# True if a window coordinate falls on the board rather than the border around it
+def on_board(pos):
+    return 20 <= pos[0] < 620 and 20 <= pos[1] < 620
+
+
+# applies a UCI move from the engine (or the evaluation store) to the position
+def play_engine_move(position, uci_move, attack_maps=None):
+    # e prefix to indicate "engine"
+    e_x, e_y, e_new_x, e_new_y, e_prom_type = uci_to_display_move(uci_move)
+    return make_move(position, e_x, e_y, e_new_x, e_new_y, user_move=False, pr_type=e_prom_type,
+                     attack_maps=attack_maps)
+
+
+# a short summary of a search in progress, shown in the window title
+def engine_info_caption(info):
+    if "score_mate" in info:
+        score = f"mate {info['score_mate']}"
+    else:
+        score = f"{info.get('score_cp', 0) / 100:+.2f}"
+    pv = " ".join(info.get("pv", [])[:6])
+    return f"Python Analysis Board - depth {info.get('depth', 0)}  eval {score}  pv {pv}"
+
+
+# timed while the performance overlay is on, see perf.py
+perf.instrument(VisCache, "get", "update_vis_cache")
+perf.instrument(BoardRenderer, "render", "render")
+perf.instrument(AttackMaps, "apply_move", "attack_maps.apply_move")
+perf.instrument(SpriteCache, "rebuild", "sprites.rebuild")
+perf.instrument(EvalStore, "lookup", "eval_store.lookup")
+perf.instrument(OpeningIndex, "layer", "opening_index.layer")
+for layer in ("attack_color_coding", "attack_array", "defended_pieces", "board_struggle",
+              "king_attackers", "move_table", "legal_move_squares", "restricted_pieces", "exchange_struggle",
+              "hanging_pieces"):
+    perf.instrument(PositionAnalysis, layer, f"analysis.{layer}")
+
+
+# draws lines of text in an opaque box in the top left of the window, or the bottom left
+# with at_bottom, returns its rect
+def draw_text_box(screen, font, lines, at_bottom=False):
+    line_height = font.get_linesize()
+    rect = pygame.Rect(0, 0, max(font.size(line)[0] for line in lines) + 8,
+                       line_height * len(lines) + 6)
+    if at_bottom:
+        rect.bottom = screen.get_height()
+    screen.fill((20, 20, 20), rect)
+    for index, line in enumerate(lines):
+        screen.blit(font.render(line, True, (230, 230, 230)), (rect.left + 4, rect.top + 3 + index * line_height))
+    return rect
+
+# draws the timings over the top left of the window, returns its rect
+def draw_perf_overlay(screen, font):
+    return draw_text_box(screen, font, ["perf (p to hide)   count / p50 / p99 / max"] + perf.overlay_lines())
+
+
 # opens analysis board, no visualizations, white to play in new game
+# fps caps how often the board is recomputed and redrawn, events arriving within one
+# frame are handled together and the loop sleeps while there are none
 def analysis_board(fen="rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
-                   disp=9999, sp=True):
-
-    # initialize engine instance
-    # adjust engine settings, depth at least 18 preferred
-    stockfish = Stockfish(path="stockfish\stockfish-windows-x86-64-avx2.exe", depth=18)
-    stockfish.update_engine_parameters({"Hash": 2 * 1024, "Threads": 4})
+                   disp=9999, sp=True, fps=60,
+                   engine_path="stockfish\\stockfish-windows-x86-64-avx2.exe",
+                   store_path="evaluations.sqlite", verify_maps=False,
+                   perf_overlay=False, perf_json=None, index_path=None):
 
     # check if FEN is valid. Note this doesn't prevent nonsensical positions, which may lead
     # to crashes. E.g. white to move while black is in check. Gee, I wonder how I came up with
     # such a specific example? -_-
-    if stockfish.is_fen_valid(fen):
-        stockfish.set_fen_position(fen)
-    else:
+    try:
+        fen_is_valid = chess.Board(fen).is_valid()
+    except ValueError:
+        fen_is_valid = False
+    if not fen_is_valid:
         raise Exception("Invalid FEN encountered")
 
     # start pygame
@@ -177,42 +333,101 @@ def analysis_board(fen="rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1
 
     # create board and initialize control variables
     board = pygame.Surface((600,600))
-    board_pieces = load_fen(fen)
+    # the game is kept here, the engine only ever receives its root position and moves
+    game = GameState(fen)
+    board_pieces = game.position
 
     side_playing = sp
     display_mode = disp
     x = 0
     y = 0
+    press_on_board = False  # a move is only made by a drag that started on the board
     new_visualization_needed = False  # this variable controls when we refresh our highlights
 
-    # compute relevant modes for highlighting
-    vis_cache = update_vis_cache(board, board_pieces, side_playing, display_mode, x, y)
-    highlighted_squares = vis_cache[min(display_mode, len(vis_cache) - 1)]
+    # attack weights and contested squares are updated move by move, verify_maps checks
+    # every update against a full recompute
+    attack_maps = AttackMaps(board_pieces, verify=verify_maps)
+    # compute the highlights for the active mode, other modes wait until they are viewed
+    # opening positions are answered from a precomputed index when one is given, it is only
+    # mapped here, pages are read as positions are looked up
+    opening_index = OpeningIndex(index_path) if index_path else None
+    vis_cache = VisCache(board_pieces, attack_maps, opening_index)
+    highlighted_squares = vis_cache.get(display_mode, side_playing, x, y)
 
 
-    draw_board_and_pieces(board, screen, board_pieces, highlighted_squares, display_mode)
+    renderer = BoardRenderer(screen, board)
+    renderer.render(board_pieces, highlighted_squares, display_mode)
     pygame.display.flip()  # must be called to actually show the frames of the game
 
+    # searches run on a background thread, their output wakes the loop via ENGINE_EVENT.
+    # adjust engine settings, depth at least 18 preferred
+    engine_depth = default_depth
+    engine_worker = EngineWorker(engine_path, {"Hash": 2 * 1024, "Threads": 4}, depth=engine_depth,
+                                 notify=lambda: pygame.event.post(pygame.event.Event(ENGINE_EVENT)))
+    engine_worker.warm_up()  # the board is already on screen, the engine loads meanwhile
+    engine_request = None  # id of the search whose result we are waiting for
+    # e asks the engine for its best lines and shows what each does to the analysis layers
+    explain_line_count = 3
+    explaining = False  # engine_request is a search to explain rather than to play
+    explain_fen = None
+    explanation = None  # lines of text shown until the position changes or a key is pressed
+    explanation_rect = None  # where the explanation was last drawn
+    last_engine_info = {}  # newest info of the running search, stored with its best move
+    # positions searched before, in this session or any other, are answered from here
+    eval_store = EvalStore(store_path) if store_path else None
+
+    # p shows timings of the analysis, rendering and engine paths, they are only measured
+    # while shown. perf_json receives everything measured when the window is closed
+    perf_font = None
+    engine_submitted = 0.0  # when the running search was submitted, for the engine wait time
+    frame_end = time.perf_counter()
+    if perf_overlay:
+        perf.enable()
+
+    # mouse motion never changes the board, keep it from waking the loop up
+    pygame.event.set_blocked(pygame.MOUSEMOTION)
+    clock = pygame.time.Clock()
 
     while True:
-        for event in pygame.event.get():
+        # events already waiting arrived while the last frame was drawn or the clock slept,
+        # their latency is counted from the end of that frame
+        events_waiting = perf.enabled and pygame.event.peek()
+        # block until something happens, then take everything that queued up meanwhile
+        events = [pygame.event.wait()] + pygame.event.get()
+        frame_start = time.perf_counter()
+        input_since = frame_end if events_waiting else frame_start
+        input_received = False  # a key, click or engine result that the next frame shows
+        redraw_needed = False
+
+        for event in events:
             if event.type == pygame.QUIT:
+                engine_worker.close()
+                # lookups only note when results were used, close writes that to the store
+                if eval_store is not None:
+                    eval_store.close()
+                if opening_index is not None:
+                    opening_index.close()
+                if perf_json:
+                    perf.dump(perf_json)
                 pygame.quit()
                 sys.exit()
 
+            if event.type in (pygame.KEYDOWN, pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP, ENGINE_EVENT):
+                input_received = True
+
             if event.type == pygame.KEYDOWN:
                 new_visualization_needed = True
+                # any other keypress abandons a running search, its result would be stale
+                if engine_request is not None and event.key not in (pygame.K_r, pygame.K_p, pygame.K_e):
+                    engine_worker.cancel()
+                    engine_request = None
+                    pygame.display.set_caption('Python Analysis Board')
+                if explanation is not None and event.key != pygame.K_p:
+                    explanation = None
                 if event.key == pygame.K_SPACE:
                     new_visualization_needed = True  # sides have switched, this impacts visuals
                     side_playing = not side_playing
-
-                    stock_fen = stockfish.get_fen_position().split(" ")
-                    # change player indicator in FEN and update engine
-                    if stock_fen[1] == "w":
-                        stock_fen[1] = "b"
-                    elif stock_fen[1] == "b":
-                        stock_fen[1] = "w"
-                    stockfish.set_fen_position(" ".join(stock_fen))
+                    game.switch_side()  # change player to move for the engine as well
 
                 if event.key == pygame.K_0:
                     display_mode = 0
@@ -234,10 +449,26 @@ def analysis_board(fen="rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1
                     display_mode = 4
                     print("Now viewing restricted pieces")
 
+                if event.key == pygame.K_5:
+                    display_mode = 5
+                    print("Now viewing exchange results on contested squares.")
+
+                if event.key == pygame.K_6:
+                    display_mode = 6
+                    print("Now viewing hanging pieces")
+
                 if event.key == pygame.K_TAB:
                     display_mode = 9999
                     print("All visualizations disabled")
 
+                if event.key == pygame.K_p:
+                    perf_overlay = not perf_overlay
+                    if perf_overlay:
+                        perf.enable()
+                    else:
+                        perf.disable()
+                        renderer.invalidate()  # uncover the squares under the overlay
+
                 if event.key == pygame.K_a:
                     new_visualization_needed = True  # more pieces affects visualizations
                     add_piece_type = input("Please input a piece to add to the board: ")
@@ -250,63 +481,160 @@ def analysis_board(fen="rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1
 
                     piece_to_drop = Piece(add_piece_color,int(add_square[0]),
                                           int(add_square[1]),add_piece_type)
-                    board_pieces.append(piece_to_drop)
-                    # update engine after piece is dropped
-                    stock_fen = stockfish.get_fen_position().split(" ")
-                    stock_tail = " ".join(stock_fen[1:])
-                    abbrev_fen = get_abbrev_fen(board_pieces)
-                    full_fen = abbrev_fen + " " + stock_tail
-                    stockfish.set_fen_position(full_fen)
+                    game.add_piece(piece_to_drop)
+                    attack_maps.squares_changed([(piece_to_drop.x, piece_to_drop.y)])
+                    vis_cache.position_changed()
+
+                if event.key == pygame.K_e:
+                    print("Explaining the engine's best moves.")
+                    root_fen, moves = game.engine_position()
+                    explain_fen = game.fen()
+                    last_engine_info = {}
+                    explaining = True
+                    engine_request = engine_worker.submit(root_fen, moves, multipv=explain_line_count)
+                    engine_submitted = time.perf_counter()
 
                 if event.key == pygame.K_r:
-                    new_visualization_needed = True  # engine move will impact the board
                     print("Engine move requested.")
-                    # e prefix to indicate "engine"
-                    # we play for the opponent of the current player
-                    # NOTE: we currently do not have a way to activate castling rights or en passant.
-                    # Only use during the middlegame or later!
-                    (e_x, e_y, e_new_x,
-                     e_new_y, e_prom_type) = request_engine_move(stockfish)
-                    # apply engine request to the board
-                    uci_move_eng = make_move(board_pieces, e_x, e_y, e_new_x,
-                              e_new_y, user_move=False, pr_type=e_prom_type)
-                    print(f"Engine has played {uci_move_eng}")
-                    stockfish.make_moves_from_current_position([uci_move_eng])
+                    # we play for the opponent of the current player. The search runs in the
+                    # background, the move is applied when ENGINE_EVENT delivers it
+                    stored = None
+                    source = "stored"
+                    if opening_index is not None:
+                        stored = opening_index.evaluation(index_key(board_pieces), min_depth=engine_depth)
+                        source = "opening index"
+                    if stored is None and eval_store is not None:
+                        stored = eval_store.lookup(game.fen(), min_depth=engine_depth)
+                        source = "stored"
+                    if stored is not None:
+                        uci_move_eng = play_engine_move(board_pieces, stored["best_move"], attack_maps)
+                        vis_cache.position_changed()
+                        game.record_move(uci_move_eng)
+                        print(f"Engine has played {uci_move_eng} (depth {stored['depth']}, {source})")
+                        # the position changed under a running search, e.g. an explanation, drop it
+                        if engine_request is not None:
+                            engine_worker.cancel()
+                            engine_request = None
+                            explaining = False
+                            pygame.display.set_caption('Python Analysis Board')
+                    else:
+                        root_fen, moves = game.engine_position()
+                        last_engine_info = {}
+                        explaining = False
+                        engine_request = engine_worker.submit(root_fen, moves)
+                        engine_submitted = time.perf_counter()
+
+            if event.type == ENGINE_EVENT:
+                for kind, request_id, payload in engine_worker.poll():
+                    if request_id != engine_request:
+                        continue  # superseded or cancelled search
+                    if kind == "info":
+                        last_engine_info = payload
+                        pygame.display.set_caption(engine_info_caption(payload))
+                    elif kind == "error":
+                        print(f"Engine failed: {payload}")
+                        engine_request = None
+                    elif kind == "lines" and explaining:
+                        # the candidates are played out on the position the search started from
+                        explanation = format_explanation(explain_lines(explain_fen, payload))
+                        print("\n".join(explanation))
+                        redraw_needed = True
+                    elif kind == "bestmove":
+                        engine_request = None
+                        if perf.enabled:
+                            perf.record("engine.wait", (time.perf_counter() - engine_submitted) * 1000)
+                        pygame.display.set_caption('Python Analysis Board')
+                        if explaining:
+                            explaining = False
+                            continue  # explained, not played
+                        if payload is None:
+                            print("Engine has no move in this position.")
+                            continue
+                        new_visualization_needed = True  # engine move will impact the board
+                        # only complete searches are worth keeping, cancelled ones never get here
+                        if eval_store is not None and last_engine_info.get("depth", 0) >= engine_depth:
+                            result = dict(last_engine_info, best_move=payload)
+                            eval_store.store(game.fen(), result)
+                        # apply engine request to the board
+                        uci_move_eng = play_engine_move(board_pieces, payload, attack_maps)
+                        vis_cache.position_changed()
+                        game.record_move(uci_move_eng)
+                        print(f"Engine has played {uci_move_eng}")
 
             if event.type == pygame.MOUSEBUTTONDOWN:
-                new_visualization_needed = True
-                # get click position
-                pos = pygame.mouse.get_pos()
-                # find clicked square
-                x = (pos[0]-20) // 75
-                y = (pos[1]-20) // 75
+                # get click position, from the event since several may be handled in one frame
+                pos = event.pos
+                # find clicked square, clicks on the border around the board are ignored
+                press_on_board = on_board(pos)
+                if press_on_board:
+                    new_visualization_needed = True
+                    x = (pos[0]-20) // 75
+                    y = (pos[1]-20) // 75
 
             if event.type == pygame.MOUSEBUTTONUP:
+                # a release after a press off the board would move the piece of an older click
+                released_on_board = press_on_board and on_board(event.pos)
+                press_on_board = False
+            if event.type == pygame.MOUSEBUTTONUP and released_on_board:
                 new_visualization_needed = True
-                new_pos = pygame.mouse.get_pos()
+                new_pos = event.pos
                 new_x = (new_pos[0] - 20) // 75
                 new_y = (new_pos[1] - 20) // 75
 
-                uci_move_player = make_move(board_pieces, x, y, new_x, new_y)
-                # get this information before engine crashes from illegal move
-                stock_fen = stockfish.get_fen_position().split(" ")
-                stock_tail = " ".join(stock_fen[1:])
-                try:
-                    stockfish.make_moves_from_current_position([uci_move_player])
-                except:
-                    abbrev_fen = get_abbrev_fen(board_pieces)
-                    full_fen = abbrev_fen + " " + stock_tail
-                    stockfish.set_fen_position(full_fen)
-
-            # if commands have altered our displays, update them
-            if new_visualization_needed:
-                vis_cache = update_vis_cache(board, board_pieces, side_playing, display_mode, x, y)
-                highlighted_squares = vis_cache[min(display_mode, len(vis_cache) - 1)]  # disp_mode can=9999
-
-            # once we have updated visuals, draw board and set new_visualization to False
-            draw_board_and_pieces(board, screen, board_pieces, highlighted_squares, display_mode)
+                if new_x != x or new_y != y:
+                    explanation = None  # it explained the position before this move
+                    uci_move_player = make_move(board_pieces, x, y, new_x, new_y,
+                                                attack_maps=attack_maps)
+                    # extends the move list sent to the engine, or re-roots it on an illegal move
+                    game.record_move(uci_move_player)
+                    vis_cache.position_changed()
+                    # the position changed under a running search, drop it
+                    if engine_request is not None:
+                        engine_worker.cancel()
+                        engine_request = None
+                        pygame.display.set_caption('Python Analysis Board')
+
+            if event.type == pygame.WINDOWEXPOSED:
+                renderer.invalidate()
+                redraw_needed = True
+
+        redraw_needed = redraw_needed or new_visualization_needed
+
+        # at most one recompute and one redraw per frame, however many events arrived.
+        # Only the active layer is computed, and only if it is not already cached
+        if new_visualization_needed:
+            highlighted_squares = vis_cache.get(display_mode, side_playing, x, y)
             new_visualization_needed = False
-            pygame.display.update()
+
+        # redraw the squares that changed
+        if redraw_needed:
+            if explanation is None and explanation_rect is not None:
+                # uncover what the explanation was drawn over, the border included
+                screen.fill((0, 0, 0), explanation_rect)
+                renderer.invalidate()
+            dirty_rects = renderer.render(board_pieces, highlighted_squares, display_mode)
+            if explanation is None and explanation_rect is not None:
+                dirty_rects.append(explanation_rect)
+                explanation_rect = None
+            if perf_overlay:
+                if perf_font is None:
+                    perf_font = pygame.font.SysFont("monospace", 13)
+                dirty_rects.append(draw_perf_overlay(screen, perf_font))
+            if explanation:
+                if perf_font is None:
+                    perf_font = pygame.font.SysFont("monospace", 13)
+                explanation_rect = draw_text_box(screen, perf_font, explanation, at_bottom=True)
+                dirty_rects.append(explanation_rect)
+            if dirty_rects:
+                pygame.display.update(dirty_rects)
+
+        frame_end = time.perf_counter()
+        if perf.enabled:
+            perf.record("frame", (frame_end - frame_start) * 1000)
+            if input_received and redraw_needed:
+                perf.record("event_to_pixel", (frame_end - input_since) * 1000)
+
+        clock.tick(fps)  # input arriving before the next frame is due is merged into it
 
 if __name__ == "__main__":
     import argparse as ag
@@ -316,10 +644,28 @@ if __name__ == "__main__":
                         default="rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
                         help="Game FEN")
     parser.add_argument("-d", "--disp", dest="disp", default=9999,
-                        help="display modes are numeric values 0-3")
+                        help="display modes are numeric values 0-6")
     parser.add_argument("-s", "--side", dest="sp", default=True,
                         help="1: white to play, 0: black to play")
+    parser.add_argument("--fps", dest="fps", default=60,
+                        help="maximum frames drawn per second")
+    parser.add_argument("-e", "--engine", dest="engine_path",
+                        default="stockfish\\stockfish-windows-x86-64-avx2.exe",
+                        help="path to a UCI engine binary")
+    parser.add_argument("--store", dest="store_path", default="evaluations.sqlite",
+                        help="evaluation store shared between sessions, empty to disable")
+    parser.add_argument("--verify-maps", dest="verify_maps", action="store_true",
+                        help="check incremental attack maps against a full recompute")
+    parser.add_argument("--perf", dest="perf_overlay", action="store_true",
+                        help="start with the performance overlay shown (toggle with p)")
+    parser.add_argument("--perf-json", dest="perf_json", default=None,
+                        help="write the measured timings to this JSON file on exit")
+    parser.add_argument("--index", dest="index_path", default=None,
+                        help="opening index built by opening_index.py, layers and engine moves "
+                             "of the positions it holds are read from it")
 
     # read command line and run analysis board
     args = parser.parse_args()
-    analysis_board(args.fen, int(args.disp), int(args.sp)>0)
+    analysis_board(args.fen, int(args.disp), int(args.sp)>0, int(args.fps), args.engine_path,
+                   args.store_path, args.verify_maps, args.perf_overlay, args.perf_json,
+                   args.index_path)
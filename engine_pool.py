@@ -0,0 +1,144 @@
+import os
+import sys
+import json
+import queue
+import threading
+from uci_engine import UCIEngine, EngineError
+from eval_store import EvalStore
+
+# evaluates many positions in parallel on several UCI engine processes. The CPU budget and
+# hash are split between the processes, an engine that crashes is restarted and the
+# position it was working on goes back on the queue. With an EvalStore, positions it
+# already holds at the requested depth are not searched and new results are added to it
+
+class EnginePool:
+    def __init__(self, path, processes=None, cpu_budget=None, hash_mb=2048,
+                 options=None, max_retries=2):
+        cpu_budget = cpu_budget or os.cpu_count() or 1
+        self.path = path
+        self.processes = processes or cpu_budget
+        self.max_retries = max_retries
+        # each engine gets an equal share of threads and hash
+        self.options = {"Threads": max(1, cpu_budget // self.processes),
+                        "Hash": max(16, hash_mb // self.processes)}
+        self.options.update(options or {})
+        self.engines = [None] * self.processes
+        self.restarts = 0  # engine failures seen, each one is followed by a fresh process
+
+    def _engine(self, slot):
+        engine = self.engines[slot]
+        if engine is None or not engine.is_alive():
+            engine = UCIEngine(self.path, self.options)
+            self.engines[slot] = engine
+        return engine
+
+    # evaluates every FEN with the given limit and returns one result per FEN in input
+    # order, {"fen", "best_move", "depth", "score_cp" or "score_mate", "pv"}, or
+    # {"fen", "error"} if the engines kept failing on it. At least one limit is needed, an
+    # unlimited search would never return
+    def evaluate(self, fens, depth=None, nodes=None, movetime=None, on_result=None, store=None):
+        if depth is None and nodes is None and movetime is None:
+            raise Exception("evaluate needs a depth, nodes or movetime limit")
+        jobs = queue.Queue()
+        results = [None] * len(fens)
+        remaining = [len(fens)]
+        done = threading.Condition()
+        for index, fen in enumerate(fens):
+            stored = store.lookup(fen, min_depth=depth or 0) if store is not None else None
+            if stored is None:
+                jobs.put((index, fen, 0))
+            else:
+                stored["fen"] = fen
+                results[index] = stored
+                remaining[0] -= 1
+                if on_result is not None:
+                    on_result(index, stored)
+
+        def finish(index, result):
+            results[index] = result
+            if on_result is not None:
+                on_result(index, result)
+            with done:
+                remaining[0] -= 1
+                done.notify_all()
+
+        def work(slot):
+            while True:
+                with done:
+                    if remaining[0] == 0:
+                        return
+                try:
+                    index, fen, attempts = jobs.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                try:
+                    engine = self._engine(slot)
+                    engine.set_position(fen)
+                    best_move, lines = engine.search(depth=depth, nodes=nodes, movetime=movetime)
+                    result = {"fen": fen, "best_move": best_move}
+                    if lines:
+                        result.update({key: lines[0][key] for key in
+                                       ("depth", "score_cp", "score_mate", "pv") if key in lines[0]})
+                    if store is not None and best_move is not None:
+                        store.store(fen, result)
+                    finish(index, result)
+                except EngineError as error:
+                    if self.engines[slot] is not None:
+                        self.engines[slot].quit()  # reaps the dead process
+                    self.engines[slot] = None  # restarted when this slot takes its next job
+                    self.restarts += 1
+                    if attempts < self.max_retries:
+                        jobs.put((index, fen, attempts + 1))
+                    else:
+                        finish(index, {"fen": fen, "error": str(error)})
+
+        threads = [threading.Thread(target=work, args=(slot,), daemon=True)
+                   for slot in range(min(self.processes, max(1, jobs.qsize())))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def close(self):
+        for engine in self.engines:
+            if engine is not None:
+                engine.quit()
+        self.engines = [None] * self.processes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == "__main__":
+    import argparse as ag
+    parser = ag.ArgumentParser()
+    # command line program controls
+    parser.add_argument("input", help="file with one FEN per line")
+    parser.add_argument("-e", "--engine", dest="engine_path", required=True,
+                        help="path to a UCI engine binary")
+    parser.add_argument("-p", "--processes", dest="processes", type=int, default=None,
+                        help="engine processes, defaults to the CPU budget")
+    parser.add_argument("-c", "--cpus", dest="cpu_budget", type=int, default=None,
+                        help="total threads shared by all engines, defaults to the CPU count")
+    parser.add_argument("--hash", dest="hash_mb", type=int, default=2048,
+                        help="total hash in MB shared by all engines")
+    parser.add_argument("-d", "--depth", dest="depth", type=int, default=None,
+                        help="search depth, defaults to 18 unless a node limit is given")
+    parser.add_argument("-n", "--nodes", dest="nodes", type=int, default=None)
+    parser.add_argument("--store", dest="store_path", default=None,
+                        help="evaluation store to answer from and add results to")
+
+    args = parser.parse_args()
+    if args.depth is None and args.nodes is None:
+        args.depth = 18
+    with open(args.input) as handle:
+        input_fens = [line.strip() for line in handle if line.strip()]
+    eval_store = EvalStore(args.store_path) if args.store_path else None
+    with EnginePool(args.engine_path, args.processes, args.cpu_budget, args.hash_mb) as pool:
+        for evaluation in pool.evaluate(input_fens, depth=args.depth, nodes=args.nodes,
+                                        store=eval_store):
+            sys.stdout.write(json.dumps(evaluation) + "\n")
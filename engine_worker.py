@@ -0,0 +1,138 @@
+import queue
+import threading
+from uci_engine import UCIEngine, EngineError
+
+# runs engine searches on a background thread so the GUI never waits on the engine.
+# Every request gets an id. Submitting a new request or calling cancel stops the running
+# search, and anything reported for an older request is dropped instead of delivered.
+# Messages are read with poll(), as ("info", request_id, info) while a search runs and
+# ("bestmove", request_id, move) or ("error", request_id, message) when it ends. A finished
+# search also reports ("lines", request_id, lines) just before its best move, the last info
+# of each MultiPV line in rank order. notify,
+# if given, is called from the worker thread whenever a message is ready, e.g. to wake up
+# an event loop
+
+# depth the board searches to, results stored for it (e.g. in an opening index) must reach it
+default_depth = 18
+
+class EngineWorker:
+    def __init__(self, path, options=None, depth=default_depth, notify=None):
+        self.path = path
+        self.options = options
+        self.depth = depth
+        self.notify = notify
+        self.engine = None
+        self.requests = queue.Queue()
+        self.messages = queue.Queue()
+        self.lock = threading.Lock()
+        self.current_id = 0  # newest request, results for any other id are stale
+        self.searching_id = None
+        self.multipv = 1  # MultiPV the running engine is set to
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    # starts the engine process in the background without searching, so the first search
+    # does not wait for it. Searches start the engine anyway if this was never called
+    def warm_up(self):
+        self.requests.put("warm_up")
+
+    # starts a search of fen (plus optional moves played from it), returns its request id.
+    # multipv is the number of best lines the engine reports
+    def submit(self, fen, moves=(), depth=None, nodes=None, multipv=1):
+        with self.lock:
+            self.current_id += 1
+            request_id = self.current_id
+            self._stop_search()
+        self.requests.put((request_id, fen, tuple(moves), depth or self.depth, nodes, multipv))
+        return request_id
+
+    # stops the running search without starting a new one
+    def cancel(self):
+        with self.lock:
+            self.current_id += 1
+            self._stop_search()
+
+    def _stop_search(self):
+        if self.searching_id is not None and self.engine is not None:
+            try:
+                self.engine.stop()
+            except EngineError:
+                pass  # the worker thread reports the crash
+
+    def is_current(self, request_id):
+        return request_id == self.current_id
+
+    # messages for the newest request, anything older is discarded here as well in case
+    # it was queued before the request was superseded
+    def poll(self):
+        messages = []
+        while True:
+            try:
+                message = self.messages.get_nowait()
+            except queue.Empty:
+                return messages
+            if self.is_current(message[1]):
+                messages.append(message)
+
+    def close(self):
+        self.cancel()
+        self.requests.put(None)
+
+    def _post(self, message):
+        if self.is_current(message[1]):
+            self.messages.put(message)
+            if self.notify is not None:
+                self.notify()
+
+    def _run(self):
+        while True:
+            request = self.requests.get()
+            # skip straight to the newest request if several queued up
+            while request is not None:
+                try:
+                    newer = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if newer != "warm_up":  # a search queued before it is still wanted
+                    request = newer
+            if request is None:
+                break
+            if request == "warm_up":
+                try:
+                    if self.engine is None or not self.engine.is_alive():
+                        self.engine = UCIEngine(self.path, self.options)
+                        self.multipv = 1
+                except EngineError:
+                    pass  # reported by the first search, which tries again
+                continue
+
+            request_id, fen, moves, depth, nodes, multipv = request
+            if not self.is_current(request_id):
+                continue
+            try:
+                if self.engine is None or not self.engine.is_alive():
+                    self.engine = UCIEngine(self.path, self.options)
+                    self.multipv = 1
+                if multipv != self.multipv:
+                    self.engine.set_option("MultiPV", multipv)
+                    self.multipv = multipv
+                with self.lock:
+                    if not self.is_current(request_id):
+                        continue
+                    self.engine.set_position(fen, moves)
+                    self.engine.start_search(depth=depth, nodes=nodes)
+                    self.searching_id = request_id
+                best_move, lines = self.engine.finish_search(
+                    on_info=lambda info: self._post(("info", request_id, info)))
+                with self.lock:
+                    self.searching_id = None
+                self._post(("lines", request_id, lines))
+                self._post(("bestmove", request_id, best_move))
+            except EngineError as error:
+                with self.lock:
+                    self.searching_id = None
+                self.engine = None  # restarted on the next request
+                self._post(("error", request_id, str(error)))
+
+        if self.engine is not None:
+            self.engine.quit()
@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import chess
+
+# a persistent store of engine results, so a position searched once is never searched
+# again at the same or lower depth, across sessions and by everyone sharing the file.
+# Results are keyed by the normalized FEN (placement, side to move, castling and a legal
+# en passant square, no move clocks) and a deeper result always replaces a shallower one.
+# The SQLite file runs in WAL mode so any number of processes can read while one writes.
+# When it grows past max_entries the least recently used results are dropped. Lookups only
+# read: the time a result was last used is kept in memory and written with the next store,
+# eviction or close, so readers never wait on each other for the write lock
+
+schema = """
+CREATE TABLE IF NOT EXISTS evaluations (
+    position TEXT PRIMARY KEY,
+    best_move TEXT,
+    depth INTEGER NOT NULL,
+    score_cp INTEGER,
+    score_mate INTEGER,
+    pv TEXT,
+    last_used REAL NOT NULL
+)
+"""
+
+# stores a result unless the one already kept for the position is deeper
+upsert = """
+INSERT INTO evaluations (position, best_move, depth, score_cp, score_mate, pv, last_used)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(position) DO UPDATE SET
+    best_move = excluded.best_move, depth = excluded.depth, score_cp = excluded.score_cp,
+    score_mate = excluded.score_mate, pv = excluded.pv, last_used = excluded.last_used
+WHERE excluded.depth >= evaluations.depth
+"""
+
+fields = ("best_move", "depth", "score_cp", "score_mate", "pv")
+
+# the store key of a FEN, or of the position reached by playing moves from it. fen of
+# None is the standard starting position
+def normalize_fen(fen=None, moves=()):
+    board = chess.Board() if fen is None else chess.Board(fen)
+    for move in moves:
+        board.push_uci(move)
+    return " ".join(board.fen().split()[:4])
+
+
+class EvalStore:
+    def __init__(self, path="evaluations.sqlite", max_entries=1000000, check_every=256):
+        self.path = path
+        self.max_entries = max_entries
+        self.check_every = check_every  # stores between size checks, counting rows is not free
+        self.stores_since_check = 0
+        self.local = threading.local()  # sqlite connections may not be shared between threads
+        self.last_used = {}  # position -> time of a lookup not written to the file yet
+        self.last_used_lock = threading.Lock()
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(schema)
+        connection.execute("CREATE INDEX IF NOT EXISTS evaluations_last_used ON evaluations (last_used)")
+        connection.commit()
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    # the stored result for a position as {"best_move", "depth", "score_cp", "score_mate",
+    # "pv"} (missing scores left out), or None if there is none searched to min_depth
+    def lookup(self, fen=None, moves=(), min_depth=0):
+        position = normalize_fen(fen, moves)
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT best_move, depth, score_cp, score_mate, pv FROM evaluations WHERE position = ?",
+            (position,)).fetchone()
+        if row is None or row[1] < min_depth:
+            return None
+        with self.last_used_lock:
+            self.last_used[position] = time.time()
+        return self._result(row)
+
+    # writes the use times of looked up results, inside the caller's transaction
+    def _write_last_used(self, connection):
+        with self.last_used_lock:
+            pending = self.last_used
+            self.last_used = {}
+        if pending:
+            connection.executemany("UPDATE evaluations SET last_used = ? WHERE position = ?",
+                                   [(used, position) for position, used in pending.items()])
+
+    @staticmethod
+    def _result(row):
+        result = {name: value for name, value in zip(fields, row) if value is not None}
+        result["pv"] = result["pv"].split() if result.get("pv") else []
+        return result
+
+    @staticmethod
+    def _row(position, result, last_used):
+        pv = result.get("pv") or []
+        return (position, result.get("best_move"), int(result.get("depth") or 0),
+                result.get("score_cp"), result.get("score_mate"),
+                pv if isinstance(pv, str) else " ".join(pv), last_used)
+
+    # keeps an engine result, e.g. an EnginePool result or {"best_move": ..., "depth": ...}
+    def store(self, fen, result, moves=()):
+        connection = self._connection()
+        with connection:
+            self._write_last_used(connection)
+            connection.execute(upsert, self._row(normalize_fen(fen, moves), result, time.time()))
+        self.stores_since_check += 1
+        if self.stores_since_check >= self.check_every:
+            self.evict()
+
+    # drops the least recently used results until the store is back under max_entries,
+    # with some room to spare so eviction does not run on every store
+    def evict(self):
+        self.stores_since_check = 0
+        connection = self._connection()
+        with connection:
+            self._write_last_used(connection)  # recent lookups must count before dropping
+        count = connection.execute("SELECT COUNT(*) FROM evaluations").fetchone()[0]
+        if count <= self.max_entries:
+            return 0
+        excess = count - int(self.max_entries * 0.9)
+        with connection:
+            connection.execute(
+                "DELETE FROM evaluations WHERE position IN "
+                "(SELECT position FROM evaluations ORDER BY last_used LIMIT ?)", (excess,))
+        return excess
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM evaluations").fetchone()[0]
+
+    # writes every result as a JSON line {"fen", "best_move", "depth", ...}
+    def export(self, path):
+        count = 0
+        with open(path, "w") as handle:
+            for row in self._connection().execute(
+                    "SELECT position, best_move, depth, score_cp, score_mate, pv FROM evaluations"):
+                record = {"fen": row[0]}
+                record.update(self._result(row[1:]))
+                handle.write(json.dumps(record) + "\n")
+                count += 1
+        return count
+
+    # reads JSON lines as written by export (or by the engine pool) in one transaction,
+    # deeper results already in the store are kept
+    def import_records(self, path):
+        now = time.time()
+        rows = []
+        with open(path) as handle:
+            for line in handle:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if "error" in record or not record.get("best_move"):
+                    continue
+                rows.append(self._row(normalize_fen(record["fen"]), record, now))
+        connection = self._connection()
+        with connection:
+            connection.executemany(upsert, rows)
+        self.evict()
+        return len(rows)
+
+    def close(self):
+        if self.last_used:
+            with self._connection() as connection:
+                self._write_last_used(connection)
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+
+if __name__ == "__main__":
+    import argparse as ag
+    parser = ag.ArgumentParser()
+    # command line program controls
+    parser.add_argument("store", help="path to the evaluation store")
+    parser.add_argument("--import", dest="import_path", default=None,
+                        help="JSON lines of engine results to add to the store")
+    parser.add_argument("--export", dest="export_path", default=None,
+                        help="write every stored result to this file as JSON lines")
+    parser.add_argument("-m", "--max-entries", dest="max_entries", type=int, default=1000000)
+
+    args = parser.parse_args()
+    eval_store = EvalStore(args.store, args.max_entries)
+    if args.import_path:
+        print(f"imported {eval_store.import_records(args.import_path)} results")
+    if args.export_path:
+        print(f"exported {eval_store.export(args.export_path)} results")
+    print(f"{len(eval_store)} results in {os.path.abspath(args.store)}")
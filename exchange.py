@@ -0,0 +1,117 @@
+from attack_tables import Bitboards, rook_attacks, bishop_attacks, squares_descending
+
+# static exchange evaluation (SEE) over every square of a position. Each side captures on
+# a square with its least valuable attacker in turn, sliders behind a piece that has just
+# captured join in (x-rays), and either side may stop when going on would lose material.
+# The attackers of all 64 squares are generated once per position and every exchange
+# starts from them. Squares are python-chess numbers and values are in pawns, as in the
+# rest of attack_tables
+
+exchange_values = {"pawn": 1, "knight": 3, "bishop": 3, "rook": 5, "queen": 9, "king": 100}
+# cheapest first, the order pieces join an exchange in
+capture_order = ("pawn", "knight", "bishop", "rook", "queen", "king")
+
+
+class ExchangeMap:
+    def __init__(self, pieces):
+        self.bitboards = pieces if isinstance(pieces, Bitboards) else Bitboards(pieces)
+        bitboards = self.bitboards
+        # direct attackers of both colors on every square, shared by all exchanges
+        self.attackers = [bitboards.attackers(True, square) | bitboards.attackers(False, square)
+                          for square in range(64)]
+        self._results = {}
+
+    # the captures of an exchange on a square started by side, as a list of (origin square,
+    # piece type) in the order they happen, x-ray attackers included. Both sides keep
+    # capturing until one runs out of attackers or the king would be taken
+    def sequence(self, square, side):
+        bitboards = self.bitboards
+        by_type = bitboards.by_type
+        diagonal_sliders = by_type["bishop"] | by_type["queen"]
+        straight_sliders = by_type["rook"] | by_type["queen"]
+        occupied = bitboards.occupied
+        attackers = self.attackers[square]
+        # pawns only move diagonally to capture, they can not be first onto an empty square
+        first_movers = ~by_type["pawn"] if bitboards.types[square] is None else ~0
+        captures = []
+        while True:
+            candidates = attackers & bitboards.by_color[side] & occupied
+            if not captures:
+                candidates &= first_movers
+            if not candidates:
+                return captures
+            for piece_type in capture_order:
+                chosen = candidates & by_type[piece_type]
+                if chosen:
+                    break
+            origin = chosen.bit_length() - 1
+            if piece_type == "king":
+                # the king can not move into a defended square, the sliders its own square
+                # was blocking count as defenders
+                without_king = occupied & ~(1 << origin)
+                defenders = (attackers | (bishop_attacks(square, without_king) & diagonal_sliders) |
+                             (rook_attacks(square, without_king) & straight_sliders))
+                if defenders & bitboards.by_color[not side] & without_king:
+                    return captures
+            captures.append((origin, piece_type))
+            occupied &= ~(1 << origin)
+            # sliders lined up behind the piece that just captured can now reach the square
+            if piece_type != "knight":
+                attackers |= ((bishop_attacks(square, occupied) & diagonal_sliders) |
+                              (rook_attacks(square, occupied) & straight_sliders))
+            side = not side
+
+    # material side wins (positive) or loses (negative) by starting an exchange on a square,
+    # in pawns, with both sides free to stop capturing when it stops paying. None if side
+    # does not attack the square. On an empty square the first move is an occupation
+    def see(self, square, side):
+        key = (square, side)
+        if key not in self._results:
+            captures = self.sequence(square, side)
+            if not captures:
+                self._results[key] = None
+            else:
+                target = self.bitboards.types[square]
+                # gains[n] is what the side making capture n has won if the exchange stops there
+                gains = [exchange_values[target] if target is not None else 0]
+                for index in range(1, len(captures)):
+                    gains.append(exchange_values[captures[index - 1][1]] - gains[-1])
+                # a side stops capturing whenever continuing leaves it worse off
+                for index in range(len(gains) - 1, 0, -1):
+                    gains[index - 1] = -max(-gains[index - 1], gains[index])
+                self._results[key] = gains[0]
+        return self._results[key]
+
+    # white's material result of the fight for each square, in pawns. On an occupied square
+    # it is what the opponent of the piece there wins by capturing it (zero if capturing
+    # does not pay), positive when white wins material. On an empty square it is what a
+    # side would lose by moving a piece there, black's loss counting positive. Kings are
+    # never captured, a king in check is not material to win
+    def contested_squares(self):
+        bitboards = self.bitboards
+        results = {}
+        for square in range(64):
+            if not self.attackers[square] or bitboards.types[square] == "king":
+                continue
+            if bitboards.types[square] is not None:
+                owner = bool(bitboards.by_color[True] >> square & 1)
+                result = self.see(square, not owner)
+                if result is None or result <= 0:
+                    continue
+                results[square] = result if not owner else -result
+            else:
+                white = self.see(square, True)
+                black = self.see(square, False)
+                value = min(white or 0, 0) - min(black or 0, 0)
+                if value:
+                    results[square] = value
+        return results
+
+    # squares of side's pieces other than the king that the opponent wins material by capturing
+    def hanging(self, side):
+        hanging = []
+        for square in squares_descending(self.bitboards.by_color[side] & ~self.bitboards.by_type["king"]):
+            result = self.see(square, not side)
+            if result is not None and result > 0:
+                hanging.append(square)
+        return hanging
@@ -0,0 +1,153 @@
+import sys
+import json
+import chess
+from piece_methods import Position, PositionAnalysis, uci_to_display_move, display_coordinates_to_square
+from piece_methods import board_keys
+from attack_maps import AttackMaps
+from uci_engine import UCIEngine
+
+# explains the engine's candidate moves by what they do to the analysis layers. The engine
+# is asked for its top lines with MultiPV, then every candidate move and the first plies of
+# its principal variation are played on one set of attack maps: the maps of the position
+# being explained are built once and each ply only updates the squares it touches, then the
+# line is taken back before the next candidate. Positions reached by more than one line are
+# analysed once, through the analysis cache. Each position along a line is compared with
+# the starting one, giving per layer the change in total weight and the squares that changed
+
+weight_layers = ("attack_white", "attack_black", "struggle")
+square_layers = ("king_attackers_white", "king_attackers_black", "restricted_white", "restricted_black")
+
+# the compared layers of the position the attack maps are on. King attackers are empty
+# for a side whose opponent has no king
+def layer_snapshot(attack_maps):
+    position = attack_maps.position
+    analysis = PositionAnalysis(position)
+    snapshot = {"attack_white": dict(attack_maps.attack_color_coding(True)),
+                "attack_black": dict(attack_maps.attack_color_coding(False)),
+                "struggle": dict(attack_maps.board_struggle())}
+    for side, name in ((True, "white"), (False, "black")):
+        if position.king("black" if side else "white") is not None:
+            snapshot[f"king_attackers_{name}"] = set(analysis.king_attackers(side))
+        else:
+            snapshot[f"king_attackers_{name}"] = set()
+        snapshot[f"restricted_{name}"] = set(analysis.restricted_pieces(side))
+    return snapshot
+
+# how the layers changed from one snapshot to another, squares as names such as "e4".
+# Weight layers give the change in total weight and per changed square, the other layers
+# the squares added and removed
+def layer_diff(before, after):
+    diff = {}
+    for layer in weight_layers:
+        old, new = before[layer], after[layer]
+        squares = {}
+        for key in sorted((set(old) | set(new)) & board_keys.keys()):
+            change = new.get(key, 0.0) - old.get(key, 0.0)
+            if abs(change) > 1e-9:
+                squares[display_coordinates_to_square(key)] = round(change, 3)
+        diff[layer] = {"total": round(sum(new.values()) - sum(old.values()), 3), "squares": squares}
+    for layer in square_layers:
+        diff[layer] = {"added": sorted(display_coordinates_to_square(key) for key in after[layer] - before[layer]),
+                       "removed": sorted(display_coordinates_to_square(key) for key in before[layer] - after[layer])}
+    return diff
+
+# the candidates of a search with their layer changes, in the engine's order. lines are
+# the engine's MultiPV infos (with "pv" and a score). plies is how far along each PV the
+# changes are followed, the first ply being the candidate move itself
+def explain_lines(fen, lines, plies=3):
+    py_board = chess.Board(fen)
+    attack_maps = AttackMaps(Position.from_fen(fen))
+    root = layer_snapshot(attack_maps)
+    candidates = []
+    for rank, line in enumerate(lines, 1):
+        pv = line.get("pv", [])
+        if not pv:
+            continue
+        candidate = {"rank": rank, "move": pv[0], "score_cp": line.get("score_cp"),
+                     "score_mate": line.get("score_mate"), "depth": line.get("depth"), "plies": []}
+        line_board = py_board.copy(stack=False)
+        undo_moves = []
+        for uci_move in pv[:max(1, plies)]:
+            move = chess.Move.from_uci(uci_move)
+            if move not in line_board.legal_moves:
+                break  # a PV from an older position, the rest does not apply
+            san = line_board.san(move)
+            line_board.push(move)
+            undo_moves.append(attack_maps.apply_move(*uci_to_display_move(uci_move)))
+            candidate["plies"].append({"move": uci_move, "san": san,
+                                       "diff": layer_diff(root, layer_snapshot(attack_maps))})
+        # back to the position being explained for the next candidate
+        for undo in reversed(undo_moves):
+            attack_maps.unapply_move(undo)
+        if candidate["plies"]:
+            candidate["san"] = candidate["plies"][0]["san"]
+            candidates.append(candidate)
+    return candidates
+
+def score_text(candidate):
+    if candidate.get("score_mate") is not None:
+        return f"mate {candidate['score_mate']}"
+    return f"{(candidate.get('score_cp') or 0) / 100:+.2f}"
+
+# the biggest changes of a weight layer, e.g. "e5 +0.9, d4 +0.6"
+def top_squares(layer_change, count=3):
+    squares = sorted(layer_change["squares"].items(), key=lambda item: (-abs(item[1]), item[0]))
+    return ", ".join(f"{square} {change:+.1f}" for square, change in squares[:count])
+
+# short lines of text ranking the candidates, for the console and the board's overlay
+def format_explanation(candidates):
+    text = []
+    for candidate in candidates:
+        first = candidate["plies"][0]["diff"]
+        text.append(f"{candidate['rank']}. {candidate['san']} ({score_text(candidate)})"
+                    f"  control w {first['attack_white']['total']:+.1f} b {first['attack_black']['total']:+.1f}"
+                    f"  struggle {first['struggle']['total']:+.1f}")
+        if first["struggle"]["squares"]:
+            text.append(f"     squares {top_squares(first['struggle'])}")
+        for layer, label in (("king_attackers_white", "white king attackers"),
+                             ("king_attackers_black", "black king attackers"),
+                             ("restricted_white", "white restricted"),
+                             ("restricted_black", "black restricted")):
+            if first[layer]["added"] or first[layer]["removed"]:
+                text.append(f"     {label} " + " ".join([f"+{square}" for square in first[layer]["added"]] +
+                                                      [f"-{square}" for square in first[layer]["removed"]]))
+        if len(candidate["plies"]) > 1:
+            last = candidate["plies"][-1]["diff"]
+            sans = " ".join(ply["san"] for ply in candidate["plies"])
+            text.append(f"     after {sans}: struggle {last['struggle']['total']:+.1f}")
+    return text
+
+# searches fen for the top lines and explains them, for use without the board
+def explain_position(engine, fen, lines=3, depth=18, plies=3):
+    engine.set_option("MultiPV", lines)
+    engine.set_position(fen)
+    best_move, infos = engine.search(depth=depth)
+    return explain_lines(fen, infos, plies)
+
+
+if __name__ == "__main__":
+    import argparse as ag
+    parser = ag.ArgumentParser()
+    # command line program controls
+    parser.add_argument("fen", help="position to explain")
+    parser.add_argument("-e", "--engine", dest="engine_path", required=True,
+                        help="path to a UCI engine binary")
+    parser.add_argument("-k", "--lines", dest="lines", type=int, default=3,
+                        help="candidate moves asked from the engine (MultiPV)")
+    parser.add_argument("-d", "--depth", dest="depth", type=int, default=18)
+    parser.add_argument("-p", "--plies", dest="plies", type=int, default=3,
+                        help="plies of each line followed, the candidate move included")
+    parser.add_argument("--json", dest="json", action="store_true",
+                        help="print the full diffs as JSON instead of the ranked summary")
+
+    args = parser.parse_args()
+    uci_engine = UCIEngine(args.engine_path)
+    try:
+        explained = explain_position(uci_engine, args.fen, args.lines, args.depth, args.plies)
+    finally:
+        uci_engine.quit()
+    if args.json:
+        json.dump(explained, sys.stdout, indent=1)
+        sys.stdout.write("\n")
+    else:
+        print("\n".join(format_explanation(explained)))
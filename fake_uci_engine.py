@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+import sys
+import time
+import threading
+import chess
+
+# a stand-in UCI engine for exercising the engine code without a real engine binary.
+# It plays legal moves ordered by a one-ply material count, reports one info line per
+# depth and answers stop, setoption MultiPV and the usual handshake. Searches are
+# deterministic so results can be compared between runs.
+# options useful for testing: "DepthDelay" (ms slept per depth) and "CrashAfter"
+# (exit without a reply after that many searches, to test restarts)
+
+piece_values = {chess.PAWN: 100, chess.KNIGHT: 300, chess.BISHOP: 300,
+                chess.ROOK: 500, chess.QUEEN: 900, chess.KING: 0}
+
+def material(board, color):
+    return sum(piece_values[piece.piece_type] * (1 if piece.color == color else -1)
+               for piece in board.piece_map().values())
+
+# legal moves with their score for the side to move, best first
+def ranked_moves(board):
+    color = board.turn
+    scored = []
+    for move in board.legal_moves:
+        board.push(move)
+        scored.append((material(board, color), move.uci()))
+        board.pop()
+    scored.sort(key=lambda item: (-item[0], item[1]))
+    return scored
+
+
+class FakeEngine:
+    def __init__(self):
+        self.board = chess.Board()
+        self.options = {"MultiPV": 1, "DepthDelay": 0, "CrashAfter": 0}
+        self.searches = 0
+        self.stop_event = threading.Event()
+        self.search_thread = None
+        self.output_lock = threading.Lock()
+
+    def say(self, line):
+        with self.output_lock:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+
+    def search(self, depth):
+        ranked = ranked_moves(self.board)
+        lines = ranked[:max(1, int(self.options["MultiPV"]))]
+        delay = int(self.options["DepthDelay"]) / 1000
+        for current_depth in range(1, depth + 1):
+            if self.stop_event.is_set():
+                break
+            for rank, (score, uci) in enumerate(lines, start=1):
+                pv = self.principal_variation(uci, current_depth)
+                self.say(f"info depth {current_depth} multipv {rank} score cp {score} "
+                         f"nodes {current_depth * 1000} pv {' '.join(pv)}")
+            if delay:
+                time.sleep(delay)
+        self.say(f"bestmove {lines[0][1] if lines else '(none)'}")
+
+    # the best reply to each move, a few plies deep
+    def principal_variation(self, first_move, length):
+        board = self.board.copy(stack=False)
+        pv = [first_move]
+        board.push_uci(first_move)
+        while len(pv) < min(length, 4):
+            ranked = ranked_moves(board)
+            if not ranked:
+                break
+            pv.append(ranked[0][1])
+            board.push_uci(ranked[0][1])
+        return pv
+
+    def handle(self, line):
+        tokens = line.split()
+        if not tokens:
+            return True
+        command = tokens[0]
+        if command == "uci":
+            self.say("id name fake_uci_engine")
+            self.say("option name MultiPV type spin default 1 min 1 max 500")
+            self.say("uciok")
+        elif command == "isready":
+            self.say("readyok")
+        elif command == "setoption" and "name" in tokens and "value" in tokens:
+            name = " ".join(tokens[tokens.index("name") + 1:tokens.index("value")])
+            self.options[name] = " ".join(tokens[tokens.index("value") + 1:])
+        elif command == "ucinewgame":
+            self.board = chess.Board()
+        elif command == "position":
+            moves_at = tokens.index("moves") if "moves" in tokens else len(tokens)
+            if tokens[1] == "startpos":
+                self.board = chess.Board()
+            else:
+                self.board = chess.Board(" ".join(tokens[2:moves_at]))
+            for move in tokens[moves_at + 1:]:
+                self.board.push_uci(move)
+        elif command == "go":
+            self.searches += 1
+            crash_after = int(self.options["CrashAfter"])
+            if crash_after and self.searches >= crash_after:
+                return False
+            depth = int(tokens[tokens.index("depth") + 1]) if "depth" in tokens else 10
+            if "nodes" in tokens:
+                depth = min(depth, max(1, int(tokens[tokens.index("nodes") + 1]) // 1000))
+            self.stop_event.clear()
+            self.search_thread = threading.Thread(target=self.search, args=(depth,))
+            self.search_thread.start()
+        elif command == "stop":
+            self.stop_event.set()
+            if self.search_thread is not None:
+                self.search_thread.join()
+        elif command == "quit":
+            return False
+        return True
+
+
+if __name__ == "__main__":
+    engine = FakeEngine()
+    for input_line in sys.stdin:
+        if not engine.handle(input_line):
+            break
+    engine.stop_event.set()
@@ -0,0 +1,223 @@
+import sys
+import json
+import chess
+import chess.pgn
+from piece_methods import Position, PositionAnalysis, board_keys
+from attack_maps import AttackMaps
+
+# control over whole games. Games are streamed from a PGN one move at a time, each ply
+# updates the attack maps incrementally and yields a time series record, and running
+# totals build heatmaps of the contested squares and of each side's control. Nothing is
+# kept per ply, so memory does not grow with the length of a game or of the database.
+# Over a database the totals are also kept per opening
+
+# per-ply fields summed into the aggregates
+series_fields = ("white_control", "black_control", "balance", "contested_squares",
+                 "king_pressure_white", "king_pressure_black",
+                 "restricted_white", "restricted_black")
+
+def empty_grid():
+    return [[0.0]*8, [0.0]*8, [0.0]*8, [0.0]*8, [0.0]*8, [0.0]*8, [0.0]*8, [0.0]*8]
+
+# the time series values of the current position. king pressure counts the pieces
+# attacking the squares around the enemy king, restricted the pieces with few safe moves
+def ply_record(attack_maps):
+    white = attack_maps.attack_color_coding(True)
+    black = attack_maps.attack_color_coding(False)
+    struggle = attack_maps.board_struggle()
+    record = {"white_control": sum(white.values()), "black_control": sum(black.values()),
+              "balance": sum(struggle.values()),
+              "contested_squares": sum(1 for square in struggle
+                                       if square in white and square in black)}
+    position = attack_maps.position
+    analysis = PositionAnalysis(position)
+    for side, name in ((True, "white"), (False, "black")):
+        if position.king("black" if side else "white") is not None:
+            record[f"king_pressure_{name}"] = len(analysis.king_attackers(side))
+        else:
+            record[f"king_pressure_{name}"] = 0
+        record[f"restricted_{name}"] = len(analysis.restricted_pieces(side))
+    return record
+
+
+# running totals of plies, as sums so aggregates of several games can be merged
+class ControlAggregate:
+    def __init__(self):
+        self.games = 0
+        self.plies = 0
+        self.struggle = empty_grid()  # summed white minus black weight per square
+        self.control = {True: empty_grid(), False: empty_grid()}  # summed weight per side
+        self.totals = {field: 0.0 for field in series_fields}
+
+    def add_ply(self, attack_maps, record):
+        self.plies += 1
+        for field in series_fields:
+            self.totals[field] += record[field]
+        for square, value in attack_maps.board_struggle().items():
+            if square in board_keys:
+                x, y = board_keys[square]
+                self.struggle[x][y] += value
+        for side in (True, False):
+            grid = self.control[side]
+            for square, value in attack_maps.attack_color_coding(side).items():
+                if square in board_keys:
+                    x, y = board_keys[square]
+                    grid[x][y] += value
+
+    def merge(self, other):
+        self.games += other.games
+        self.plies += other.plies
+        for field in series_fields:
+            self.totals[field] += other.totals[field]
+        for mine, theirs in ((self.struggle, other.struggle),
+                             (self.control[True], other.control[True]),
+                             (self.control[False], other.control[False])):
+            for x in range(8):
+                for y in range(8):
+                    mine[x][y] += theirs[x][y]
+
+    # heatmaps are [x][y] in display coordinates like the other analysis arrays, the
+    # means are per ply
+    def to_dict(self):
+        plies = self.plies or 1
+        return {"games": self.games, "plies": self.plies,
+                "means": {field: self.totals[field] / plies for field in series_fields},
+                "struggle_sum": self.struggle,
+                "struggle_mean": [[value / plies for value in column] for column in self.struggle],
+                "white_control_mean": [[value / plies for value in column] for column in self.control[True]],
+                "black_control_mean": [[value / plies for value in column] for column in self.control[False]]}
+
+
+# the opening a game is filed under: its ECO code and name when the PGN has them,
+# otherwise its first moves
+def opening_key(headers, first_moves, group_by):
+    if group_by == "eco" and headers.get("ECO"):
+        return headers["ECO"]
+    if group_by == "opening" and headers.get("Opening"):
+        return " ".join(part for part in (headers.get("ECO"), headers["Opening"],
+                                          headers.get("Variation")) if part)
+    return " ".join(first_moves) or "(no moves)"
+
+
+# a python-chess PGN visitor that analyses the mainline while the game is read. on_ply,
+# if given, receives each ply's record as it is produced
+class GameControlVisitor(chess.pgn.BaseVisitor):
+    def __init__(self, on_ply=None, group_by="eco", opening_plies=6):
+        self.on_ply = on_ply
+        self.group_by = group_by
+        self.opening_plies = opening_plies
+
+    def begin_game(self):
+        self.headers = {}
+        self.attack_maps = None
+        self.aggregate = ControlAggregate()
+        self.aggregate.games = 1
+        self.first_moves = []
+        self.ply = 0
+        self.error = None
+
+    def visit_header(self, tagname, tagvalue):
+        self.headers[tagname] = tagvalue
+
+    def begin_variation(self):
+        return chess.pgn.SKIP  # only the moves actually played count
+
+    def visit_board(self, board):
+        if self.attack_maps is None and self.error is None:
+            # the starting position, later calls follow each move and are already applied
+            self.attack_maps = AttackMaps(Position.from_fen(board.fen()))
+            self._record(None)
+
+    def visit_move(self, board, move):
+        if self.error is not None or self.attack_maps is None:
+            return
+        if len(self.first_moves) < self.opening_plies:
+            self.first_moves.append(move.uci())
+        from_x, from_y = move.from_square % 8, 7 - move.from_square // 8
+        to_x, to_y = move.to_square % 8, 7 - move.to_square // 8
+        prom_type = chess.piece_name(move.promotion) if move.promotion else "empty"
+        self.attack_maps.apply_move(from_x, from_y, to_x, to_y, prom_type)
+        self.ply += 1
+        self._record(move.uci())
+
+    def _record(self, uci_move):
+        try:
+            record = ply_record(self.attack_maps)
+        except Exception as error:
+            # e.g. a set-up position the analysis cannot handle, the game is skipped
+            self.error = repr(error)
+            return
+        self.aggregate.add_ply(self.attack_maps, record)
+        if self.on_ply is not None:
+            self.on_ply(dict(record, ply=self.ply, move=uci_move))
+
+    def handle_error(self, error):
+        self.error = repr(error)
+
+    # (opening key, aggregate of the game, error or None)
+    def result(self):
+        return (opening_key(self.headers, self.first_moves, self.group_by),
+                self.aggregate, self.error)
+
+
+# streams every game of a PGN file. series_handle, if given, receives one JSON line per
+# ply. Returns (aggregate over all games, {opening: aggregate}, number of skipped games)
+def analyze_games(pgn_handle, series_handle=None, group_by="eco", opening_plies=6):
+    overall = ControlAggregate()
+    openings = {}
+    skipped = 0
+    game_number = 0
+
+    def write_ply(record):
+        record["game"] = game_number
+        series_handle.write(json.dumps(record) + "\n")
+
+    visitor = GameControlVisitor(write_ply if series_handle is not None else None,
+                                 group_by, opening_plies)
+    while True:
+        result = chess.pgn.read_game(pgn_handle, Visitor=lambda: visitor)
+        if result is None:
+            break
+        opening, aggregate, error = result
+        if error is not None:
+            print(f"game {game_number}: skipped, {error}", file=sys.stderr)
+            skipped += 1
+        else:
+            overall.merge(aggregate)
+            if group_by != "none":
+                openings.setdefault(opening, ControlAggregate()).merge(aggregate)
+        game_number += 1
+    return overall, openings, skipped
+
+
+if __name__ == "__main__":
+    import argparse as ag
+    parser = ag.ArgumentParser()
+    # command line program controls
+    parser.add_argument("input", help="PGN file with one or more games")
+    parser.add_argument("-o", "--output", dest="output", default="-",
+                        help="JSON file for the heatmaps and averages ('-' for stdout)")
+    parser.add_argument("-s", "--series", dest="series", default=None,
+                        help="write the per-ply time series to this file as JSON lines")
+    parser.add_argument("-g", "--group-by", dest="group_by", default="eco",
+                        choices=["eco", "opening", "moves", "none"],
+                        help="how games are grouped into openings, falls back to the first moves")
+    parser.add_argument("--opening-plies", dest="opening_plies", type=int, default=6,
+                        help="first moves used as the opening when grouping by moves")
+
+    args = parser.parse_args()
+    series_out = open(args.series, "w") if args.series else None
+    with open(args.input, errors="replace") as pgn_in:
+        totals, by_opening, skipped_games = analyze_games(pgn_in, series_out, args.group_by,
+                                                          args.opening_plies)
+    if series_out is not None:
+        series_out.close()
+
+    report = {"overall": totals.to_dict(), "skipped_games": skipped_games,
+              "openings": {name: aggregate.to_dict() for name, aggregate in sorted(by_opening.items())}}
+    if args.output == "-":
+        json.dump(report, sys.stdout)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as handle:
+            json.dump(report, handle)
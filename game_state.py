@@ -0,0 +1,49 @@
+import chess
+from piece_methods import Position, new_game_fen
+
+# the authoritative game: the Position drawn and analysed by the board, plus the moves
+# played since the last setup change. The engine is sent the root position and this
+# move list, so it never needs to be asked for a FEN and castling and en passant rights
+# survive every move. A python-chess board mirrors the position to check move legality
+# locally; setup changes (dropped pieces, switching sides, illegal moves) start a new root
+class GameState:
+    def __init__(self, fen=new_game_fen):
+        self.position = Position.from_fen(fen)
+        self.reset_root()
+
+    # makes the current position the root of a new, empty move list
+    def reset_root(self):
+        self.root_fen = self.position.fen()
+        self.moves = []
+        self.py_board = chess.Board(self.root_fen)
+
+    # records a move already applied to the position with make_move. Legal moves extend the
+    # move list, anything else (e.g. moving the side not to play) re-roots at the result
+    def record_move(self, uci_move):
+        try:
+            move = chess.Move.from_uci(uci_move)
+        except ValueError:
+            move = None
+        if move is not None and move in self.py_board.legal_moves:
+            self.py_board.push(move)
+            self.moves.append(uci_move)
+        else:
+            self.reset_root()
+
+    def switch_side(self):
+        self.position.white_to_move = not self.position.white_to_move
+        self.position.en_passant = None
+        self.reset_root()
+
+    def add_piece(self, piece):
+        self.position.add_piece(piece)
+        self.reset_root()
+
+    # (fen, moves) for the engine's position command, fen is None for the standard
+    # starting position so the engine receives "position startpos moves ..."
+    def engine_position(self):
+        root = None if self.root_fen == new_game_fen else self.root_fen
+        return root, list(self.moves)
+
+    def fen(self):
+        return self.position.fen()
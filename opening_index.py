@@ -0,0 +1,344 @@
+import os
+import sys
+import mmap
+import time
+import struct
+from bisect import bisect_left
+from collections import deque
+from piece_methods import (Position, PositionAnalysis, square_display_coordinates,
+                           zobrist_black_to_move, zobrist_castling)
+from attack_tables import squares_descending
+from engine_worker import default_depth
+
+# a precomputed index of the positions that keep coming up in openings, with their
+# analysis layers and an engine evaluation. A build step walks a PGN corpus, keeps every
+# position seen more than min_count times in the first plies of the games and writes one
+# binary file: a header, then two tables of sorted 64-bit keys each followed by one
+# fixed-size record per key in the same order. Opening the file only maps it into memory,
+# nothing is parsed, so the board and the batch tools can open it at startup for free and
+# every process on the machine shares the same pages of the page cache. A lookup is a
+# binary search over the mapped keys, then only the fields asked for are unpacked.
+#
+#   python opening_index.py games.pgn openings.idx -n 5 -p 24 -e stockfish -d 18
+#
+# The layers only depend on the pieces, their table is keyed by the placement key of the
+# position, so the side to move or the castling rights never make a layer lookup miss.
+# Evaluations are keyed by index_key, the zobrist hash of the position without its en
+# passant square: a board that made a double pawn push keeps an en passant square the FEN
+# of the same position leaves out when no capture is possible
+
+magic = b"CTOPIDX\x00"
+version = 2
+# magic, version, layer and evaluation record sizes, number of layer and evaluation
+# records, then the offsets of the layer keys, layer records, evaluation keys and
+# evaluation records
+header = struct.Struct("<8sIHHQQQQQQ")
+# flags, king attackers and restricted pieces of each side as bitboards of python-chess
+# squares, attack weights of white then black by python-chess square in units of 0.05
+# (every attack weight is a multiple of it)
+layer_record = struct.Struct("<B7x4Q128H")
+weight_unit = 0.05
+# offsets of the fields inside a layer record, so only those bytes are unpacked
+bitboards_offset = 8  # king attackers white, black, restricted white, black
+weights_offset = 40  # white, then black 128 bytes further
+flags_field = struct.Struct("<B")
+bitboard_field = struct.Struct("<Q")
+weights_field = struct.Struct("<64H")
+# score (centipawns or mate in moves), times the position was seen, search depth, flags
+# and best move as UCI padded with NUL bytes
+evaluation_record = struct.Struct("<iIHB5s")
+
+# layer record flags
+no_king_attackers_white = 4  # the side has no enemy king to attack
+no_king_attackers_black = 8
+# evaluation record flags
+evaluated = 1
+mate_score = 2
+
+if sys.byteorder != "little":
+    raise Exception("opening index files are little-endian and mapped as they are")
+
+# the evaluation key of a Position
+def index_key(position):
+    key = position.placement_key
+    if not position.white_to_move:
+        key ^= zobrist_black_to_move
+    for symbol in position.castling:
+        key ^= zobrist_castling[symbol]
+    return key
+
+def fen_key(fen):
+    return index_key(Position.from_fen(fen))
+
+# position of key in a mapped table of sorted keys, -1 if it is not there. Searches the
+# keys in place, no container is built
+def search_keys(keys, key):
+    index = bisect_left(keys, key)
+    if index < len(keys) and keys[index] == key:
+        return index
+    return -1
+
+
+class OpeningIndex:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as handle:
+            # a shared, read-only mapping: the file stays on disk and is paged in on demand
+            self.map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        (file_magic, file_version, layer_size, evaluation_size, layer_count, evaluation_count,
+         layer_keys_offset, self.layers_offset, evaluation_keys_offset,
+         self.evaluations_offset) = header.unpack_from(self.map, 0)
+        if (file_magic != magic or file_version != version or layer_size != layer_record.size or
+                evaluation_size != evaluation_record.size):
+            self.map.close()
+            raise Exception(f"{path} is not an opening index of version {version}")
+        if (self.layers_offset + layer_count * layer_record.size > len(self.map) or
+                self.evaluations_offset + evaluation_count * evaluation_record.size > len(self.map)):
+            self.map.close()
+            raise Exception(f"{path} is truncated")
+        view = memoryview(self.map)
+        self.layer_keys = view[layer_keys_offset:layer_keys_offset + 8 * layer_count].cast("Q")
+        self.evaluation_keys = view[evaluation_keys_offset:evaluation_keys_offset + 8 * evaluation_count].cast("Q")
+        view.release()
+
+    # number of positions, one per evaluation key
+    def __len__(self):
+        return len(self.evaluation_keys)
+
+    # whether the layers of a placement key are indexed
+    def has_layers(self, placement_key):
+        return search_keys(self.layer_keys, placement_key) >= 0
+
+    # how often the build corpus reached the position of an index_key, 0 if it is not indexed
+    def seen(self, key):
+        index = search_keys(self.evaluation_keys, key)
+        if index < 0:
+            return 0
+        return struct.unpack_from("<I", self.map, self.evaluations_offset + index * evaluation_record.size + 4)[0]
+
+    # the stored engine result for an index_key like EvalStore.lookup gives it, {"best_move",
+    # "depth", "score_cp" or "score_mate", "pv"}, or None if there is none searched to min_depth
+    def evaluation(self, key, min_depth=0):
+        index = search_keys(self.evaluation_keys, key)
+        if index < 0:
+            return None
+        score, count, depth, flags, best_move = evaluation_record.unpack_from(
+            self.map, self.evaluations_offset + index * evaluation_record.size)
+        if not flags & evaluated or depth < min_depth:
+            return None
+        best_move = best_move.rstrip(b"\x00").decode()
+        result = {"best_move": best_move or None, "depth": depth, "pv": [best_move] if best_move else []}
+        result["score_mate" if flags & mate_score else "score_cp"] = score
+        return result
+
+    # one analysis layer of a placement key in the form PositionAnalysis returns it, with
+    # squares as "xy" display keys: "attack" and "struggle" are {square: weight},
+    # "king_attackers" a set and "restricted" a list of squares. None if the placement is
+    # not indexed or, for king attackers, if the opponent has no king. Weights come out as
+    # the nearest float to their decimal value, a sum of weights computed by
+    # PositionAnalysis can be off by a rounding error
+    def layer(self, placement_key, name, side=True):
+        index = search_keys(self.layer_keys, placement_key)
+        if index < 0:
+            return None
+        offset = self.layers_offset + index * layer_record.size
+        if name == "attack":
+            weights = weights_field.unpack_from(self.map, offset + weights_offset + (0 if side else 128))
+            return {square_display_coordinates[square]: units * 5 / 100
+                    for square, units in enumerate(weights) if units}
+        if name == "struggle":
+            white = weights_field.unpack_from(self.map, offset + weights_offset)
+            black = weights_field.unpack_from(self.map, offset + weights_offset + 128)
+            # white minus black like board_struggle, from the decoded weights
+            return {square_display_coordinates[square]: white[square] * 5 / 100 - black[square] * 5 / 100
+                    for square in range(64) if white[square] or black[square]}
+        if name == "king_attackers":
+            flags = flags_field.unpack_from(self.map, offset)[0]
+            if flags & (no_king_attackers_white if side else no_king_attackers_black):
+                return None
+            bitboard = bitboard_field.unpack_from(self.map, offset + bitboards_offset + (0 if side else 8))[0]
+            return {square_display_coordinates[square] for square in squares_descending(bitboard)}
+        if name == "restricted":
+            bitboard = bitboard_field.unpack_from(self.map, offset + bitboards_offset + (16 if side else 24))[0]
+            # ascending squares, the order the pieces are iterated in by restricted_pieces
+            return [square_display_coordinates[square]
+                    for square in reversed(list(squares_descending(bitboard)))]
+        raise Exception(f"unknown index layer {name}")
+
+    def close(self):
+        # the map cannot close while a view of it is alive
+        self.layer_keys.release()
+        self.evaluation_keys.release()
+        self.map.close()
+
+
+# the index keys, placement keys and FENs of the first max_plies plies of each game, runs
+# in a worker
+def game_positions(games, max_plies):
+    from analyze_corpus import game_fens
+    positions = []
+    for game_text in games:
+        for fen in game_fens(game_text)[:max_plies + 1]:
+            position = Position.from_fen(fen)
+            positions.append((index_key(position), position.placement_key, fen))
+    return positions
+
+# the layer fields of a record for each FEN, (flags, four bitboards, 128 weights)
+def analysis_fields(fens):
+    results = []
+    for fen in fens:
+        position = Position.from_fen(fen)
+        analysis = PositionAnalysis(position)
+        flags = 0
+        bitboards = []
+        weights = []
+        for side in (True, False):
+            if position.king("black" if side else "white") is None:
+                flags |= no_king_attackers_white if side else no_king_attackers_black
+                bitboards.append(0)
+            else:
+                bitboards.append(squares_bitboard(analysis.king_attackers(side)))
+        for side in (True, False):
+            bitboards.append(squares_bitboard(analysis.restricted_pieces(side)))
+        for side in (True, False):
+            attack = analysis.attack_color_coding(side)
+            weights.extend(round(attack.get(square_display_coordinates[square], 0.0) / weight_unit)
+                           for square in range(64))
+        results.append((flags, bitboards, weights))
+    return results
+
+def squares_bitboard(display_squares):
+    bitboard = 0
+    for square in display_squares:
+        bitboard |= 1 << (int(square[0]) + (7 - int(square[1])) * 8)
+    return bitboard
+
+# writes the index next to path and moves it in place, processes that mapped the old file
+# keep reading it until they reopen. Entries are (key, packed record) in any order, layers
+# by placement key and evaluations by index_key
+def write_index(path, layer_entries, evaluation_entries):
+    layer_entries = sorted(layer_entries)
+    evaluation_entries = sorted(evaluation_entries)
+    layer_keys_offset = header.size
+    layers_offset = layer_keys_offset + 8 * len(layer_entries)
+    evaluation_keys_offset = layers_offset + layer_record.size * len(layer_entries)
+    evaluations_offset = evaluation_keys_offset + 8 * len(evaluation_entries)
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as handle:
+        handle.write(header.pack(magic, version, layer_record.size, evaluation_record.size,
+                                 len(layer_entries), len(evaluation_entries), layer_keys_offset,
+                                 layers_offset, evaluation_keys_offset, evaluations_offset))
+        for entries in (layer_entries, evaluation_entries):
+            handle.write(struct.pack(f"<{len(entries)}Q", *(key for key, packed in entries)))
+            for key, packed in entries:
+                handle.write(packed)
+    os.replace(temporary_path, path)
+
+# builds the index of every position seen more than min_count times within the first
+# max_plies plies of the games in the PGN files. With an engine each kept position is also
+# searched to depth, through an EvalStore when store_path is given. Returns the number of
+# positions written
+def build_index(pgn_paths, output_path, min_count=1, max_plies=24, workers=None, chunk_size=64,
+                engine_path=None, depth=default_depth, engine_processes=None, store_path=None):
+    # only the build needs the corpus reader and the engines
+    import multiprocessing as mp
+    from analyze_corpus import read_pgn_games, chunked
+    workers = workers or mp.cpu_count()
+    max_in_flight = 2 * workers
+    start = time.perf_counter()
+    counts = {}
+    kept = {}  # index key -> FEN, taken when a position passes min_count
+    placements = {}  # placement key -> FEN of the first kept position with that placement
+    games = 0
+
+    def count(positions):
+        for key, placement_key, fen in positions:
+            seen = counts.get(key, 0) + 1
+            counts[key] = seen
+            if seen == min_count + 1:
+                kept[key] = fen
+                placements.setdefault(placement_key, fen)
+
+    with mp.Pool(workers) as pool:
+        for pgn_path in pgn_paths:
+            with open(pgn_path, "r", errors="replace") as in_handle:
+                pending = deque()
+                for chunk in chunked(read_pgn_games(in_handle), chunk_size):
+                    pending.append(pool.apply_async(game_positions, (chunk, max_plies)))
+                    games += len(chunk)
+                    while len(pending) >= max_in_flight:
+                        count(pending.popleft().get())
+                while pending:
+                    count(pending.popleft().get())
+        print(f"{games} games, {len(counts)} positions, {len(kept)} seen more than {min_count} times",
+              file=sys.stderr)
+
+        placement_keys = list(placements)
+        layer_fields = []
+        for result in [pool.apply_async(analysis_fields, (chunk,))
+                       for chunk in chunked([placements[key] for key in placement_keys], chunk_size)]:
+            layer_fields.extend(result.get())
+
+    keys = list(kept)
+    fens = [kept[key] for key in keys]
+
+    evaluations = [{}] * len(fens)
+    if engine_path is not None and fens:
+        from engine_pool import EnginePool
+        from eval_store import EvalStore
+        store = EvalStore(store_path) if store_path else None
+        with EnginePool(engine_path, processes=engine_processes) as engine_pool:
+            evaluations = engine_pool.evaluate(fens, depth=depth, store=store)
+        if store is not None:
+            store.close()
+
+    layer_entries = [(key, layer_record.pack(flags, *bitboards, *weights))
+                     for key, (flags, bitboards, weights) in zip(placement_keys, layer_fields)]
+    entries = []
+    for key, result in zip(keys, evaluations):
+        flags = 0
+        score = 0
+        if result.get("best_move") is not None:
+            flags |= evaluated
+            if result.get("score_mate") is not None:
+                flags |= mate_score
+                score = result["score_mate"]
+            else:
+                score = result.get("score_cp") or 0
+        best_move = (result.get("best_move") or "").encode()
+        entries.append((key, evaluation_record.pack(score, min(counts[key], 0xFFFFFFFF),
+                                                    min(result.get("depth") or 0, 0xFFFF), flags, best_move)))
+    write_index(output_path, layer_entries, entries)
+
+    elapsed = time.perf_counter() - start
+    searched = sum(result.get("best_move") is not None for result in evaluations)
+    print(f"done: {len(entries)} positions ({len(layer_entries)} placements) written to {output_path} "
+          f"in {elapsed:.1f}s, {searched} with an evaluation", file=sys.stderr)
+    return len(entries)
+
+
+if __name__ == "__main__":
+    import argparse as ag
+    parser = ag.ArgumentParser()
+    # command line program controls
+    parser.add_argument("input", nargs="+", help="PGN files to build the index from")
+    parser.add_argument("output", help="index file to write")
+    parser.add_argument("-n", "--min-count", dest="min_count", type=int, default=1,
+                        help="keep positions seen more than this many times")
+    parser.add_argument("-p", "--plies", dest="plies", type=int, default=24,
+                        help="plies of each game whose positions are counted")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=None,
+                        help="worker processes, defaults to the CPU count")
+    parser.add_argument("-e", "--engine", dest="engine_path", default=None,
+                        help="UCI engine to evaluate the kept positions with, none by default")
+    parser.add_argument("-d", "--depth", dest="depth", type=int, default=default_depth,
+                        help="search depth, the board only plays moves searched at least this deep")
+    parser.add_argument("--engines", dest="engine_processes", type=int, default=None,
+                        help="engine processes, defaults to the CPU count")
+    parser.add_argument("--store", dest="store_path", default=None,
+                        help="evaluation store to reuse and extend with the searches")
+
+    args = parser.parse_args()
+    build_index(args.input, args.output, args.min_count, args.plies, args.workers,
+                engine_path=args.engine_path, depth=args.depth,
+                engine_processes=args.engine_processes, store_path=args.store_path)
@@ -0,0 +1,111 @@
+import json
+import time
+import bisect
+
+# timers and histograms for finding where the board spends its time. Functions are
+# registered with instrument() and only wrapped while instrumentation is enabled, when
+# it is disabled the original functions are back in place and nothing is measured.
+# Times are in milliseconds throughout
+
+# upper bounds of the histogram buckets, the last bucket takes everything slower
+bucket_bounds = [0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 33, 66, 133, 266, 533, 1000]
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(bucket_bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.buckets[bisect.bisect_left(bucket_bounds, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    # upper bound of the bucket holding the given fraction of the samples, or the slowest
+    # sample if that is lower
+    def percentile(self, fraction):
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= fraction * self.count:
+                return min(bucket_bounds[index], self.max) if index < len(bucket_bounds) else self.max
+        return 0.0
+
+    def summary(self):
+        return {"count": self.count, "total_ms": self.total,
+                "mean_ms": self.total / self.count if self.count else 0.0,
+                "p50_ms": self.percentile(0.5), "p99_ms": self.percentile(0.99),
+                "max_ms": self.max,
+                "buckets": {f"<={bound}" if index < len(bucket_bounds) else ">1000": count
+                            for index, (bound, count) in
+                            enumerate(zip(bucket_bounds + [None], self.buckets)) if count}}
+
+
+enabled = False
+histograms = {}  # name -> Histogram, for both timed functions and recorded samples
+targets = []  # (owner, attribute, name) of every registered function
+originals = {}  # (owner, attribute) -> the unwrapped function while enabled
+
+def record(name, ms):
+    if name not in histograms:
+        histograms[name] = Histogram()
+    histograms[name].add(ms)
+
+# registers a function or method to be timed while instrumentation is enabled, e.g.
+# instrument(VisCache, "get", "update_vis_cache")
+def instrument(owner, attribute, name=None):
+    targets.append((owner, attribute, name or f"{getattr(owner, '__name__', owner)}.{attribute}"))
+    if enabled:
+        _wrap(owner, attribute, targets[-1][2])
+
+def _wrap(owner, attribute, name):
+    original = getattr(owner, attribute)
+    originals[(owner, attribute)] = original
+    perf_counter = time.perf_counter
+
+    def timed(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            record(name, (perf_counter() - start) * 1000)
+
+    timed.__name__ = getattr(original, "__name__", attribute)
+    timed.__wrapped__ = original
+    setattr(owner, attribute, timed)
+
+def enable():
+    global enabled
+    if not enabled:
+        enabled = True
+        for owner, attribute, name in targets:
+            _wrap(owner, attribute, name)
+
+def disable():
+    global enabled
+    if enabled:
+        enabled = False
+        for (owner, attribute), original in originals.items():
+            setattr(owner, attribute, original)
+        originals.clear()
+
+def reset():
+    histograms.clear()
+
+def summary():
+    return {name: histogram.summary() for name, histogram in sorted(histograms.items())}
+
+def dump(path):
+    with open(path, "w") as handle:
+        json.dump(summary(), handle, indent=1)
+
+# one short line per histogram for the on-screen overlay, slowest total first
+def overlay_lines(limit=12):
+    lines = []
+    for name, histogram in sorted(histograms.items(), key=lambda item: -item[1].total)[:limit]:
+        lines.append(f"{name[:28]:28s} n={histogram.count:<6d} p50 {histogram.percentile(0.5):>6.2f} "
+                     f"p99 {histogram.percentile(0.99):>6.2f} max {histogram.max:>7.2f} ms")
+    return lines
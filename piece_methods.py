@@ -1,6 +1,7 @@
-import pygame
-import chess
-from stockfish.models import Stockfish
+import random
+from analysis_cache import AnalysisCache
+from attack_tables import Bitboards, pawn_attacks, squares_descending
+from exchange import ExchangeMap
 
 # useful global dictionaries and values for various conversions
 fen_dictionary = {"K":["white","king"], "k":["black","king"],
@@ -21,49 +22,260 @@ attack_weights = {"pawn":0.9, "knight":0.6,
                   "bishop":0.6, "rook":0.4,
                   "queen":0.25, "king":0.1}
 
+# castling rights lost when a piece leaves or lands on one of these display squares
+castling_squares = {(4, 7): "KQ", (7, 7): "K", (0, 7): "Q",
+                    (4, 0): "kq", (7, 0): "k", (0, 0): "q"}
+
+# zobrist keys, one random 64-bit number per piece on each square plus the FEN tail.
+# a fixed seed keeps keys identical between runs and between processes
+zobrist_random = random.Random(20240818)
+zobrist_pieces = {key: [zobrist_random.getrandbits(64) for index in range(64)]
+                  for key in inv_fen_dictionary}
+zobrist_black_to_move = zobrist_random.getrandbits(64)
+zobrist_castling = {symbol: zobrist_random.getrandbits(64) for symbol in "KQkq"}
+zobrist_en_passant = [zobrist_random.getrandbits(64) for file in range(8)]
+
+# hash of the piece placement alone, for plain piece lists
+def zobrist_hash(pieces):
+    if isinstance(pieces, Position):
+        return pieces.placement_key
+    key = 0
+    for piece in pieces:
+        key ^= zobrist_pieces[f"{piece.color}_{piece.type}"][piece.x + 8*piece.y]
+    return key
+
 class Piece:
+    __slots__ = ("color", "x", "y", "type")
+
     def __init__(self,color,x,y,piece_type):
         self.color = color
         self.x = x
         self.y = y
         self.type = piece_type
 
-    def draw(self, surface):
-        img = pygame.image.load(f"piece_images/{self.color}_{self.type}.svg")
-        scaled_img = pygame.transform.rotozoom(img,0,1.8)
-        surface.blit(scaled_img, (self.x*75-2,self.y*75-2))
+    def draw(self, surface, square_size=75):
+        # sprites are rasterized once per square size, see sprites.py. Imported here so the
+        # analysis code never loads pygame
+        from sprites import sprite_cache
+        sprite_cache.blit(surface, self.color, self.type, self.x, self.y, square_size)
+
+# a board stored as 64 slots indexed by display coordinates (x + 8*y), so looking up,
+# moving and taking back a piece never has to scan the other pieces.
+# iterating over a Position yields its pieces, so it can be passed anywhere a list
+# of pieces was accepted before
+class Position:
+    __slots__ = ("squares", "kings", "placement_key", "white_to_move", "castling", "en_passant",
+                 "halfmove_clock", "fullmove_number")
+
+    def __init__(self, pieces=(), white_to_move=True, castling="",
+                 en_passant=None, halfmove_clock=0, fullmove_number=1):
+        self.squares = [None]*64
+        self.kings = {"white": None, "black": None}
+        self.placement_key = 0  # zobrist hash of the pieces, kept up to date as they move
+        self.white_to_move = white_to_move
+        self.castling = castling  # subset of "KQkq", empty string if no rights remain
+        self.en_passant = en_passant  # (x, y) of the square behind a double pawn push, or None
+        self.halfmove_clock = halfmove_clock
+        self.fullmove_number = fullmove_number
+        for piece in pieces:
+            self.add_piece(piece)
+
+    @classmethod
+    def from_fen(cls, full_fen):
+        fields = full_fen.split(" ")
+        position = cls()
+        ranks = fields[0].split("/")  # first element is the 8th rank, y = 0 in display coordinates
+        for y, rank in enumerate(ranks):
+            x = 0  # start at the left-most end of the board
+            for symbol in rank:
+                if symbol.isdigit():
+                    # moves file by designated number of blank spaces
+                    x += int(symbol)
+                else:
+                    piece_info = fen_dictionary[symbol]
+                    position.add_piece(Piece(piece_info[0], x, y, piece_info[1]))
+                    x += 1
+
+        # missing fields fall back to the same defaults python-chess uses
+        if len(fields) > 1:
+            position.white_to_move = fields[1] != "b"
+        if len(fields) > 2 and fields[2] != "-":
+            position.castling = fields[2]
+        if len(fields) > 3 and fields[3] != "-":
+            ep_coords = square_to_display_coordinates(fields[3])
+            position.en_passant = (int(ep_coords[0]), int(ep_coords[1]))
+        if len(fields) > 4:
+            position.halfmove_clock = int(fields[4])
+        if len(fields) > 5:
+            position.fullmove_number = int(fields[5])
+
+        return position
+
+    # pieces come out from the first rank upwards, the order load_fen always produced
+    def __iter__(self):
+        for y in range(7, -1, -1):
+            for piece in self.squares[8*y:8*y + 8]:
+                if piece is not None:
+                    yield piece
+
+    def __len__(self):
+        return sum(piece is not None for piece in self.squares)
+
+    def piece_at(self, x, y):
+        return self.squares[x + 8*y]
+
+    def king(self, color):
+        return self.kings[color]
+
+    # zobrist hash of the whole position, the piece placement plus the FEN tail
+    @property
+    def zobrist_key(self):
+        key = self.placement_key
+        if not self.white_to_move:
+            key ^= zobrist_black_to_move
+        for symbol in self.castling:
+            key ^= zobrist_castling[symbol]
+        if self.en_passant is not None:
+            key ^= zobrist_en_passant[self.en_passant[0]]
+        return key
+
+    # places a piece on its square, returning whatever piece it replaced
+    def add_piece(self, piece):
+        index = piece.x + 8*piece.y
+        replaced = self.squares[index]
+        if replaced is not None:
+            self.placement_key ^= zobrist_pieces[f"{replaced.color}_{replaced.type}"][index]
+            if self.kings[replaced.color] is replaced:
+                self.kings[replaced.color] = None
+        self.squares[index] = piece
+        self.placement_key ^= zobrist_pieces[f"{piece.color}_{piece.type}"][index]
+        if piece.type == "king":
+            self.kings[piece.color] = piece
+        return replaced
+
+    def remove_piece(self, x, y):
+        index = x + 8*y
+        piece = self.squares[index]
+        self.squares[index] = None
+        if piece is not None:
+            self.placement_key ^= zobrist_pieces[f"{piece.color}_{piece.type}"][index]
+            if self.kings[piece.color] is piece:
+                self.kings[piece.color] = None
+        return piece
+
+    def _relocate(self, piece, new_x, new_y):
+        piece_keys = zobrist_pieces[f"{piece.color}_{piece.type}"]
+        index = piece.x + 8*piece.y
+        new_index = new_x + 8*new_y
+        self.squares[index] = None
+        self.squares[new_index] = piece
+        self.placement_key ^= piece_keys[index] ^ piece_keys[new_index]
+        piece.x = new_x
+        piece.y = new_y
+
+    # moves the piece on (x, y) to (new_x, new_y), handling captures, castling, en passant
+    # and promotion. No legality checks are made. Returns an undo record for unapply_move
+    def apply_move(self, x, y, new_x, new_y, prom_type="empty"):
+        piece = self.squares[x + 8*y]
+        captured = self.squares[new_x + 8*new_y]
+        # everything needed to take the move back, the FEN tail is saved before it changes
+        saved_state = (self.castling, self.en_passant, self.halfmove_clock, self.fullmove_number)
+        ep_capture = None
+        rook_move = None
+        promoted = None
+
+        if piece.type == "pawn" and captured is None and (new_x, new_y) == self.en_passant:
+            # the captured pawn sits beside the moving pawn, not on the destination square
+            ep_capture = self.remove_piece(new_x, y)
+        elif piece.type == "king" and abs(new_x - x) == 2 and new_y == y:
+            # castling, the rook jumps to the square the king passed over
+            rook_x = 7 if new_x > x else 0
+            rook = self.squares[rook_x + 8*y]
+            if rook is not None and rook.type == "rook" and rook.color == piece.color:
+                rook_move = (rook, rook_x, (x + new_x) // 2)
+
+        if captured is not None:
+            self.remove_piece(new_x, new_y)
+        self._relocate(piece, new_x, new_y)
+        if rook_move is not None:
+            self._relocate(rook_move[0], rook_move[2], y)
+        if prom_type != "empty" and piece.type == "pawn":
+            promoted = Piece(piece.color, new_x, new_y, prom_type)
+            self.add_piece(promoted)
+
+        # update the rights and counters that the FEN tail records
+        for square in ((x, y), (new_x, new_y)):
+            if square in castling_squares:
+                for symbol in castling_squares[square]:
+                    self.castling = self.castling.replace(symbol, "")
+        if piece.type == "pawn" and abs(new_y - y) == 2:
+            self.en_passant = (x, (y + new_y) // 2)
+        else:
+            self.en_passant = None
+        if piece.type == "pawn" or captured is not None or ep_capture is not None:
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
+        if piece.color == "black":
+            self.fullmove_number += 1
+        self.white_to_move = piece.color != "white"
+
+        return (piece, x, y, new_x, new_y, captured, ep_capture, rook_move, promoted, saved_state)
+
+    def unapply_move(self, undo):
+        piece, x, y, new_x, new_y, captured, ep_capture, rook_move, promoted, saved_state = undo
+        self.castling, self.en_passant, self.halfmove_clock, self.fullmove_number = saved_state
+
+        if promoted is not None:
+            self.add_piece(piece)  # the pawn still holds the promotion square as its coordinates
+        if rook_move is not None:
+            self._relocate(rook_move[0], rook_move[1], y)
+        self._relocate(piece, x, y)
+        if captured is not None:
+            self.add_piece(captured)
+        if ep_capture is not None:
+            self.add_piece(ep_capture)
+        self.white_to_move = piece.color == "white"
+
+    def board_fen(self):
+        fen_array = []
+        for y in range(8):
+            blank_counter = 0
+            rank_string = ""
+            for x in range(8):
+                piece = self.squares[x + 8*y]
+                if piece is None:
+                    blank_counter += 1
+                else:
+                    if blank_counter > 0:
+                        rank_string += f"{blank_counter}"
+                        blank_counter = 0
+                    rank_string += inv_fen_dictionary[f"{piece.color}_{piece.type}"]
+            if blank_counter > 0:
+                rank_string += f"{blank_counter}"
+            fen_array.append(rank_string)
+        return "/".join(fen_array)
+
+    def fen(self):
+        side = "w" if self.white_to_move else "b"
+        castling = self.castling or "-"
+        if self.en_passant is None:
+            ep = "-"
+        else:
+            ep = display_coordinates_to_square(f"{self.en_passant[0]}{self.en_passant[1]}")
+        return f"{self.board_fen()} {side} {castling} {ep} {self.halfmove_clock} {self.fullmove_number}"
 
 def load_fen(full_fen):
-    fen = full_fen.split(" ")[0]
-    ranks = fen.split("/")  # first element is the 8th rank
-    ranks.reverse()
-    curr_rank = 7  # reflects the comment above
-    pieces = []  # this will hold all pieces
-    for rank in ranks:
-
-        file = 0  # start at the left-most end of the board
-
-        for symbol in rank:
-            if symbol.isdigit():
-                # moves file by designated number of blank spaces
-                file += int(symbol)
-            else:
-                piece_info = fen_dictionary[symbol]
-                temp_piece = Piece(piece_info[0], file, curr_rank, piece_info[1])
-                pieces.append(temp_piece)
-
-                # updates file position
-                file += 1
-
-        curr_rank -= 1
-
-    return pieces
+    return Position.from_fen(full_fen)
 
 # a helper function that uses the above and a new-game FEN to load a fresh game
 def new_game():
     return load_fen(new_game_fen)
 
 def get_abbrev_fen(pieces):
+    if isinstance(pieces, Position):
+        return pieces.board_fen()
+
     ranks = [["_"]*8,["_"]*8,["_"]*8,["_"]*8,["_"]*8,["_"]*8,["_"]*8,["_"]*8]
     for piece in pieces:
         curr_rank = piece.y
@@ -97,6 +309,23 @@ def get_abbrev_fen(pieces):
     return "/".join(fen_array)
 
 
+# finds the piece on a display square, a direct lookup when given a Position
+def find_piece(pieces, x, y):
+    if isinstance(pieces, Position):
+        return pieces.piece_at(x, y)
+    for piece in pieces:
+        if piece.x == x and piece.y == y:
+            return piece
+    return None
+
+def find_king(pieces, color):
+    if isinstance(pieces, Position):
+        return pieces.king(color)
+    for piece in pieces:
+        if piece.type == "king" and piece.color == color:
+            return piece
+    return None
+
 def get_pieces_at_squares(pieces):
     board_places = [["_"]*8,["_"]*8,["_"]*8,["_"]*8,["_"]*8,["_"]*8,["_"]*8,["_"]*8]
     for piece in pieces:
@@ -129,249 +358,276 @@ def pawn_attacked_squares(pawn_x, pawn_y, color):
     return attacked_squares
 
 
-# side_to_play is a Boolean, True for white, False for black
+# display coordinates for every python-chess square number, so moves never go through strings
+square_display_coordinates = [f"{square % 8}{7 - square // 8}" for square in range(64)]
+
+# the 8x8 square keys of the analysis maps and their (x, y), pawns on the last rank can
+# produce others
+board_keys = {f"{x}{y}": (x, y) for x in range(8) for y in range(8)}
+
+# results of the analysis layers across positions, keyed by the zobrist hash of the
+# piece placement (the only part of a position the layers depend on), the layer and its
+# parameters. Resize or inspect it through its methods, e.g. analysis_cache.stats()
+analysis_cache = AnalysisCache(max_entries=4096)
+
+# wraps a PositionAnalysis layer so repeated requests for a position read from analysis_cache
+def cached_layer(method):
+    layer = method.__name__
+
+    def cached_method(self, *args, **kwargs):
+        params = tuple(tuple(arg) if isinstance(arg, list) else arg for arg in args)
+        params += tuple(sorted((name, tuple(value) if isinstance(value, list) else value)
+                               for name, value in kwargs.items()))
+        key = (self.key, layer, params)
+        found, result = analysis_cache.lookup(key)
+        if not found:
+            result = method(self, *args, **kwargs)
+            analysis_cache.store(key, result)
+        return result
+
+    cached_method.__name__ = layer
+    cached_method.__wrapped__ = method  # the uncached layer, for full recomputes
+    return cached_method
+
+# the keys pawn_attacked_squares gives a pawn on each python-chess square, by color
+pawn_attack_keys = {color: [pawn_attacked_squares(square % 8, 7 - square // 8, color)
+                            for square in range(64)] for color in (True, False)}
+
+# builds the bitboards of a position once and generates each side's attacks at most once,
+# every visualization map is then derived from that shared data. Attacks come from the
+# precomputed tables in attack_tables, so no move objects or strings are made on the way.
+# side_to_play is a Boolean throughout, True for white, False for black
+class PositionAnalysis:
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.key = zobrist_hash(pieces)
+        self._bitboards = None
+        self._piece_moves = {}
+        self._exchange = None
+
+    # only built once a layer misses the cache
+    @property
+    def bitboards(self):
+        if self._bitboards is None:
+            self._bitboards = Bitboards(self.pieces)
+        return self._bitboards
+
+    # attackers of every square and the exchanges on them, see exchange.py
+    @property
+    def exchange(self):
+        if self._exchange is None:
+            self._exchange = ExchangeMap(self.bitboards)
+        return self._exchange
+
+    # (origin square, piece type, destinations bitboard) for every non-pawn piece of a
+    # side, in python-chess move generation order
+    def piece_moves(self, side_to_play):
+        if side_to_play not in self._piece_moves:
+            self._piece_moves[side_to_play] = self.bitboards.piece_moves(side_to_play)
+        return self._piece_moves[side_to_play]
+
+    # python-chess squares of a side's pawns, in the order the pieces are stored
+    def pawn_squares(self, side_to_play):
+        for piece in self.pieces:
+            if piece.type == "pawn" and (piece.color == "white") == side_to_play:
+                yield piece.x + (7 - piece.y)*8
+
+    # control type lists the pieces whose control we wish to visualize, defaults to all
+    @cached_layer
+    def attack_color_coding(self, side_to_play,
+                            con_types=("pawn", "bishop", "knight", "rook", "queen", "king")):
+        coloring_weights = {}
+        # use moves of non-pawn pieces to find control
+        for origin, piece_type, destinations in self.piece_moves(side_to_play):
+            if piece_type in con_types:
+                weight = attack_weights[piece_type]
+                for destination in squares_descending(destinations):
+                    attacked_square = square_display_coordinates[destination]
+                    # add weight to target square, or create new entry if not yet attacked
+                    coloring_weights[attacked_square] = coloring_weights.get(attacked_square, 0) + weight
+
+        if "pawn" in con_types:
+            weight = attack_weights["pawn"]
+            pawn_keys = pawn_attack_keys[side_to_play]
+            for pawn_square in self.pawn_squares(side_to_play):
+                for square in pawn_keys[pawn_square]:
+                    coloring_weights[square] = coloring_weights.get(square, 0) + weight
+
+        return coloring_weights
+
+    @cached_layer
+    def attack_array(self, side_to_play,
+                     con_types=("pawn", "bishop", "knight", "rook", "queen", "king")):
+        attack_array = [["_"]*8,["_"]*8,["_"]*8,["_"]*8,["_"]*8,["_"]*8,["_"]*8,["_"]*8]
+
+        for origin, piece_type, destinations in self.piece_moves(side_to_play):
+            if piece_type in con_types:
+                # add piece type to attack map
+                for destination in squares_descending(destinations):
+                    attack_array[destination % 8][7 - destination // 8] = piece_type
+
+        if "pawn" in con_types:
+            for pawn_square in self.pawn_squares(side_to_play):
+                for destination in squares_descending(pawn_attacks[side_to_play][pawn_square]):
+                    attack_array[destination % 8][7 - destination // 8] = "pawn"
+
+        return attack_array
+
+    @cached_layer
+    def defended_pieces(self, defending_side):
+        defense_array = [[0]*8,[0]*8,[0]*8,[0]*8,[0]*8,[0]*8,[0]*8,[0]*8]
+        defense_values = {"king": 1, "queen": 1, "rook": 5, "bishop": 7, "knight": 7, "pawn": 10}
+
+        bitboards = self.bitboards
+        for piece in self.pieces:
+            piece_square_number = piece.x + (7-piece.y)*8
+            if (piece.color == "white") == defending_side and bitboards.attackers(defending_side, piece_square_number):
+                defense_array[piece.x][piece.y] += defense_values[piece.type]
+
+        return defense_array
+
+    @cached_layer
+    def board_struggle(self):
+        white_attack = self.attack_color_coding(True)
+        black_attack = self.attack_color_coding(False)
+
+        conflict_coding = {}
+        for square in set(white_attack) | set(black_attack):
+            # save relative strength of attack from each player
+            conflict_coding[square] = white_attack.get(square, 0.0) - black_attack.get(square, 0.0)
+
+        return conflict_coding
+
+    # {origin: (reach, legal destinations)} of every piece of a side as bitboards, see
+    # Bitboards.move_table. Built once per position and shared by the layers below, so a
+    # click on a piece is a lookup
+    @cached_layer
+    def move_table(self, side_to_play):
+        return self.bitboards.move_table(side_to_play)
+
+    @cached_layer
+    def king_attackers(self, side_to_play):
+        # find coordinates of enemy king
+        enemy_king = find_king(self.pieces, "black" if side_to_play else "white")
+        king_x = enemy_king.x
+        king_y = enemy_king.y
+
+        # find surrounding squares of enemy king, as a bitboard
+        king_zone = 0
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                king_zone |= 1 << (min(max(king_x+dx,0),7) + (7 - min(max(king_y+dy,0),7))*8)
+
+        # pawns count for the squares they attack and the squares they can advance to
+        return {square_display_coordinates[origin]
+                for origin, (reach, legal) in self.move_table(side_to_play).items()
+                if reach & king_zone}
+
+    # legal destinations of the piece on a square, empty if there is none
+    def legal_move_squares(self, x, y):
+        piece_square = x + (7-y)*8  # square that the piece originates on
+
+        # both colors are tabulated together, the piece's own color holds its moves
+        white_moves, black_moves = self.move_table(True), self.move_table(False)
+        moves = white_moves.get(piece_square) or black_moves.get(piece_square)
+        if moves is None:
+            return set()
+        return {square_display_coordinates[destination]
+                for destination in squares_descending(moves[1])}
+
+    # who wins the exchange on each square, in pawns and positive for white, see
+    # ExchangeMap.contested_squares. Unlike board_struggle this follows the captures through
+    @cached_layer
+    def exchange_struggle(self):
+        return {square_display_coordinates[square]: value
+                for square, value in self.exchange.contested_squares().items()}
+
+    # pieces of a side that the opponent wins material by capturing
+    @cached_layer
+    def hanging_pieces(self, side_to_play):
+        return [square_display_coordinates[square] for square in self.exchange.hanging(side_to_play)]
+
+    # a method to find which pieces have very few (pseudo)moves available
+    @cached_layer
+    def restricted_pieces(self, side_to_play):
+        # a dictionary representing when pieces have "not a lot of moves"
+        restriction_dict = {"queen": 9, "rook": 5, "bishop": 3, "knight": 2}
+
+        # squares an opposing piece controls or defends, i.e. everything the opponent attacks
+        unsafe = self.bitboards.attacked_by(not side_to_play)
+
+        # count the moves of each piece that land on undefended, unattacked squares
+        safe_moves = {origin: (reach & ~unsafe).bit_count()
+                      for origin, (reach, legal) in self.move_table(side_to_play).items()}
+
+        restricted_piece_squares = []
+        for piece in self.pieces:
+            piece_type = piece.type
+            if piece_type != "pawn" and piece_type != "king" and ((piece.color == "white") == side_to_play):
+                # check if we have less than the alloted number of moves
+                if safe_moves.get(piece.x + (7-piece.y)*8, 0) <= restriction_dict[piece_type]:
+                    restricted_piece_squares.append(f"{piece.x}{piece.y}")
+
+        return restricted_piece_squares
+
+
+# the functions below analyse a single map, use PositionAnalysis directly when several
+# maps are needed for the same position
 # control type lists the pieces whose control we wish to visualize, defaults to all
 def get_attack_color_coding(pieces, side_to_play,
                             con_types=["pawn", "bishop", "knight", "rook", "queen", "king"]):
-    coloring_weights = {}
-    # get fen from piece list, use this to generate a python-chess board to obtain legal moves
-    board_fen = get_abbrev_fen(pieces)
-    py_board = chess.Board(board_fen)
-
-    if not side_to_play:
-        py_board.push(chess.Move.null())  # if black to play, make a null move to get correct moveset
-
-    # use moves of non-pawn pieces to find control
-    moves = list(py_board.pseudo_legal_moves)
-    for move in moves:
-        string_move = str(move)[0:4]  # remove formatting and promotion from legal moves
-        origin = string_move[0:2]  # starting square of the move
-        destination = string_move[2:]
-        piece_type = py_board.piece_at(chess.parse_square(origin)) # determine the type of piece moving
-        piece_type = fen_dictionary[str(piece_type)][1]  # translate piece type to text
-
-        weight = attack_weights[piece_type]
-        attacked_square = square_to_display_coordinates(destination)
-        if piece_type != "pawn" and piece_type in con_types:
-            # add weight to target square, or create new entry if not yet attacked
-            try:
-                coloring_weights[attacked_square] += weight
-            except:
-                coloring_weights[attacked_square] = weight
-
-    if "pawn" in con_types:
-        for piece in pieces:
-            if piece.type == "pawn" and (piece.color == "white") == side_to_play:
-                pawn_x = piece.x
-                pawn_y = piece.y
-                pawn_squares = pawn_attacked_squares(pawn_x, pawn_y, side_to_play)
-                for square in pawn_squares:
-                    try:
-                        coloring_weights[square] += weight
-                    except:
-                        coloring_weights[square] = weight
-
-    return coloring_weights
+    return PositionAnalysis(pieces).attack_color_coding(side_to_play, con_types)
 
 def get_defended_pieces(pieces, defending_side):
-    defense_array = [[0]*8,[0]*8,[0]*8,[0]*8,[0]*8,[0]*8,[0]*8,[0]*8]
-    defense_values = {"king": 1, "queen": 1, "rook": 5, "bishop": 7, "knight": 7, "pawn": 10}
-
-    # get fen from piece list, use this to generate a python-chess board to obtain legal moves
-    board_fen = get_abbrev_fen(pieces)
-    py_board = chess.Board(board_fen)
-
-    for piece in pieces:
-        piece_square_number = piece.x + (7-piece.y)*8
-        if py_board.is_attacked_by(defending_side, piece_square_number) and ((piece.color == "white") == defending_side):
-            defense_array[piece.x][piece.y] += defense_values[piece.type]
-
-    return defense_array
+    return PositionAnalysis(pieces).defended_pieces(defending_side)
 
-
-# side_to_play is a Boolean, True for white, False for black
-# control type lists the pieces whose control we wish to visualize, defaults to all
 def get_attack_array(pieces, side_to_play,
                             con_types=["pawn", "bishop", "knight", "rook", "queen", "king"]):
-
-    attack_array = [["_"]*8,["_"]*8,["_"]*8,["_"]*8,["_"]*8,["_"]*8,["_"]*8,["_"]*8]
-
-    # get fen from piece list, use this to generate a python-chess board to obtain legal moves
-    board_fen = get_abbrev_fen(pieces)
-    py_board = chess.Board(board_fen)
-
-    if not side_to_play:
-        py_board.push(chess.Move.null())  # if black to play, make a null move to get correct moveset
-
-    # use moves of non-pawn pieces to find control
-    moves = list(py_board.pseudo_legal_moves)
-
-    for move in moves:
-        string_move = str(move)[0:4]  # remove formatting and promotion from legal moves
-        origin = string_move[0:2]  # starting square of the move
-        destination = string_move[2:]
-        piece_type = py_board.piece_at(chess.parse_square(origin)) # determine the type of piece moving
-        piece_type = fen_dictionary[str(piece_type)][1]  # translate piece type to text
-
-        attacked_coords = square_to_display_coordinates(destination)
-        attacked_x = int(attacked_coords[0])
-        attacked_y = int(attacked_coords[1])
-        if piece_type != "pawn" and piece_type in con_types:
-            # add piece type to attack map
-            attack_array[attacked_x][attacked_y] = piece_type
-
-    if "pawn" in con_types:
-        for piece in pieces:
-            if "pawn" in con_types and piece.type == "pawn" and (piece.color == "white") == side_to_play:
-                pawn_x = piece.x
-                pawn_y = piece.y
-                pawn_squares = pawn_attacked_squares(pawn_x, pawn_y, side_to_play)
-                for square in pawn_squares:
-                    attacked_x = int(square[0])
-                    attacked_y = int(square[1])
-                    attack_array[attacked_x][attacked_y] = "pawn"
-
-    return attack_array
+    return PositionAnalysis(pieces).attack_array(side_to_play, con_types)
 
 def board_struggle(pieces):
-    white_attack = get_attack_color_coding(pieces, True)
-    black_attack = get_attack_color_coding(pieces, False)
-
-    contested_squares = set(list(white_attack.keys()) + list(black_attack.keys()))
-    conflict_coding = {}
-    for square in contested_squares:
-        # check if white piece controls the square
-        try:
-            white_attack_strength = white_attack[square]
-        except:
-            white_attack_strength = 0.0
-        # check if black piece controls the square
-        try:
-            black_attack_strength = black_attack[square]
-        except:
-            black_attack_strength = 0.0
-        # save relative strength of attack from each player
-        conflict_coding[square] = white_attack_strength - black_attack_strength
-
-    return conflict_coding
+    return PositionAnalysis(pieces).board_struggle()
 
 def king_attackers(pieces, side_to_play):
-    # set up board to obtain legal moves
-    board_fen = get_abbrev_fen(pieces)
-    py_board = chess.Board(board_fen)
-    if not side_to_play:  # it is black's move, push a null move
-        py_board.push(chess.Move.null())
-
-    moves = list(py_board.pseudo_legal_moves)  # a lsit of all legal moves in the position
-
-    # find coordinates of enemy king
-    for piece in pieces:
-        if piece.type == "king" and (side_to_play != (piece.color == "white")):
-            king_x = piece.x
-            king_y = piece.y
-            break
-
-    # find surrounding squares of enemy king
-    increments = [-1,0,1]
-    king_domain = [[min(max(king_x+dx,0),7), min(max(king_y+dy,0),7)] for dx in increments for dy in increments]
-    king_dom_squares = {display_coordinates_to_square(f"{dsp[0]}{dsp[1]}") for dsp in king_domain}
-
-    squares_to_highlight = set()
-    for move in moves:
-        string_move = str(move)[0:4]  # remove formatting and promotion from legal moves
-        origin = string_move[0:2]  # starting square of the move
-        destination = string_move[2:]
-        if destination in king_dom_squares:
-            squares_to_highlight.add(square_to_display_coordinates(origin))
-
-    for piece in pieces:
-        if piece.type == "pawn" and (piece.color == "white") == side_to_play:
-            pawn_x = piece.x
-            pawn_y = piece.y
-            pawn_attack_coords = pawn_attacked_squares(pawn_x, pawn_y, side_to_play)
-            for coords in pawn_attack_coords:
-                pawn_square = display_coordinates_to_square(coords)
-                if pawn_square in king_dom_squares:
-                    squares_to_highlight.add(f"{pawn_x}{pawn_y}")
-
-    return squares_to_highlight
+    return PositionAnalysis(pieces).king_attackers(side_to_play)
 
 def legal_move_squares(board_pieces, x, y):
-    fen = get_abbrev_fen(board_pieces)
-    py_board = chess.Board(fen)
-    piece_square = display_coordinates_to_square(f"{x}{y}")  # square that the piece originates on
-
-    side_to_play = True  # added so program fails gracefully if there is no piece on a target square
-    # identify color of piece on the target square
-    for piece in board_pieces:
-        if piece.x == x and piece.y == y:
-            side_to_play = piece.color == "white"
+    return PositionAnalysis(board_pieces).legal_move_squares(x, y)
 
-    # modify whose move it is on py_board
-    if not side_to_play:
-        py_board.push(chess.Move.null())
+def restricted_pieces(board_pieces, side_to_play):
+    return PositionAnalysis(board_pieces).restricted_pieces(side_to_play)
 
-    moves = list(py_board.legal_moves)
-    legal_squares = set()
+def exchange_struggle(pieces):
+    return PositionAnalysis(pieces).exchange_struggle()
 
-    for move in moves:
-        origin_square = str(move)[0:2]
-        if origin_square == piece_square:
-            dest_square = str(move)[2:4]
-            legal_squares.add(square_to_display_coordinates(dest_square))
+def hanging_pieces(pieces, side_to_play):
+    return PositionAnalysis(pieces).hanging_pieces(side_to_play)
 
-    return legal_squares
+# with an EvalStore, positions already searched at least as deep as the engine is set to
+# search are answered from the store and new results are added to it
+def request_engine_move(engine, store=None):
+    if store is None:
+        # pull best move from engine
+        result = engine.get_best_move()
+    else:
+        fen = engine.get_fen_position()
+        depth = int(getattr(engine, "depth", 0))
+        stored = store.lookup(fen, min_depth=depth)
+        if stored is not None:
+            result = stored["best_move"]
+        else:
+            result = engine.get_best_move()
+            if result is not None:
+                store.store(fen, {"best_move": result, "depth": depth})
 
-# a method to find which pieces have very few (pseudo)moves available
-def restricted_pieces(board_pieces, side_to_play):
+    # return move information in a way that is most useful for display
+    return uci_to_display_move(result)
 
-    # a dictionary representing when pieces have "not a lot of moves"
-    restriction_dict = {"queen": 9, "rook": 5, "bishop": 3, "knight": 2}
-    # standard board setup
-    fen = get_abbrev_fen(board_pieces)
-    py_board = chess.Board(fen)
-
-    # we use this to see which squares an opposing piece controls
-    attack_array = get_attack_array(board_pieces, not side_to_play)
-    def_array = get_defended_pieces(board_pieces, not side_to_play)
-
-    # side adjustment
-    if not side_to_play:
-        py_board.push(chess.Move.null())
-
-    moves = list(py_board.pseudo_legal_moves)
-    restricted_piece_squares = []
-
-    for piece in board_pieces:
-        num_moves = 0  # a counter to hold the number of legal moves for a given piece
-        piece_square = display_coordinates_to_square(f"{piece.x}{piece.y}")
-        piece_type = piece.type
-        if piece_type != "pawn" and piece_type != "king" and ((piece.color == "white") == side_to_play):
-            for move in moves:
-                origin_square = str(move)[0:2]
-                if piece_square == origin_square:
-                    # we must now check to see if destination square is defended by opponent
-                    dest_square = str(move)[2:4]
-                    dest_coords = square_to_display_coordinates(dest_square)
-
-                    dest_x = int(dest_coords[0])
-                    dest_y = int(dest_coords[1])
-
-                    if attack_array[dest_x][dest_y] == "_" and def_array[dest_x][dest_y] == 0:
-                        num_moves += 1
-            # check if we have less than the alloted number of moves
-            if num_moves <= restriction_dict[piece_type]:
-                restricted_piece_squares.append(f"{piece.x}{piece.y}")
-
-    return restricted_piece_squares
-
-def request_engine_move(engine):
+# splits a UCI move such as "e7e8q" into display coordinates and a promotion piece name
+def uci_to_display_move(result):
     # UCI promotion notation to full piece name for compatibility with display
     uci_prom = {"q": "queen", "n": "knight", "b": "bishop", "r": "rook"}
 
-    # pull best move from engine
-    result = engine.get_best_move()
-
     # take origin square, convert to display, split to give to move function
     origin_coord = square_to_display_coordinates(result[0:2])
     x = int(origin_coord[0])
@@ -388,5 +644,4 @@ def request_engine_move(engine):
     except:
         prom_type = "empty"  # value for no promotion
 
-    # return move information in a way that is most useful for display
     return x, y, new_x, new_y, prom_type
@@ -0,0 +1,171 @@
+import os
+import sys
+import time
+import zlib
+import struct
+import multiprocessing as mp
+from collections import deque
+
+# diagrams are drawn offscreen, no window is ever opened
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+from piece_methods import Position
+from sprites import sprite_cache
+from board import VisCache, draw_board_and_pieces
+from analyze_corpus import read_numbered_fens, chunked
+from opening_index import OpeningIndex
+
+# renders annotated diagrams of a FEN list to PNG files without opening a window, with
+# the same drawing code as analysis_board: every position is drawn once per requested
+# overlay mode into an offscreen surface the size of the board window. Chunks of
+# positions are rendered by a process pool, each worker rasterizes the piece sprites
+# once and reuses them for every diagram. Files are named by the position's line in the
+# input, counting from 1, and the mode, e.g. 000042_m1.png, and the same input always
+# gives the same bytes
+
+opening_index = None  # a worker's mapping of the opening index, if one was given
+
+window_size = (640, 640)  # the analysis_board window, board and border included
+board_size = (600, 600)
+
+# writes a surface as an RGB PNG. pygame's own PNG writer spends most of the time of a
+# diagram compressing, a low zlib level writes three times faster for a larger file. No
+# metadata is written, so the bytes only depend on the pixels
+def write_png(surface, path, compression=1):
+    width, height = surface.get_size()
+    pixels = pygame.image.tobytes(surface, "RGB")
+    stride = width * 3
+    # every row starts with filter type 0 (none)
+    rows = b"".join(b"\x00" + pixels[row * stride:(row + 1) * stride] for row in range(height))
+
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data +
+                struct.pack(">I", zlib.crc32(kind + data)))
+
+    with open(path, "wb") as handle:
+        handle.write(b"\x89PNG\r\n\x1a\n" +
+                     chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) +
+                     chunk(b"IDAT", zlib.compress(rows, compression)) +
+                     chunk(b"IEND", b""))
+
+# runs once in each worker process. pygame.init is left out, it would make SDL catch the
+# signal the pool stops its workers with. Every worker maps the same index file, the
+# pages are shared between them
+def init_worker(image_dir, index_path=None):
+    global opening_index
+    sprite_cache.image_dir = image_dir
+    sprite_cache.set_square_size(75)
+    if index_path is not None:
+        opening_index = OpeningIndex(index_path)
+
+# side is True, False or None for the side to move. click is the (x, y) square whose
+# legal moves mode 3 shows. Returns one (path, error) per diagram, error None if written
+def render_position(line_number, fen, modes, output_dir, side=None, click=(0, 0), compression=1):
+    screen = pygame.Surface(window_size)
+    board = pygame.Surface(board_size)
+    results = []
+    try:
+        position = Position.from_fen(fen)
+    except Exception as error:
+        return [(None, f"line {line_number}: {error!r}")]
+
+    vis_cache = VisCache(position, opening_index=opening_index)
+    side_playing = position.white_to_move if side is None else side
+    for mode in modes:
+        path = os.path.join(output_dir, f"{line_number:06d}_m{mode}.png")
+        try:
+            highlighted_squares = vis_cache.get(mode, side_playing, *click)
+        except Exception as error:
+            # e.g. king attackers of a position without a king
+            results.append((path, f"line {line_number} mode {mode}: {error!r}"))
+            continue
+        screen.fill((0, 0, 0))
+        draw_board_and_pieces(board, screen, position, highlighted_squares, mode)
+        write_png(screen, path, compression)
+        results.append((path, None))
+    return results
+
+# items are (line number, FEN) pairs
+def render_chunk(items, modes, output_dir, side, click, compression):
+    results = []
+    for line_number, fen in items:
+        results.extend(render_position(line_number, fen, modes, output_dir, side, click, compression))
+    return results
+
+# renders every position of a FEN/EPD file in each of the modes, returns (written, failed)
+def render_diagrams(input_path, output_dir, modes=(1,), workers=None, chunk_size=32,
+                    side=None, click=(0, 0), image_dir="piece_images", compression=1,
+                    index_path=None):
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or mp.cpu_count()
+    max_in_flight = 2 * workers
+    image_dir = os.path.abspath(image_dir)
+    if index_path is not None:
+        index_path = os.path.abspath(index_path)
+    written = 0
+    failed = 0
+    start = time.perf_counter()
+
+    def collect(results):
+        nonlocal written, failed
+        for path, error in results:
+            if error is None:
+                written += 1
+            else:
+                failed += 1
+                print(error, file=sys.stderr)
+
+    with open(input_path, "r", errors="replace") as in_handle, \
+            mp.Pool(workers, initializer=init_worker, initargs=(image_dir, index_path)) as pool:
+        pending = deque()
+        for chunk in chunked(read_numbered_fens(in_handle), chunk_size):
+            pending.append(pool.apply_async(render_chunk, (chunk, modes, output_dir,
+                                                           side, click, compression)))
+            # keeps the reader from running ahead of the workers
+            while len(pending) >= max_in_flight:
+                collect(pending.popleft().get())
+        while pending:
+            collect(pending.popleft().get())
+
+    elapsed = time.perf_counter() - start
+    print(f"done: {written} diagrams in {elapsed:.1f}s, "
+          f"{written / elapsed if elapsed else 0:.0f} diagrams/s, {failed} failed", file=sys.stderr)
+    return written, failed
+
+
+if __name__ == "__main__":
+    import argparse as ag
+    parser = ag.ArgumentParser()
+    # command line program controls
+    parser.add_argument("input", help="FEN/EPD list, one position per line")
+    parser.add_argument("output", help="directory the PNG files are written to")
+    parser.add_argument("-m", "--modes", dest="modes", default="1",
+                        help="comma separated display modes to render, e.g. 0,1,2")
+    parser.add_argument("-s", "--side", dest="side", default="fen", choices=["fen", "white", "black"],
+                        help="side shown by the one-sided modes, by default the side to move")
+    parser.add_argument("--square", dest="square", default=None,
+                        help="square whose legal moves mode 3 shows, e.g. e2")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=None,
+                        help="worker processes, defaults to the CPU count")
+    parser.add_argument("-c", "--chunk-size", dest="chunk_size", type=int, default=32,
+                        help="positions per chunk sent to a worker")
+    parser.add_argument("-i", "--images", dest="image_dir", default="piece_images",
+                        help="directory holding the piece SVGs")
+    parser.add_argument("-z", "--compression", dest="compression", type=int, default=1,
+                        choices=range(10), help="zlib level of the PNGs, higher is smaller and slower")
+    parser.add_argument("-x", "--index", dest="index_path", default=None,
+                        help="opening index whose layers are used for the positions it holds")
+
+    args = parser.parse_args()
+    display_modes = [int(mode) for mode in args.modes.split(",")]
+    square = (0, 0)
+    if 3 in display_modes:
+        if args.square is None:
+            parser.error("mode 3 needs --square")
+        square = (ord(args.square[0]) - ord("a"), 8 - int(args.square[1]))
+    failures = render_diagrams(args.input, args.output, display_modes, args.workers, args.chunk_size,
+                               {"fen": None, "white": True, "black": False}[args.side], square,
+                               args.image_dir, args.compression, args.index_path)[1]
+    if failures:
+        sys.exit(1)
@@ -0,0 +1,70 @@
+import pygame
+
+# piece image citation: By Cburnett - Own work, CC BY-SA 3.0,
+# https://commons.wikimedia.org/w/index.php?curid=1499808
+
+piece_colors = ["white", "black"]
+piece_types = ["king", "queen", "rook", "bishop", "knight", "pawn"]
+
+# the piece SVGs were drawn scaled by 1.8 and shifted 2px up and left on 75px squares,
+# other square sizes keep the same proportions
+base_square_size = 75
+base_scale = 1.8
+base_offset = -2
+
+# rasterizes each of the 12 piece images once per square size and keeps the results, so
+# drawing a piece is a single blit instead of an SVG parse and a rotozoom. With
+# use_atlas the sprites share one surface and are blitted by area
+class SpriteCache:
+    def __init__(self, image_dir="piece_images", use_atlas=False):
+        self.image_dir = image_dir
+        self.use_atlas = use_atlas
+        self.square_size = None
+        self.offset = 0
+        self.sprites = {}  # "color_type" -> surface, or atlas area when using the atlas
+        self.atlas = None
+
+    # rebuilds the sprites if the square size changed since they were last rasterized
+    def set_square_size(self, square_size):
+        if square_size != self.square_size:
+            self.rebuild(square_size)
+
+    def rebuild(self, square_size):
+        scale = base_scale * square_size / base_square_size
+        self.square_size = square_size
+        self.offset = round(base_offset * square_size / base_square_size)
+
+        sprites = {}
+        for color in piece_colors:
+            for piece_type in piece_types:
+                img = pygame.image.load(f"{self.image_dir}/{color}_{piece_type}.svg")
+                sprite = pygame.transform.rotozoom(img, 0, scale)
+                if pygame.display.get_surface() is not None:
+                    sprite = sprite.convert_alpha()  # matches the screen format for faster blits
+                sprites[f"{color}_{piece_type}"] = sprite
+
+        if self.use_atlas:
+            # lay the sprites out in one row on a shared transparent surface
+            width = sum(sprite.get_width() for sprite in sprites.values())
+            height = max(sprite.get_height() for sprite in sprites.values())
+            self.atlas = pygame.Surface((width, height), pygame.SRCALPHA)
+            left = 0
+            for key, sprite in sprites.items():
+                self.atlas.blit(sprite, (left, 0))
+                sprites[key] = pygame.Rect(left, 0, sprite.get_width(), sprite.get_height())
+                left += sprite.get_width()
+        else:
+            self.atlas = None
+        self.sprites = sprites
+
+    def blit(self, surface, color, piece_type, x, y, square_size=base_square_size):
+        self.set_square_size(square_size)
+        sprite = self.sprites[f"{color}_{piece_type}"]
+        dest = (x*square_size + self.offset, y*square_size + self.offset)
+        if self.atlas is not None:
+            surface.blit(self.atlas, dest, sprite)
+        else:
+            surface.blit(sprite, dest)
+
+# shared by Piece.draw and the board drawing functions
+sprite_cache = SpriteCache()
@@ -0,0 +1,143 @@
+import subprocess
+import threading
+
+# a minimal UCI client talking to an engine process over its standard input and output.
+# Unlike the stockfish package it exposes the info lines of a running search and lets
+# another thread stop it
+
+class EngineError(RuntimeError):
+    pass
+
+# turns an "info" line into a dict, e.g. {"depth": 12, "score_cp": 35, "pv": ["e2e4", ...]}.
+# mate scores are reported as score_mate instead of score_cp
+def parse_info(line):
+    tokens = line.split()
+    info = {}
+    i = 1
+    while i < len(tokens):
+        token = tokens[i]
+        if token in ("depth", "seldepth", "multipv", "nodes", "nps", "time", "hashfull") and i + 1 < len(tokens):
+            info[token] = int(tokens[i + 1])
+            i += 2
+        elif token == "score" and i + 2 < len(tokens):
+            kind = "score_cp" if tokens[i + 1] == "cp" else "score_mate"
+            info[kind] = int(tokens[i + 2])
+            i += 3
+            if i < len(tokens) and tokens[i] in ("lowerbound", "upperbound"):
+                info["bound"] = tokens[i]
+                i += 1
+        elif token == "pv":
+            info["pv"] = tokens[i + 1:]
+            break
+        elif token == "string":
+            info["string"] = " ".join(tokens[i + 1:])
+            break
+        else:
+            i += 1
+    return info
+
+# the "go" command for a search limit, depth and nodes may be combined
+def go_command(depth=None, nodes=None, movetime=None):
+    command = "go"
+    if depth is not None:
+        command += f" depth {depth}"
+    if nodes is not None:
+        command += f" nodes {nodes}"
+    if movetime is not None:
+        command += f" movetime {movetime}"
+    if command == "go":
+        command += " infinite"
+    return command
+
+
+class UCIEngine:
+    def __init__(self, path, options=None):
+        self.path = path
+        try:
+            self.process = subprocess.Popen([path], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                            stderr=subprocess.DEVNULL, text=True, bufsize=1)
+        except OSError as error:
+            raise EngineError(f"could not start engine {path}") from error
+        self.write_lock = threading.Lock()  # stop may be sent from another thread
+        self.send("uci")
+        self.read_until("uciok")
+        for name, value in (options or {}).items():
+            self.set_option(name, value)
+        self.wait_ready()
+
+    def send(self, command):
+        with self.write_lock:
+            try:
+                self.process.stdin.write(command + "\n")
+                self.process.stdin.flush()
+            except (BrokenPipeError, OSError, ValueError) as error:
+                raise EngineError(f"engine {self.path} is not running") from error
+
+    def readline(self):
+        line = self.process.stdout.readline()
+        if not line:
+            raise EngineError(f"engine {self.path} exited")
+        return line.strip()
+
+    def read_until(self, prefix):
+        while True:
+            line = self.readline()
+            if line.startswith(prefix):
+                return line
+
+    def set_option(self, name, value):
+        self.send(f"setoption name {name} value {value}")
+
+    def wait_ready(self):
+        self.send("isready")
+        self.read_until("readyok")
+
+    def new_game(self):
+        self.send("ucinewgame")
+        self.wait_ready()
+
+    # fen of None means the standard starting position
+    def set_position(self, fen=None, moves=()):
+        command = "position startpos" if fen is None else f"position fen {fen}"
+        if moves:
+            command += " moves " + " ".join(moves)
+        self.send(command)
+
+    # runs a search on the current position and returns (best move, last info of each
+    # multipv line). on_info is called with every parsed info line as it arrives
+    def search(self, depth=None, nodes=None, movetime=None, on_info=None):
+        self.start_search(depth, nodes, movetime)
+        return self.finish_search(on_info)
+
+    # the two halves of search, for callers that must know the search started before
+    # another thread may stop it
+    def start_search(self, depth=None, nodes=None, movetime=None):
+        self.send(go_command(depth, nodes, movetime))
+
+    def finish_search(self, on_info=None):
+        lines = {}
+        while True:
+            line = self.readline()
+            if line.startswith("info") and " pv " in f"{line} ":
+                info = parse_info(line)
+                lines[info.get("multipv", 1)] = info
+                if on_info is not None:
+                    on_info(info)
+            elif line.startswith("bestmove"):
+                tokens = line.split()
+                best_move = tokens[1] if len(tokens) > 1 and tokens[1] != "(none)" else None
+                return best_move, [lines[key] for key in sorted(lines)]
+
+    # interrupts a running search, which then reports its best move so far
+    def stop(self):
+        self.send("stop")
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def quit(self):
+        try:
+            self.send("quit")
+            self.process.wait(timeout=2)
+        except (EngineError, subprocess.TimeoutExpired):
+            self.process.kill()